@@ -0,0 +1,194 @@
+"""Сравнение задержки ответа бота в режимах long polling и webhook.
+
+Бот из src/main.py запускается против локального поддельного Telegram API: скрипт
+подаёт ему сообщения /help и измеряет время от появления обновления до вызова sendMessage.
+Сообщения идут от одного пользователя в один чат подряд, поэтому пауза между ответами в чат
+(SEND_CHAT_INTERVAL) и лимит запросов пользователя (RATE_LIMIT_*) здесь отключены: иначе вместо
+задержки доставки замерялись бы эти ограничения.
+
+    python benchmarks/bot_latency.py --samples 20
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Condition, Event, Thread
+from urllib.parse import parse_qs, urlparse
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+
+class FakeTelegram:
+    """Минимальный Telegram Bot API: getUpdates с настоящим long polling и запись sendMessage"""
+
+    def __init__(self):
+        self.updates = []
+        self.next_update_id = 1
+        self.changed = Condition()
+        self.replied = Event()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                url = urlparse(self.path)
+                method = url.path.rsplit('/', 1)[-1]
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode()
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                if body:
+                    params.update({k: v[0] for k, v in parse_qs(body).items()})
+                self._reply(fake.call(method, params))
+
+            do_GET = do_POST
+
+            def _reply(self, result):
+                out = json.dumps({'ok': True, 'result': result}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.api_url = f"http://127.0.0.1:{self.server.server_address[1]}/bot{{0}}/{{1}}"
+
+    def call(self, method, params):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        if method == 'getUpdates':
+            offset = int(params.get('offset') or 0)
+            deadline = time.monotonic() + float(params.get('timeout') or 0)
+            with self.changed:
+                while True:
+                    self.updates = [u for u in self.updates if u['update_id'] >= offset]
+                    remaining = deadline - time.monotonic()
+                    if self.updates or remaining <= 0:
+                        return list(self.updates)
+                    self.changed.wait(remaining)
+        if method == 'sendMessage':
+            self.replied.set()
+            return {'message_id': 1, 'date': 0, 'chat': {'id': int(params['chat_id']), 'type': 'private'}, 'text': ''}
+        return True
+
+    def make_update(self, user_id, text='/help'):
+        update = {
+            'update_id': self.next_update_id,
+            'message': {
+                'message_id': self.next_update_id, 'date': int(time.time()), 'text': text,
+                'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}],
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': 'bench'},
+            },
+        }
+        self.next_update_id += 1
+        return update
+
+    def push_update(self, update):
+        with self.changed:
+            self.updates.append(update)
+            self.changed.notify_all()
+
+    def wake(self):
+        with self.changed:
+            self.changed.notify_all()
+
+
+def measure(deliver, fake, user_id, samples):
+    """Задержки (мс) от доставки обновления до ответа бота"""
+    latencies = []
+    for _ in range(samples):
+        fake.replied.clear()
+        update = fake.make_update(user_id)
+        started = time.perf_counter()
+        deliver(update)
+        if not fake.replied.wait(30):
+            raise RuntimeError("Бот не ответил за 30 секунд")
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies
+
+
+def run_polling(main, fake, user_id, samples, interval):
+    thread = Thread(target=main.bot.polling, kwargs={
+        'none_stop': True, 'interval': interval, 'timeout': 10, 'long_polling_timeout': 5,
+    }, daemon=True)
+    thread.start()
+    try:
+        return measure(fake.push_update, fake, user_id, samples)
+    finally:
+        main.bot.stop_polling()
+        fake.wake()
+        thread.join(15)
+
+
+def run_webhook(main, fake, user_id, samples):
+    server = main.bot_wrapper.webhook_server(listen='127.0.0.1', port=0, path='/webhook', secret='bench')
+    Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/webhook"
+
+    def deliver(update):
+        request = urllib.request.Request(url, data=json.dumps(update).encode(), headers={
+            'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': 'bench',
+        })
+        urllib.request.urlopen(request).read()
+
+    try:
+        return measure(deliver, fake, user_id, samples)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def summary(latencies):
+    ordered = sorted(latencies)
+    return {
+        'mean': statistics.fmean(ordered),
+        'p50': ordered[len(ordered) // 2],
+        'p95': ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))],
+        'max': ordered[-1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--samples', type=int, default=20, help="сообщений на каждый режим (в один чат, без паузы SEND_CHAT_INTERVAL)")
+    parser.add_argument('--legacy-interval', type=float, default=3, help="пауза polling в прежней конфигурации")
+    args = parser.parse_args()
+
+    fake = FakeTelegram()
+    workdir = tempfile.mkdtemp(prefix='bot_latency_')
+    os.chdir(workdir)
+    os.environ.update(
+        TELEGRAM_TOKEN='1:bench', DB_FILE=os.path.join(workdir, 'products.db'),
+        SEND_CHAT_INTERVAL='0', RATE_LIMIT_BURST=str(10 ** 9),
+    )
+    import telebot.apihelper
+    telebot.apihelper.API_URL = fake.api_url
+    sys.path.insert(0, SRC_DIR)
+    import main as bot_main
+    # Пустая база во временном каталоге: список доступа читает таблицу allowed_users, как в работе бота
+    bot_main.db_manager.open()
+
+    user_id = next(iter(bot_main.ALLOWED_USERS))
+    results = {
+        f"polling, interval={args.legacy_interval:g}":
+            run_polling(bot_main, fake, user_id, args.samples, args.legacy_interval),
+        "polling, interval=0": run_polling(bot_main, fake, user_id, args.samples, 0),
+        "webhook": run_webhook(bot_main, fake, user_id, args.samples),
+    }
+
+    print(f"{'режим':<24}{'mean':>10}{'p50':>10}{'p95':>10}{'max':>10}  (мс, {args.samples} сообщений)")
+    for mode, latencies in results.items():
+        stats = summary(latencies)
+        print(f"{mode:<24}" + ''.join(f"{stats[k]:>10.1f}" for k in ('mean', 'p50', 'p95', 'max')))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+"""Бенчмарк горячих путей: загрузка Excel, сравнение с базой и поиск артикулов.
+
+Генерирует синтетические выгрузки в формате bot_data.xlsx (по умолчанию 10 000 и 100 000 строк),
+для каждого размера в отдельном процессе замеряет update_from_excel, перевод в колоночный снимок
+и загрузку из него, холодный старт бота, compare_excel_with_db по Excel и по снимку,
+apply_delta, построение снимка и поиск одного и нескольких артикулов так, как это делает
+handle_message. Результат — пропускная способность, p50/p99 и пиковый RSS — сохраняется в JSON.
+
+    python benchmarks/ingest_lookup.py --rows 10000 100000 1000000
+    python benchmarks/ingest_lookup.py --compare benchmarks/results/old.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import openpyxl
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+from core import (  # noqa: E402
+    DatabaseManager, EXCEL_COLUMNS, compare_excel_with_db, convert_excel, extract_articles,
+)
+
+WAREHOUSES = (
+    'ПОКУПНЫЕ ИЗДЕЛИЯ', 'СКЛАД МАГАДАН', 'СКЛАД НОВОСИБИРСК', 'СКЛАД ЧИТА',
+    'СКЛАД ИРКУТСК', 'СКЛАД ЯКУТСК', 'СКЛАД МОСКВА', 'СКЛАД КРАСНОЯРСК',
+)
+NAMES = (
+    'Уплотнительное кольцо', 'Гидрозамок', 'Шплинт прямой, цинк 3,2х32 DIN 94', 'Штифт цилиндрический 8х20 DIN 7343',
+    'Фильтр гидравлический', 'Втулка', 'Болт М12х40', 'Гидромотор хода', 'Комплект уплотнений', 'Подшипник',
+)
+LOOKUPS = 2000
+ARTICLES_PER_MESSAGE = 20
+# Доля строк, которые меняются, удаляются и добавляются во «вчерашней» выгрузке для замера сравнения
+CHANGED_SHARE = 0.01
+REMOVED_SHARE = 0.002
+ADDED_SHARE = 0.002
+
+
+def make_article(rng):
+    """Артикул в одном из форматов реальной выгрузки: 5590024, 3222 3409 48, 805-015, AB1234"""
+    kind = rng.random()
+    if kind < 0.55:
+        return str(rng.randint(100000, 999999999))
+    if kind < 0.8:
+        return f"{rng.randint(1000, 9999)} {rng.randint(1000, 9999)} {rng.randint(10, 99)}"
+    if kind < 0.95:
+        return f"{rng.randint(100, 999)}-{rng.randint(100, 999)}"
+    return f"{rng.choice('ABCKMPTX')}{rng.choice('ABCKMPTX')}{rng.randint(1000, 99999)}"
+
+
+def generate_rows(rows, seed):
+    """Строки выгрузки в порядке EXCEL_COLUMNS: позиции номенклатуры на 1–3 складах, у 5% нет артикула"""
+    rng = random.Random(seed)
+    result = []
+    number = 0
+    while len(result) < rows:
+        number += 1
+        article = make_article(rng) if rng.random() > 0.05 else None
+        code = f"УТ-{number:08d}"
+        name = rng.choice(NAMES)
+        price = round(rng.uniform(0.5, 5000), 2) if rng.random() > 0.4 else None
+        currency = rng.choice(('EUR', 'RUB', 'USD')) if price is not None else None
+        price_date = f"{rng.randint(1, 28):02d}.{rng.randint(1, 12):02d}.2025" if price is not None else None
+        for warehouse in rng.sample(WAREHOUSES, rng.randint(1, 3)):
+            result.append(['04.06.2025', article, name, code, warehouse,
+                           float(rng.randint(1, 2000)), price, currency, price_date])
+    return result[:rows]
+
+
+def write_workbook(path, rows):
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(list(EXCEL_COLUMNS))
+    for row in rows:
+        sheet.append(row)
+    workbook.save(path)
+
+
+def prepare_workbooks(workdir, rows, seed):
+    """Две выгрузки одного размера: «вчерашняя» и «сегодняшняя» с небольшими отличиями (кэшируются в workdir)"""
+    base_path = os.path.join(workdir, f"stock_{rows}_{seed}.xlsx")
+    changed_path = os.path.join(workdir, f"stock_{rows}_{seed}_changed.xlsx")
+    if os.path.exists(base_path) and os.path.exists(changed_path):
+        return base_path, changed_path
+
+    base = generate_rows(rows, seed)
+    write_workbook(base_path, base)
+
+    rng = random.Random(seed + 1)
+    changed = [list(row) for row in base]
+    for row in rng.sample(changed, int(rows * CHANGED_SHARE)):
+        row[5] += 1
+    removed = set(rng.sample(range(len(changed)), int(rows * REMOVED_SHARE)))
+    changed = [row for i, row in enumerate(changed) if i not in removed]
+    for row in generate_rows(int(rows * ADDED_SHARE), seed + 2):
+        row[3] = 'НОВ-' + row[3]
+        changed.append(row)
+    write_workbook(changed_path, changed)
+    return base_path, changed_path
+
+
+def peak_rss_mb():
+    """Пиковый RSS текущего процесса (ru_maxrss в Linux — килобайты, в macOS — байты)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def latency_stats(samples):
+    """p50/p99/максимум в миллисекундах и число операций в секунду"""
+    ordered = sorted(samples)
+    return {
+        'count': len(ordered),
+        'p50_ms': ordered[len(ordered) // 2] * 1000,
+        'p99_ms': ordered[min(len(ordered) - 1, int(0.99 * len(ordered)))] * 1000,
+        'max_ms': ordered[-1] * 1000,
+        'ops_per_s': len(ordered) / sum(ordered) if sum(ordered) else None,
+    }
+
+
+def timed(function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - started
+
+
+def run_size(workdir, rows, seed):
+    """Все замеры для одного размера выгрузки; запускается в отдельном процессе ради честного пикового RSS"""
+    import logging
+    logging.basicConfig(level=logging.WARNING)
+    base_path, changed_path = prepare_workbooks(workdir, rows, seed)
+    db_file = os.path.join(workdir, f"bench_{rows}_{seed}.db")
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(db_file + suffix):
+            os.remove(db_file + suffix)
+
+    result = {'rows': rows}
+    manager = DatabaseManager(db_file, with_snapshot=False).open()
+
+    ok, elapsed = timed(manager.update_from_excel, base_path)
+    if not ok:
+        raise RuntimeError(f"update_from_excel не загрузил {base_path}")
+    result['update_from_excel'] = {'seconds': elapsed, 'rows_per_s': rows / elapsed, 'peak_rss_mb': peak_rss_mb()}
+
+    _, elapsed = timed(convert_excel, base_path)
+    result['convert_excel'] = {'seconds': elapsed, 'rows_per_s': rows / elapsed, 'peak_rss_mb': peak_rss_mb()}
+
+    # load_excel найдёт готовый колоночный снимок и загрузит базу из него
+    ok, elapsed = timed(manager.load_excel, base_path)
+    if not ok:
+        raise RuntimeError(f"load_excel не загрузил {base_path}")
+    result['update_from_columnar'] = {'seconds': elapsed, 'rows_per_s': rows / elapsed, 'peak_rss_mb': peak_rss_mb()}
+
+    # Холодный старт бота: открыть базу, построить снимок и убедиться, что выгрузка уже загружена
+    _, elapsed = timed(lambda: DatabaseManager(db_file).open().load_excel(base_path))
+    result['cold_start'] = {'seconds': elapsed, 'peak_rss_mb': peak_rss_mb()}
+
+    _, elapsed = timed(compare_excel_with_db, manager, convert_excel(changed_path))
+    result['compare_columnar'] = {'seconds': elapsed, 'peak_rss_mb': peak_rss_mb()}
+
+    diff, elapsed = timed(compare_excel_with_db, manager, changed_path)
+    result['compare_excel_with_db'] = {
+        'seconds': elapsed, 'rows_per_s': diff['rows'] / elapsed, 'peak_rss_mb': peak_rss_mb(),
+        'added': len(diff['added']), 'removed': len(diff['removed']), 'changed': len(diff['changed']),
+    }
+
+    ok, elapsed = timed(manager.apply_delta, diff)
+    result['apply_delta'] = {'seconds': elapsed, 'applied': ok, 'peak_rss_mb': peak_rss_mb()}
+
+    _, elapsed = timed(manager.refresh_snapshot)
+    snapshot = manager.snapshot
+    result['refresh_snapshot'] = {'seconds': elapsed, 'rows_per_s': snapshot.size / elapsed, 'peak_rss_mb': peak_rss_mb()}
+
+    # Запросы как в handle_message: выделение артикулов из текста и поиск по снимку;
+    # каждый десятый артикул отсутствует в базе
+    rng = random.Random(seed + 3)
+    known = [article for article in snapshot._by_article if article]
+    queries = [rng.choice(known) if i % 10 else f"{rng.randint(10 ** 8, 10 ** 9)}" for i in range(LOOKUPS)]
+
+    single = []
+    for article in queries:
+        started = time.perf_counter()
+        snapshot.find_many(extract_articles(article))
+        single.append(time.perf_counter() - started)
+    result['lookup_single'] = latency_stats(single)
+
+    multi = []
+    for start in range(0, LOOKUPS, ARTICLES_PER_MESSAGE):
+        text = ' '.join(queries[start:start + ARTICLES_PER_MESSAGE])
+        started = time.perf_counter()
+        snapshot.find_many(extract_articles(text))
+        multi.append(time.perf_counter() - started)
+    result['lookup_multi'] = latency_stats(multi)
+    result['lookup_multi']['articles_per_message'] = ARTICLES_PER_MESSAGE
+
+    sql = []
+    for article in queries:
+        started = time.perf_counter()
+        manager.search_products(''.join(c for c in article if c.isdigit()))
+        sql.append(time.perf_counter() - started)
+    result['search_products_sql'] = latency_stats(sql)
+
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=SRC_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report, previous=None):
+    """Таблица результатов; с previous — отношение к прошлому прогону (больше 1 — стало медленнее)"""
+    old_sizes = {size['rows']: size for size in (previous or {}).get('sizes', [])}
+    metrics = (
+        ('update_from_excel', 'seconds'), ('convert_excel', 'seconds'), ('update_from_columnar', 'seconds'),
+        ('cold_start', 'seconds'), ('compare_excel_with_db', 'seconds'), ('compare_columnar', 'seconds'),
+        ('apply_delta', 'seconds'),
+        ('refresh_snapshot', 'seconds'), ('lookup_single', 'p50_ms'), ('lookup_single', 'p99_ms'),
+        ('lookup_multi', 'p50_ms'), ('lookup_multi', 'p99_ms'), ('search_products_sql', 'p50_ms'),
+        ('search_products_sql', 'p99_ms'), (None, 'peak_rss_mb'),
+    )
+    for size in report['sizes']:
+        old = old_sizes.get(size['rows'])
+        print(f"\n{size['rows']} строк")
+        for stage, metric in metrics:
+            if stage and stage not in size:
+                continue
+            value = size[stage][metric] if stage else size[metric]
+            line = f"  {(stage + ' ' if stage else '') + metric:<38}{value:>12.3f}"
+            if old and (not stage or stage in old):
+                old_value = old[stage][metric] if stage else old[metric]
+                if old_value:
+                    line += f"   x{value / old_value:.2f} к {previous.get('revision') or 'прошлому прогону'}"
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000], help="размеры выгрузок")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'),
+                        help="где хранить сгенерированные выгрузки и базы")
+    parser.add_argument('--output', help="файл JSON с результатами (по умолчанию benchmarks/results/<время>.json)")
+    parser.add_argument('--compare', help="JSON прошлого прогона для сравнения")
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    context = multiprocessing.get_context('spawn')
+    sizes = []
+    for rows in args.rows:
+        with context.Pool(1) as pool:
+            sizes.append(pool.apply(run_size, (args.workdir, rows, args.seed)))
+
+    report = {
+        'revision': git_revision(),
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': args.seed,
+        'sizes': sizes,
+    }
+    output = args.output or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'results', f"{datetime.now():%Y%m%d-%H%M%S}.json",
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            previous = json.load(f)
+    print_report(report, previous)
+    print(f"\nРезультаты сохранены в {output}")
+
+
+if __name__ == '__main__':
+    main()
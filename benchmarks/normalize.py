@@ -0,0 +1,101 @@
+"""Бенчмарк нормализации артикулов: построчная обработка против пачечной и выделение артикулов из сообщений.
+
+Сравнивает прежний способ (re.sub на каждую строку выгрузки, регулярка компилируется при каждом
+сообщении и слова фильтруются отдельным проходом) с core.normalize на синтетической выгрузке.
+
+    python benchmarks/normalize.py --rows 100000 1000000
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+from core import extract_articles, product_rows  # noqa: E402
+from core.excel import LOAD_BATCH_SIZE  # noqa: E402
+from core.schema import ARTICLE_INDEX  # noqa: E402
+from ingest_lookup import generate_rows  # noqa: E402
+
+MESSAGES = 20000
+ARTICLES_PER_MESSAGE = 5
+REPEATS = 3
+
+
+def old_product_rows(batch, loaded_at):
+    """Как было: нормализованный артикул и ключ считаются заново для каждой строки"""
+    return [
+        values + (
+            re.sub(r'[^\d]', '', str(values[ARTICLE_INDEX])),
+            re.sub(r'[\W_]+', '', str(values[ARTICLE_INDEX])).upper() if values[ARTICLE_INDEX] else '',
+            loaded_at,
+        )
+        for values in batch
+    ]
+
+
+def old_extract_articles(text):
+    """Как было: регулярка собирается при каждом вызове, слова без цифр отсеиваются отдельным проходом"""
+    article_pattern = r"[A-Za-zА-Яа-яЁё0-9][A-Za-zА-Яа-яЁё0-9\-/]{2,}[A-Za-zА-Яа-яЁё0-9]"
+    articles = dict.fromkeys(re.findall(article_pattern, text))
+    return [a for a in articles if len(a) >= 4 and any(c.isdigit() for c in a)]
+
+
+def best_of(function, *args):
+    """Лучшее время из REPEATS запусков"""
+    elapsed = []
+    for _ in range(REPEATS):
+        started = time.perf_counter()
+        function(*args)
+        elapsed.append(time.perf_counter() - started)
+    return min(elapsed)
+
+
+def normalize_all(rows_function, batches):
+    for batch in batches:
+        rows_function(batch, '2025-06-04 00:00:00')
+
+
+def extract_all(extract, messages):
+    for message in messages:
+        extract(message)
+
+
+def report(name, old, new, count, unit):
+    print(f"  {name:<28}было {old:8.3f} с   стало {new:8.3f} с   x{old / new:5.2f}   "
+          f"({count / new:,.0f} {unit}/с)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[100000, 1000000], help="размеры выгрузок")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    for rows in args.rows:
+        data = [tuple(row) for row in generate_rows(rows, args.seed)]
+        batches = [data[i:i + LOAD_BATCH_SIZE] for i in range(0, rows, LOAD_BATCH_SIZE)]
+        assert old_product_rows(batches[0], '') == product_rows(batches[0], '')
+
+        rng = random.Random(args.seed)
+        articles = [row[ARTICLE_INDEX] for row in data if row[ARTICLE_INDEX]]
+        messages = [
+            "Добрый день! Есть ли в наличии " + ', '.join(rng.sample(articles, ARTICLES_PER_MESSAGE)) + " и гидрозамок?"
+            for _ in range(MESSAGES)
+        ]
+        assert all(old_extract_articles(m) == extract_articles(m) for m in messages[:1000])
+
+        print(f"\n{rows} строк, различных артикулов: {len(set(articles))}")
+        report('нормализация при загрузке',
+               best_of(normalize_all, old_product_rows, batches), best_of(normalize_all, product_rows, batches),
+               rows, 'строк')
+        report('выделение артикулов',
+               best_of(extract_all, old_extract_articles, messages), best_of(extract_all, extract_articles, messages),
+               MESSAGES, 'сообщений')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Общее ядро бота и mail_watcher: схема базы, загрузка Excel и колоночных снимков, конвейер загрузки, поиск, история, сводки и доступ к SQLite.
+
+Импорт пакета не открывает соединений: база открывается вызовом DatabaseManager(...).open().
+Из окружения читаются только значения настроек по умолчанию (например, DELTA_MAX_RATIO),
+поэтому .env нужно загрузить до импорта; явно переданные параметры важнее окружения.
+"""
+from .columnar import columnar_path, columnar_source, convert_excel, iter_columnar_batches, iter_source_batches
+from .db import ConnectionPool, DatabaseManager
+from .diff import apply_diff, compare_batches_with_db, compare_excel_with_db, sync_db_with_excel
+from .excel import excel_cell_text, iter_excel_batches, product_key, product_rows
+from .history import article_history, changes_since, history_started, stock_at
+from .metrics import METRICS, Metrics
+from .normalize import article_clean, article_key, extract_articles, normalize_articles
+from .pipeline import fan_out, parse_and_compare
+from .rollups import article_total, low_stock, top_articles, warehouse_positions, warehouse_totals
+from .schema import EXCEL_COLUMNS, PRODUCT_COLUMNS
+from .search import ProductSnapshot, text_tokens
+
+__all__ = [
+    'ConnectionPool',
+    'DatabaseManager',
+    'EXCEL_COLUMNS',
+    'METRICS',
+    'Metrics',
+    'PRODUCT_COLUMNS',
+    'ProductSnapshot',
+    'apply_diff',
+    'article_clean',
+    'article_history',
+    'article_key',
+    'article_total',
+    'changes_since',
+    'columnar_path',
+    'columnar_source',
+    'compare_batches_with_db',
+    'compare_excel_with_db',
+    'convert_excel',
+    'excel_cell_text',
+    'extract_articles',
+    'fan_out',
+    'history_started',
+    'iter_columnar_batches',
+    'iter_excel_batches',
+    'iter_source_batches',
+    'low_stock',
+    'normalize_articles',
+    'parse_and_compare',
+    'product_key',
+    'product_rows',
+    'stock_at',
+    'sync_db_with_excel',
+    'text_tokens',
+    'top_articles',
+    'warehouse_positions',
+    'warehouse_totals',
+]
@@ -0,0 +1,149 @@
+"""Колоночный снимок выгрузки: Excel-файл разбирается один раз, дальше читается готовый файл.
+
+Формат — последовательность pickle: заголовок (версия формата, колонки, sha256 и размер
+исходного Excel-файла), порции по LOAD_BATCH_SIZE строк и None в конце. В порции каждая
+колонка хранится словарным кодированием: кортеж различных значений и array('I') с номерами
+значений по строкам. Порции пишутся и читаются по одной, так что память не растёт с размером
+файла. Файл пишет только ingest этого же сервиса, поэтому pickle здесь безопасен; чужие файлы
+этим модулем читать нельзя.
+"""
+import hashlib
+import logging
+import os
+import pickle
+from array import array
+from datetime import datetime
+
+from .excel import LOAD_BATCH_SIZE, iter_excel_batches
+from .metrics import METRICS
+from .schema import EXCEL_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+COLUMNAR_FORMAT = 2
+COLUMNAR_SUFFIX = '.columns'
+
+
+def columnar_path(excel_file):
+    """Путь колоночного снимка рядом с Excel-файлом: bot_data.xlsx → bot_data.columns"""
+    return os.path.splitext(excel_file)[0] + COLUMNAR_SUFFIX
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _encode_chunk(rows):
+    """Строки одной порции → по колонке: (кортеж различных значений, array('I') номеров значений)"""
+    chunk = []
+    for column in zip(*rows):
+        dictionary = {}
+        codes = array('I')
+        for value in column:
+            code = dictionary.get(value)
+            if code is None:
+                code = dictionary[value] = len(dictionary)
+            codes.append(code)
+        chunk.append((tuple(dictionary), codes))
+    return chunk
+
+
+def write_columnar(batches, path, source_sha256=None, source_size=None, chunk_size=LOAD_BATCH_SIZE):
+    """Записывает пачки строк (в порядке EXCEL_COLUMNS) в колоночный снимок; возвращает число строк"""
+    header = {
+        'format': COLUMNAR_FORMAT,
+        'columns': tuple(EXCEL_COLUMNS.values()),
+        'source_sha256': source_sha256,
+        'source_size': source_size,
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+    }
+    rows = 0
+    pending = []
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+            for batch in batches:
+                rows += len(batch)
+                pending.extend(batch)
+                while len(pending) >= chunk_size:
+                    pickle.dump(_encode_chunk(pending[:chunk_size]), f, protocol=pickle.HIGHEST_PROTOCOL)
+                    del pending[:chunk_size]
+            if pending:
+                pickle.dump(_encode_chunk(pending), f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(None, f, protocol=pickle.HIGHEST_PROTOCOL)
+    except BaseException:
+        # Недописанный снимок при ошибке разбора не оставляем
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+    return rows
+
+
+def read_columnar_header(path):
+    """Заголовок снимка без чтения данных; None, если файла нет или формат другой"""
+    try:
+        with open(path, 'rb') as f:
+            header = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    if not isinstance(header, dict) or header.get('format') != COLUMNAR_FORMAT:
+        return None
+    if header.get('columns') != tuple(EXCEL_COLUMNS.values()):
+        return None
+    return header
+
+
+def iter_columnar_batches(path, batch_size=LOAD_BATCH_SIZE):
+    """Пачки строк из колоночного снимка — в том же виде, что и iter_excel_batches"""
+    with open(path, 'rb') as f:
+        header = pickle.load(f)
+        if header.get('format') != COLUMNAR_FORMAT:
+            raise ValueError(f"{path}: неизвестный формат колоночного снимка {header.get('format')}")
+        pending = []
+        # Порции читаются по одной, поэтому память не зависит от размера снимка
+        while (chunk := pickle.load(f)) is not None:
+            pending.extend(zip(*([dictionary[code] for code in codes] for dictionary, codes in chunk)))
+            while len(pending) >= batch_size:
+                yield pending[:batch_size]
+                del pending[:batch_size]
+        if pending:
+            yield pending
+
+
+def convert_excel(excel_file, path=None):
+    """Разбирает Excel-файл один раз и сохраняет колоночный снимок; возвращает путь к нему"""
+    path = path or columnar_path(excel_file)
+    with METRICS.span('excel_parse', log=True, stage='convert'):
+        rows = write_columnar(
+            iter_excel_batches(excel_file), path,
+            source_sha256=file_sha256(excel_file), source_size=os.path.getsize(excel_file),
+        )
+    logger.info(f"Колоночный снимок {path} сохранён, строк: {rows}")
+    return path
+
+
+def columnar_source(excel_file, path=None):
+    """Колоночный снимок, соответствующий Excel-файлу: готовый, если он актуален, иначе создаётся заново"""
+    path = path or columnar_path(excel_file)
+    header = read_columnar_header(path)
+    if header is not None and header['source_size'] == os.path.getsize(excel_file) \
+            and header['source_sha256'] == file_sha256(excel_file):
+        return path
+    return convert_excel(excel_file, path)
+
+
+def source_format(source):
+    return 'columnar' if source.endswith(COLUMNAR_SUFFIX) else 'xlsx'
+
+
+def iter_source_batches(source, batch_size=LOAD_BATCH_SIZE):
+    """Пачки строк из колоночного снимка или, для .xlsx, прямо из Excel-файла"""
+    if source_format(source) == 'columnar':
+        return iter_columnar_batches(source, batch_size)
+    return iter_excel_batches(source, batch_size)
@@ -0,0 +1,459 @@
+"""Доступ к SQLite-базе остатков: пул соединений и DatabaseManager"""
+import logging
+import os
+import queue
+import sqlite3
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from threading import Lock
+from urllib.request import pathname2url
+
+from .columnar import columnar_source, iter_source_batches, read_columnar_header, source_format
+from .excel import product_rows
+from .history import record_delta, record_table, seed_history
+from .rollups import rebuild_rollups, seed_rollups, update_rollups
+from .normalize import article_key
+from .metrics import METRICS
+from .schema import (
+    ALLOWED_USERS_TABLE_SQL, ARTICLE_INDEX, ARTICLE_ROLLUP_TABLE_SQL, DELETE_PRODUCT_SQL, EXCEL_COLUMNS,
+    HISTORY_INDEXES_SQL, HISTORY_TABLE_SQL, INSERT_PRODUCT_SQL, META_TABLE_SQL, PRODUCT_KEY_SQL, PRODUCTS_INDEXES_SQL,
+    PRODUCTS_TABLE_SQL, ROLLUP_INDEXES_SQL, UPDATE_PERIOD_SQL, UPDATE_PRODUCT_SQL, WAREHOUSE_INDEX,
+    WAREHOUSE_ROLLUP_TABLE_SQL,
+)
+from .search import ProductSnapshot
+
+logger = logging.getLogger(__name__)
+
+# Процессы бота и mail_watcher согласуют доступ к базе через блокировки самой SQLite (WAL):
+# сколько секунд ждать, пока другой процесс освободит блокировку записи
+SQLITE_TIMEOUT = 60
+# Пул соединений: одно соединение записи и до DB_READ_POOL_SIZE соединений только для чтения;
+# каждое соединение держит кэш из DB_STATEMENT_CACHE подготовленных запросов
+DB_READ_POOL_SIZE = int(os.getenv('DB_READ_POOL_SIZE', '4'))
+DB_STATEMENT_CACHE = 64
+# Как часто проверять, не обновил ли базу другой процесс (секунды)
+SNAPSHOT_CHECK_INTERVAL = int(os.getenv('SNAPSHOT_CHECK_INTERVAL', '10'))
+# Сколько ключей с расходящимися дублями строк выводить в лог при загрузке
+DUPLICATE_LOG_LIMIT = 10
+
+
+def collapse_duplicates(conn, table, source):
+    """Оставляет в table по последней строке на ключ; возвращает число удалённых строк.
+
+    В лог попадает число повторов, а ключи, строки которых расходятся в значениях, — вместе
+    со всеми вариантами значений: иначе такие строки терялись бы незаметно.
+    """
+    columns = ', '.join(EXCEL_COLUMNS.values())
+    variants = {}
+    for row in conn.execute(f'''
+        SELECT {PRODUCT_KEY_SQL}, {columns} FROM {table}
+        WHERE ({PRODUCT_KEY_SQL}) IN (SELECT {PRODUCT_KEY_SQL} FROM {table} GROUP BY 1, 2, 3 HAVING COUNT(*) > 1)
+        ORDER BY id
+    '''):
+        values = variants.setdefault(tuple(row[:3]), [])
+        if tuple(row[3:]) not in values:
+            values.append(tuple(row[3:]))
+    if not variants:
+        return 0
+
+    duplicates = conn.execute(f'''
+        DELETE FROM {table} WHERE id NOT IN (SELECT MAX(id) FROM {table} GROUP BY {PRODUCT_KEY_SQL})
+    ''').rowcount
+    conflicts = {key: values for key, values in variants.items() if len(values) > 1}
+    logger.warning(
+        f"В файле {source} повторяющихся строк: {duplicates}, ключей с повторами: {len(variants)}, "
+        f"из них с разными значениями: {len(conflicts)}; по каждому ключу оставлена последняя строка"
+    )
+    for key, values in list(conflicts.items())[:DUPLICATE_LOG_LIMIT]:
+        logger.warning(f"Разные строки с ключом {key} ({columns}): " + '; '.join(map(str, values)))
+    return duplicates
+
+
+class ConnectionPool:
+    """Соединения SQLite, открытые один раз: одно для записи и пул соединений только для чтения (WAL)"""
+
+    def __init__(self, db_file, size=DB_READ_POOL_SIZE):
+        self.db_file = db_file
+        self.size = size
+        self._writer = None
+        self._writer_lock = Lock()
+        self._idle = queue.LifoQueue()
+        self._lock = Lock()
+        self.opened = 0
+        self.acquired = 0
+        self.waited = 0
+        self.writer_acquired = 0
+        self.writer_wait = 0.0
+
+    def _open(self, read_only):
+        """Соединение в режиме autocommit (транзакциями управляем явно), строки — sqlite3.Row"""
+        if read_only:
+            uri = f"file:{pathname2url(os.path.abspath(self.db_file))}?mode=ro"
+        else:
+            uri = f"file:{pathname2url(os.path.abspath(self.db_file))}"
+        conn = sqlite3.connect(
+            uri, uri=True, timeout=SQLITE_TIMEOUT, isolation_level=None,
+            check_same_thread=False, cached_statements=DB_STATEMENT_CACHE,
+        )
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @contextmanager
+    def writer(self):
+        """Единственное соединение записи; потоки процесса получают его по очереди"""
+        started = time.perf_counter()
+        with self._writer_lock:
+            self.writer_acquired += 1
+            self.writer_wait += time.perf_counter() - started
+            if self._writer is None:
+                self._writer = self._open(read_only=False)
+            yield self._writer
+
+    @contextmanager
+    def reader(self):
+        """Соединение только для чтения из пула; если все заняты — ждёт освобождения"""
+        with self._lock:
+            self.acquired += 1
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = None
+                open_new = self.opened < self.size
+                if open_new:
+                    self.opened += 1
+                else:
+                    self.waited += 1
+        if conn is None:
+            if open_new:
+                try:
+                    conn = self._open(read_only=True)
+                except Exception:
+                    with self._lock:
+                        self.opened -= 1
+                    raise
+            else:
+                conn = self._idle.get()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            self._idle.put(conn)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'readers': self.opened,
+                'readers_idle': self._idle.qsize(),
+                'readers_max': self.size,
+                'reader_acquired': self.acquired,
+                'reader_waited': self.waited,
+                'writer_acquired': self.writer_acquired,
+                'writer_wait': self.writer_wait,
+            }
+
+
+class DatabaseManager:
+    """Доступ к базе остатков: загрузка из Excel, точечные изменения, поиск и снимок в памяти.
+
+    Конструктор не обращается к базе: соединения открываются лениво, а схему создаёт
+    и первый снимок читает open(). with_snapshot=False отключает снимок для процессов,
+    которые только пишут в базу.
+    """
+
+    def __init__(self, db_file, read_pool_size=DB_READ_POOL_SIZE, with_snapshot=True):
+        self.db_file = db_file
+        self.pool = ConnectionPool(db_file, read_pool_size)
+        self.with_snapshot = with_snapshot
+        self.snapshot = ProductSnapshot(())
+        self._snapshot_listeners = []
+
+    def add_snapshot_listener(self, listener):
+        """Регистрирует функцию listener(snapshot), вызываемую после каждой подмены снимка"""
+        self._snapshot_listeners.append(listener)
+
+    def open(self):
+        """Создаёт схему при необходимости и загружает снимок; возвращает сам менеджер"""
+        self._initialize_db()
+        if self.with_snapshot:
+            self.refresh_snapshot()
+        return self
+
+    def _initialize_db(self):
+        """Инициализация базы данных с новой структурой"""
+        with self.pool.writer() as conn:
+            # WAL позволяет читателям работать параллельно с загрузкой новой версии данных
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(PRODUCTS_TABLE_SQL.format(table='products'))
+            conn.execute(META_TABLE_SQL)
+            conn.execute(ALLOWED_USERS_TABLE_SQL)
+            if not self._has_column(conn, 'article_key'):
+                self._add_article_key(conn)
+            for sql in PRODUCTS_INDEXES_SQL:
+                try:
+                    conn.execute(sql)
+                except sqlite3.IntegrityError:
+                    # В базе старого формата могут быть дубли ключа: индекс появится при полной загрузке
+                    logger.warning("Уникальный ключ products не создан: в базе есть дубли, нужна полная загрузка")
+            # Индекс по складу заменён составным idx_warehouse_quantity
+            conn.execute('DROP INDEX IF EXISTS idx_warehouse')
+            conn.execute(HISTORY_TABLE_SQL)
+            conn.execute(ARTICLE_ROLLUP_TABLE_SQL)
+            conn.execute(WAREHOUSE_ROLLUP_TABLE_SQL)
+            for sql in HISTORY_INDEXES_SQL + ROLLUP_INDEXES_SQL:
+                conn.execute(sql)
+            loaded_at = conn.execute("SELECT value FROM meta WHERE key = 'loaded_at'").fetchone()
+            seed_history(conn, loaded_at[0] if loaded_at else datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            seed_rollups(conn)
+
+    @staticmethod
+    def _has_column(conn, column):
+        return any(row['name'] == column for row in conn.execute('PRAGMA table_info(products)'))
+
+    def _add_article_key(self, conn):
+        """Переводит базу старого формата на колонку article_key, считая ключ для уже загруженных строк"""
+        conn.create_function(
+            'article_key', 1, lambda article: article_key(article) if article else '', deterministic=True,
+        )
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Второй процесс мог перевести базу, пока мы ждали блокировку записи
+            if not self._has_column(conn, 'article_key'):
+                logger.info("Добавляю в products колонку article_key")
+                conn.execute('ALTER TABLE products ADD COLUMN article_key TEXT')
+                conn.execute('UPDATE products SET article_key = article_key(article)')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _publish(self, conn, loaded_at):
+        """Отмечает новую версию данных внутри текущей транзакции записи"""
+        version = conn.execute('PRAGMA user_version').fetchone()[0] + 1
+        conn.execute(f'PRAGMA user_version = {version}')
+        conn.execute(META_TABLE_SQL)
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('loaded_at', ?)", (loaded_at,))
+        return version
+
+    def update_from_excel(self, excel_file):
+        """Обновление базы данных из Excel файла с новой структурой или из его колоночного снимка"""
+        if not os.path.exists(excel_file):
+            logger.error(f"Файл {excel_file} не найден.")
+            return False
+
+        try:
+            logger.info(f"📂 Загружаю {excel_file}...")
+            started = time.perf_counter()
+            total = 0
+            loaded_at = None
+            articles = set()
+            warehouses = set()
+
+            with self.pool.writer() as conn:
+                try:
+                    conn.execute('PRAGMA synchronous=NORMAL')
+                    # BEGIN IMMEDIATE берёт блокировку записи SQLite: второй процесс-писатель
+                    # дождётся окончания загрузки, а читатели продолжат видеть старую таблицу
+                    conn.execute('BEGIN IMMEDIATE')
+                    conn.execute('DROP TABLE IF EXISTS products_new')
+                    conn.execute(PRODUCTS_TABLE_SQL.format(table='products_new'))
+                    insert_sql = INSERT_PRODUCT_SQL.format(table='products_new')
+
+                    for batch in METRICS.timed_iter(
+                        'source_read', iter_source_batches(excel_file), stage='load', format=source_format(excel_file),
+                    ):
+                        # Одна отметка времени на пачку вместо datetime.now() на каждую строку
+                        loaded_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                        conn.executemany(insert_sql, product_rows(batch, loaded_at))
+                        total += len(batch)
+                        articles.update(values[ARTICLE_INDEX] for values in batch)
+                        warehouses.update(values[WAREHOUSE_INDEX] for values in batch)
+
+                    swap_started = time.perf_counter()
+                    duplicates = collapse_duplicates(conn, 'products_new', excel_file)
+
+                    # Проверяем новую версию до подмены, чтобы не заменить данные пустой таблицей
+                    loaded = conn.execute('SELECT COUNT(*) FROM products_new').fetchone()[0]
+                    if total == 0 or loaded + duplicates != total:
+                        raise ValueError(f"новая таблица не прошла проверку: прочитано {total}, записано {loaded}")
+
+                    conn.execute('DROP TABLE products')
+                    conn.execute('ALTER TABLE products_new RENAME TO products')
+                    for sql in PRODUCTS_INDEXES_SQL:
+                        conn.execute(sql)
+                    with METRICS.span('history_record', mode='full'):
+                        record_table(conn, loaded_at)
+                    with METRICS.span('rollups', mode='full'):
+                        rebuild_rollups(conn)
+                    self._publish(conn, loaded_at)
+                    conn.execute('COMMIT')
+                    METRICS.observe('db_swap', time.perf_counter() - swap_started)
+                except Exception:
+                    if conn.in_transaction:
+                        conn.execute('ROLLBACK')
+                    raise
+
+            elapsed = max(time.perf_counter() - started, 1e-9)
+            METRICS.observe('db_load', elapsed, mode='full')
+            METRICS.inc('db_loads', mode='full', result='ok')
+            METRICS.inc('db_loaded_rows', total, mode='full')
+            if self.with_snapshot:
+                self.refresh_snapshot()
+            stored = f"{loaded} (строк в файле {total}, повторов ключа {duplicates})" if duplicates else loaded
+            logger.info(
+                f"✅ База данных успешно обновлена. Записей: {stored} | "
+                f"Уникальных артикулов: {len(articles - {None})} | Уникальных складов: {len(warehouses - {None})} | "
+                f"{elapsed:.2f} с ({total / elapsed:.0f} строк/с)"
+            )
+            return True
+        except Exception as e:
+            METRICS.inc('db_loads', mode='full', result='error')
+            logger.error(f"Ошибка при обновлении базы данных: {e}")
+            return False
+
+    def load_excel(self, excel_file, force=False):
+        """Загружает Excel-файл через колоночный снимок; без force пропускает уже загруженное содержимое"""
+        if not os.path.exists(excel_file):
+            logger.error(f"Файл {excel_file} не найден.")
+            return False
+        try:
+            source = columnar_source(excel_file)
+            sha256 = read_columnar_header(source)['source_sha256']
+        except Exception as e:
+            # Повреждённая выгрузка не должна останавливать бота: остаётся уже загруженная база
+            logger.error(f"Ошибка при чтении {excel_file}: {e}")
+            return False
+        if not force and self.data_version() and self.get_meta('source_sha256') == sha256:
+            logger.info(f"Содержимое {excel_file} уже загружено в базу, загрузка пропущена")
+            return True
+        if not self.update_from_excel(source):
+            return False
+        self.set_meta('source_sha256', sha256)
+        return True
+
+    def apply_delta(self, diff):
+        """Применяет различия из compare_excel_with_db точечными INSERT/DELETE/UPDATE в одной транзакции"""
+        try:
+            started = time.perf_counter()
+            with self.pool.writer() as conn:
+                try:
+                    conn.execute('PRAGMA synchronous=NORMAL')
+                    conn.execute('BEGIN IMMEDIATE')
+                    # Различия посчитаны для конкретной версии данных: если её успели заменить, дельта устарела
+                    version = conn.execute('PRAGMA user_version').fetchone()[0]
+                    if version != diff['version']:
+                        logger.warning(f"Версия базы изменилась ({diff['version']} → {version}), дельта не применена")
+                        conn.execute('ROLLBACK')
+                        return False
+                    has_key = conn.execute(
+                        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_product_key'"
+                    ).fetchone()
+                    if not has_key:
+                        logger.warning("В базе нет уникального ключа products, дельта не применена")
+                        conn.execute('ROLLBACK')
+                        return False
+                    if not (diff['added'] or diff['removed'] or diff['changed'] or diff.get('period_changed')):
+                        # Данные не изменились: версию не поднимаем, чтобы не сбрасывать снимок и кэши ответов
+                        conn.execute('ROLLBACK')
+                        METRICS.inc('db_loads', mode='delta', result='unchanged')
+                        logger.info("Различий с базой нет, изменения не применялись")
+                        return True
+
+                    loaded_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                    conn.executemany(DELETE_PRODUCT_SQL, diff['removed'])
+                    changed_rows = product_rows([values for _, values, _ in diff['changed']], loaded_at)
+                    conn.executemany(UPDATE_PRODUCT_SQL, [
+                        row + key for row, (key, _, _) in zip(changed_rows, diff['changed'])
+                    ])
+                    conn.executemany(INSERT_PRODUCT_SQL.format(table='products'), product_rows(diff['added'], loaded_at))
+                    if diff.get('period_changed'):
+                        # Период выгрузки один на весь файл и сменился: одно обновление вместо правки каждой строки
+                        conn.execute(UPDATE_PERIOD_SQL, (diff['period'], diff['period']))
+                    with METRICS.span('history_record', mode='delta'):
+                        record_delta(conn, diff, loaded_at)
+                    with METRICS.span('rollups', mode='delta'):
+                        update_rollups(conn, diff)
+                    self._publish(conn, loaded_at)
+                    conn.execute('COMMIT')
+                except Exception:
+                    if conn.in_transaction:
+                        conn.execute('ROLLBACK')
+                    raise
+
+            elapsed = time.perf_counter() - started
+            METRICS.observe('db_load', elapsed, mode='delta')
+            METRICS.inc('db_loads', mode='delta', result='ok')
+            if self.with_snapshot:
+                self.refresh_snapshot()
+            logger.info(
+                f"✅ Изменения применены к базе за {elapsed:.3f} с. Добавлено: {len(diff['added'])} | "
+                f"Удалено: {len(diff['removed'])} | Изменено: {len(diff['changed'])}"
+                + (f" | Период: {diff['period']}" if diff.get('period_changed') else '')
+            )
+            return True
+        except Exception as e:
+            METRICS.inc('db_loads', mode='delta', result='error')
+            logger.error(f"Ошибка при применении изменений к базе данных: {e}")
+            return False
+
+    def get_meta(self, key, default=None):
+        """Читает служебное значение из таблицы meta"""
+        with self.pool.reader() as conn:
+            row = conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+            return row[0] if row else default
+
+    def set_meta(self, key, value):
+        """Сохраняет служебное значение в таблицу meta"""
+        with self.pool.writer() as conn:
+            conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+
+    def allowed_users(self):
+        """Пользователи из таблицы allowed_users"""
+        with self.pool.reader() as conn:
+            return {row[0] for row in conn.execute('SELECT user_id FROM allowed_users')}
+
+    def search_products(self, article_clean):
+        """Поиск продуктов по артикулу"""
+        with self.pool.reader() as conn:
+            return conn.execute('''
+                SELECT * FROM products 
+                WHERE article_clean = ?
+                ORDER BY warehouse, period DESC
+            ''', (article_clean,)).fetchall()
+
+    def data_version(self):
+        """Версия данных: увеличивается при каждой подмене таблицы products"""
+        with self.pool.reader() as conn:
+            return conn.execute('PRAGMA user_version').fetchone()[0]
+
+    def refresh_snapshot(self):
+        """Перечитывает таблицу products и атомарно подменяет снимок в памяти"""
+        with METRICS.span('snapshot_read'), self.pool.reader() as conn:
+            # Версия и строки читаются в одной транзакции, чтобы они соответствовали друг другу
+            conn.execute('BEGIN')
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            meta = conn.execute("SELECT value FROM meta WHERE key = 'loaded_at'").fetchone()
+            products = conn.execute('SELECT * FROM products ORDER BY warehouse, period DESC').fetchall()
+            conn.execute('COMMIT')
+
+        with METRICS.span('snapshot_build'):
+            snapshot = ProductSnapshot(products, version, meta[0] if meta else None)
+        # Присваивание атрибута атомарно: читатели видят либо старый, либо новый снимок целиком
+        self.snapshot = snapshot
+        logger.info(f"Снимок базы в памяти обновлён. Версия: {version}, записей: {self.snapshot.size}")
+        for listener in self._snapshot_listeners:
+            try:
+                listener(snapshot)
+            except Exception as e:
+                logger.error(f"Ошибка в обработчике обновления снимка: {e}")
+
+    def watch_for_updates(self, interval=SNAPSHOT_CHECK_INTERVAL):
+        """Фоновая проверка: подхватывает версии данных, загруженные другим процессом"""
+        while True:
+            time.sleep(interval)
+            try:
+                if self.data_version() != self.snapshot.version:
+                    self.refresh_snapshot()
+            except Exception as e:
+                logger.error(f"Ошибка при проверке версии базы данных: {e}")
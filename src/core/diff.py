@@ -0,0 +1,300 @@
+"""Сравнение Excel-выгрузки (или её колоночного снимка) с базой и обновление базы по различиям.
+
+Строки выгрузки пачками переносятся во временную таблицу на соединении чтения, а различия
+считаются запросами по индексам ключа и по одной пишутся в файл отчёта. В памяти остаётся
+пачка строк и, только если изменений немного, списки различий для apply_delta.
+"""
+import json
+import logging
+import os
+import time
+from datetime import datetime
+
+from .columnar import iter_source_batches, source_format
+from .db import DUPLICATE_LOG_LIMIT
+from .excel import product_key
+from .metrics import METRICS
+from .schema import COMPARED_COLUMNS, EXCEL_COLUMNS, PRODUCT_KEY_SQL
+
+logger = logging.getLogger(__name__)
+
+# Если изменилась большая доля строк, полная загрузка через теневую таблицу выгоднее точечных правок
+DELTA_MAX_RATIO = float(os.getenv('DELTA_MAX_RATIO', '0.5'))
+
+# Типы колонок как в products, чтобы значения приводились одинаково и сравнивались через IS.
+# На ключ остаётся последняя строка, как и при полной загрузке; copies — сколько строк выгрузки
+# пришлось на ключ, conflicting — среди них были строки с разными значениями
+STAGING_TABLE_SQL = '''
+    CREATE TEMP TABLE diff_staging (
+        key_article TEXT NOT NULL,
+        key_code TEXT NOT NULL,
+        key_warehouse TEXT NOT NULL,
+        period TEXT,
+        article TEXT,
+        name TEXT,
+        code TEXT,
+        warehouse TEXT,
+        quantity REAL,
+        price REAL,
+        currency TEXT,
+        price_date TEXT,
+        copies INTEGER NOT NULL DEFAULT 1,
+        conflicting INTEGER NOT NULL DEFAULT 0,
+        UNIQUE (key_article, key_code, key_warehouse)
+    )
+'''
+STAGING_COLUMNS = ('key_article', 'key_code', 'key_warehouse') + tuple(EXCEL_COLUMNS.values())
+_SAME_VALUES_SQL = ' AND '.join(f'{column} IS excluded.{column}' for column in EXCEL_COLUMNS.values())
+INSERT_STAGING_SQL = f'''
+    INSERT INTO diff_staging ({', '.join(STAGING_COLUMNS)}) VALUES ({', '.join('?' * len(STAGING_COLUMNS))})
+    ON CONFLICT (key_article, key_code, key_warehouse) DO UPDATE SET
+        copies = copies + 1,
+        conflicting = conflicting OR NOT ({_SAME_VALUES_SQL}),
+        {', '.join(f'{column} = excluded.{column}' for column in EXCEL_COLUMNS.values())}
+'''
+DUPLICATES_SQL = f'''
+    SELECT {', '.join(STAGING_COLUMNS)}, copies, conflicting FROM diff_staging WHERE copies > 1
+    ORDER BY key_article, key_code, key_warehouse
+'''
+# Унарный плюс снимает с колонок diff_staging тип TEXT: иначе SQLite не использует индекс idx_product_key по выражению
+STAGING_MATCH_SQL = (
+    "IFNULL(p.article, '') = +s.key_article AND IFNULL(p.code, '') = +s.key_code "
+    "AND IFNULL(p.warehouse, '') = +s.key_warehouse"
+)
+STAGING_ROW_SQL = ', '.join(f's.{column}' for column in STAGING_COLUMNS)
+ADDED_SQL = f'''
+    SELECT {STAGING_ROW_SQL} FROM diff_staging s
+    WHERE NOT EXISTS (SELECT 1 FROM products p WHERE {STAGING_MATCH_SQL})
+    ORDER BY s.key_article, s.key_code, s.key_warehouse
+'''
+REMOVED_SQL = f'''
+    SELECT DISTINCT {PRODUCT_KEY_SQL} FROM products p
+    WHERE NOT EXISTS (
+        SELECT 1 FROM diff_staging s
+        WHERE s.key_article = IFNULL(p.article, '') AND s.key_code = IFNULL(p.code, '')
+          AND s.key_warehouse = IFNULL(p.warehouse, '')
+    )
+'''
+# В базе старого формата с дублями ключа нет idx_product_key, и запросы выше перебирали бы products
+# для каждой строки выгрузки: там новые строки ищутся через EXCEPT, а изменённые — проходом по products
+# с поиском по уникальному ключу diff_staging
+ADDED_UNINDEXED_SQL = f'''
+    SELECT {STAGING_ROW_SQL} FROM diff_staging s
+    WHERE (s.key_article, s.key_code, s.key_warehouse) IN (
+        SELECT key_article, key_code, key_warehouse FROM diff_staging
+        EXCEPT
+        SELECT {PRODUCT_KEY_SQL} FROM products
+    )
+    ORDER BY s.key_article, s.key_code, s.key_warehouse
+'''
+# Если в выгрузке несколько периодов, период сравнивается построчно вместе с остальными полями
+ROW_COMPARED_COLUMNS = ('period',) + COMPARED_COLUMNS
+
+
+def _changed_sql(columns, indexed):
+    """Строки выгрузки, у которых в products отличается хотя бы одно из columns, и прежние значения columns"""
+    same = ' AND '.join(f'p.{column} IS s.{column}' for column in columns)
+    source = (
+        f"diff_staging s JOIN products p ON {STAGING_MATCH_SQL}" if indexed else
+        "products p CROSS JOIN diff_staging s ON s.key_article = IFNULL(p.article, '') "
+        "AND s.key_code = IFNULL(p.code, '') AND s.key_warehouse = IFNULL(p.warehouse, '')"
+    )
+    return f'''
+        SELECT {STAGING_ROW_SQL}, {', '.join(f'p.{column}' for column in columns)}
+        FROM {source}
+        WHERE NOT ({same})
+        ORDER BY s.key_article, s.key_code, s.key_warehouse
+    '''
+
+
+CHANGED_SQL = {
+    (columns, indexed): _changed_sql(columns, indexed)
+    for columns in (COMPARED_COLUMNS, ROW_COMPARED_COLUMNS) for indexed in (True, False)
+}
+STAGING_PERIODS_SQL = 'SELECT DISTINCT period FROM diff_staging LIMIT 2'
+PERIOD_CHANGED_SQL = 'SELECT 1 FROM products WHERE period IS NOT ? LIMIT 1'
+
+
+class DiffReport:
+    """Файл отчёта о различиях в формате JSON Lines: по строке на изменение и сводка последней строкой.
+
+    Пишется во временный файл и заменяет прежний отчёт только целиком; без path ничего не пишет.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(f"{path}.tmp", 'w', encoding='utf-8') if path else None
+
+    def write(self, record):
+        if self._file:
+            self._file.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+
+    def finish(self, summary):
+        if self._file:
+            self.write(summary)
+            self._file.close()
+            os.replace(f"{self.path}.tmp", self.path)
+
+    def discard(self):
+        if self._file:
+            self._file.close()
+            os.remove(f"{self.path}.tmp")
+
+
+def _stage_rows(conn, batches):
+    """Переносит пачки строк выгрузки во временную таблицу diff_staging; возвращает число строк"""
+    total = 0
+    conn.execute(STAGING_TABLE_SQL)
+    conn.execute('BEGIN')
+    for batch in batches:
+        total += len(batch)
+        conn.executemany(INSERT_STAGING_SQL, [product_key(values) + tuple(values) for values in batch])
+    conn.execute('COMMIT')
+    return total
+
+
+def _report_duplicates(conn, report, source):
+    """Пишет в отчёт ключи, на которые в выгрузке пришлось несколько строк; возвращает число повторов"""
+    duplicates, keys, conflicts = 0, 0, []
+    width = len(STAGING_COLUMNS)
+    for row in conn.execute(DUPLICATES_SQL):
+        copies, conflicting = row[width:]
+        duplicates += copies - 1
+        keys += 1
+        if conflicting:
+            conflicts.append(tuple(row[:3]))
+        report.write({
+            'type': 'duplicate', 'key': tuple(row[:3]), 'values': tuple(row[3:width]),
+            'copies': copies, 'conflicting': bool(conflicting),
+        })
+    if duplicates:
+        logger.warning(
+            f"В файле {source} повторяющихся строк: {duplicates}, ключей с повторами: {keys}, "
+            f"из них с разными значениями: {len(conflicts)}; по каждому ключу сравнивается последняя строка"
+            + (f". Ключи с разными строками: {conflicts[:DUPLICATE_LOG_LIMIT]}" if conflicts else '')
+        )
+    return duplicates
+
+
+def _file_period(conn):
+    """Период выгрузки в diff_staging: (единый ли он на весь файл, сам период, отличается ли он от базы)"""
+    periods = conn.execute(STAGING_PERIODS_SQL).fetchall()
+    if len(periods) != 1:
+        return False, None, False
+    period = periods[0][0]
+    return True, period, conn.execute(PERIOD_CHANGED_SQL, (period,)).fetchone() is not None
+
+
+def _iter_differences(conn, columns):
+    """Различия между diff_staging и products по columns: кортежи (тип, ключ, значения из выгрузки, изменения)"""
+    indexed = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_product_key'"
+    ).fetchone() is not None
+    for row in conn.execute(ADDED_SQL if indexed else ADDED_UNINDEXED_SQL):
+        yield 'added', tuple(row[:3]), tuple(row[3:]), None
+    for row in conn.execute(REMOVED_SQL):
+        yield 'removed', tuple(row), None, None
+    width = len(STAGING_COLUMNS)
+    staged_indexes = [STAGING_COLUMNS.index(column) for column in columns]
+    for row in conn.execute(CHANGED_SQL[columns, indexed]):
+        changes = {
+            column: {'old': old_value, 'new': row[i]}
+            for column, i, old_value in zip(columns, staged_indexes, row[width:])
+            if old_value != row[i]
+        }
+        yield 'changed', tuple(row[:3]), tuple(row[3:width]), changes
+
+
+def compare_excel_with_db(db_manager, excel_file, report_file=None, max_ratio=None):
+    """Сравнивает данные из Excel-файла с текущей базой; полный список различий пишет в report_file.
+
+    Возвращает {'version', 'rows', 'counts', 'period', 'period_changed', 'added', 'removed', 'changed'}.
+    Если различий больше max_ratio × число строк, списки added/removed/changed не собираются (None):
+    точечно их всё равно не применить, а счётчики и отчёт остаются полными. Если период у всего файла
+    один, он сравнивается один раз: period_changed — отличается ли он от периода в базе; такая смена
+    применяется одним UPDATE и в счётчики изменений не входит. Иначе период сравнивается построчно.
+    """
+    if not os.path.exists(excel_file):
+        logger.error(f"Файл {excel_file} не найден для сравнения.")
+        return None
+    batches = iter_source_batches(excel_file)
+    batches = METRICS.timed_iter('source_read', batches, stage='diff', format=source_format(excel_file))
+    return compare_batches_with_db(db_manager, batches, excel_file, report_file, max_ratio)
+
+
+def compare_batches_with_db(db_manager, batches, source, report_file=None, max_ratio=None):
+    """То же, что compare_excel_with_db, для уже читаемого потока пачек строк; source — для отчёта и лога"""
+    report = DiffReport(report_file)
+    try:
+        with db_manager.pool.reader() as conn:
+            try:
+                with METRICS.span('diff_stage'):
+                    total = _stage_rows(conn, batches)
+                duplicates = _report_duplicates(conn, report, source)
+                limit = None if max_ratio is None else max_ratio * total
+
+                compare_started = time.perf_counter()
+                counts = {'added': 0, 'removed': 0, 'changed': 0}
+                lists = {'added': [], 'removed': [], 'changed': []}
+                # Версия и строки products читаются в одной транзакции, чтобы соответствовать друг другу
+                conn.execute('BEGIN')
+                version = conn.execute('PRAGMA user_version').fetchone()[0]
+                single_period, period, period_changed = _file_period(conn)
+                columns = COMPARED_COLUMNS if single_period else ROW_COMPARED_COLUMNS
+                for kind, key, values, changes in _iter_differences(conn, columns):
+                    counts[kind] += 1
+                    report.write({'type': kind, 'key': key, 'values': values, 'changes': changes})
+                    if lists is None:
+                        continue
+                    if limit is not None and sum(counts.values()) > limit:
+                        lists = None
+                    elif kind == 'added':
+                        lists['added'].append(values)
+                    elif kind == 'removed':
+                        lists['removed'].append(key)
+                    else:
+                        lists['changed'].append((key, values, changes))
+                conn.execute('COMMIT')
+                METRICS.observe('diff_compare', time.perf_counter() - compare_started)
+            finally:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                conn.execute('DROP TABLE IF EXISTS temp.diff_staging')
+
+        report.finish({
+            'type': 'summary', 'source': source, 'version': version, 'rows': total, 'duplicates': duplicates,
+            'counts': counts, 'period': period, 'period_changed': period_changed,
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+        })
+        logger.info(
+            f"Сравнение с текущей базой: строк {total}, будет добавлено {counts['added']}, "
+            f"удалено {counts['removed']}, изменено {counts['changed']}"
+            + (f", период меняется на {period}" if period_changed else '')
+            + (f". Полный список различий: {report_file}" if report_file else '')
+        )
+        lists = lists or {'added': None, 'removed': None, 'changed': None}
+        return {
+            'version': version, 'rows': total, 'counts': counts, 'period': period, 'period_changed': period_changed,
+            **lists,
+        }
+    except Exception as e:
+        report.discard()
+        logger.error(f"Ошибка при сравнении Excel и БД: {e}")
+        return None
+
+
+def apply_diff(db_manager, diff, excel_file):
+    """Применяет различия точечно, если их немного, иначе загружает базу из excel_file целиком"""
+    if diff['changed'] is not None and db_manager.apply_delta(diff):
+        return True
+    logger.info("Выполняю полную загрузку базы из Excel-файла")
+    return db_manager.update_from_excel(excel_file)
+
+
+def sync_db_with_excel(db_manager, excel_file, max_ratio=DELTA_MAX_RATIO, report_file=None):
+    """Обновляет базу из Excel: точечно по различиям, если их немного, иначе полной загрузкой"""
+    with METRICS.span('diff', log=True):
+        diff = compare_excel_with_db(db_manager, excel_file, report_file, max_ratio)
+    if diff is None:
+        return db_manager.update_from_excel(excel_file)
+    return apply_diff(db_manager, diff, excel_file)
@@ -0,0 +1,62 @@
+"""Потоковое чтение Excel-выгрузки остатков"""
+import openpyxl
+
+from .normalize import normalize_articles
+from .schema import ARTICLE_INDEX, EXCEL_COLUMNS, KEY_INDEXES
+
+LOAD_BATCH_SIZE = 5000
+
+
+def excel_cell_text(value):
+    """Приводит значение ячейки к тексту так же, как это делал pandas (целые числа без .0)"""
+    if value is None:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+def product_rows(batch, loaded_at):
+    """Строки для INSERT_PRODUCT_SQL: значения из Excel плюс нормализованные артикулы и время загрузки"""
+    normalized = normalize_articles(values[ARTICLE_INDEX] for values in batch)
+    return [values + normalized[values[ARTICLE_INDEX]] + (loaded_at,) for values in batch]
+
+
+def product_key(values):
+    """Ключ строки из Excel в том же виде, что и PRODUCT_KEY_SQL в базе"""
+    return tuple(excel_cell_text(values[i]) or '' for i in KEY_INDEXES)
+
+
+def iter_excel_batches(excel_file, batch_size=LOAD_BATCH_SIZE):
+    """Потоково читает Excel-файл и отдаёт пачки строк в порядке колонок EXCEL_COLUMNS"""
+    workbook = openpyxl.load_workbook(excel_file, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        positions = {name: i for i, name in enumerate(header) if name is not None}
+        indexes = [positions.get(column) for column in EXCEL_COLUMNS]
+
+        batch = []
+        for row in rows:
+            values = tuple(
+                row[i] if i is not None and i < len(row) else None
+                for i in indexes
+            )
+            if all(value is None for value in values):
+                continue
+            if values[ARTICLE_INDEX] is not None:
+                values = (
+                    values[:ARTICLE_INDEX]
+                    + (excel_cell_text(values[ARTICLE_INDEX]),)
+                    + values[ARTICLE_INDEX + 1:]
+                )
+            batch.append(values)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    finally:
+        workbook.close()
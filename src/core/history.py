@@ -0,0 +1,147 @@
+"""История остатков и цен: интервалы значений в product_history и запросы «на дату» и «что изменилось»"""
+import logging
+
+from .excel import product_key
+from .normalize import normalize_articles
+from .schema import ARTICLE_INDEX, EXCEL_COLUMNS, HISTORY_COLUMNS, HISTORY_TRACKED_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+HISTORY_KEY_WHERE_SQL = 'article = ? AND code = ? AND warehouse = ?'
+INSERT_HISTORY_SQL = (
+    f"INSERT INTO product_history ({', '.join(HISTORY_COLUMNS)}) "
+    f"VALUES ({', '.join('?' * len(HISTORY_COLUMNS))})"
+)
+CLOSE_HISTORY_SQL = f"UPDATE product_history SET valid_to = ? WHERE valid_to IS NULL AND {HISTORY_KEY_WHERE_SQL}"
+# Текущий интервал закрывается, если строки больше нет в products или отслеживаемые значения изменились.
+# Унарный плюс снимает с колонок истории тип TEXT: иначе SQLite не использует индекс idx_product_key по выражению
+CLOSE_CHANGED_SQL = f'''
+    UPDATE product_history SET valid_to = ?
+    WHERE valid_to IS NULL AND NOT EXISTS (
+        SELECT 1 FROM products p
+        WHERE IFNULL(p.article, '') = +product_history.article
+          AND IFNULL(p.code, '') = +product_history.code
+          AND IFNULL(p.warehouse, '') = +product_history.warehouse
+          AND {' AND '.join(f'p.{column} IS product_history.{column}' for column in HISTORY_TRACKED_COLUMNS)}
+    )
+'''
+# Новый интервал открывается для строк products, у ключа которых нет текущего интервала;
+# OR IGNORE нужен для баз старого формата, где в products бывают дубли ключа
+OPEN_MISSING_SQL = f'''
+    INSERT OR IGNORE INTO product_history ({', '.join(HISTORY_COLUMNS)})
+    SELECT IFNULL(article, ''), IFNULL(code, ''), IFNULL(warehouse, ''), article_key, name,
+           {', '.join(HISTORY_TRACKED_COLUMNS)}, ?
+    FROM products p
+    WHERE NOT EXISTS (
+        SELECT 1 FROM product_history h
+        WHERE h.valid_to IS NULL
+          AND h.article = IFNULL(p.article, '') AND h.code = IFNULL(p.code, '') AND h.warehouse = IFNULL(p.warehouse, '')
+    )
+'''
+VALID_AT_SQL = 'valid_from <= ? AND (valid_to IS NULL OR valid_to > ?)'
+CHANGES_SINCE_SQL = f'''
+    WITH touched AS (
+        SELECT article, code, warehouse FROM product_history WHERE valid_from > :since
+        UNION
+        SELECT article, code, warehouse FROM product_history WHERE valid_to > :since
+    )
+    SELECT t.article, t.code, t.warehouse, COALESCE(n.name, o.name) AS name,
+           o.id AS old_id, {', '.join(f'o.{column} AS old_{column}' for column in HISTORY_TRACKED_COLUMNS)},
+           n.id AS new_id, {', '.join(f'n.{column} AS new_{column}' for column in HISTORY_TRACKED_COLUMNS)}
+    FROM touched t
+    LEFT JOIN product_history o
+        ON o.article = t.article AND o.code = t.code AND o.warehouse = t.warehouse
+       AND o.valid_from <= :since AND (o.valid_to IS NULL OR o.valid_to > :since)
+    LEFT JOIN product_history n
+        ON n.article = t.article AND n.code = t.code AND n.warehouse = t.warehouse AND n.valid_to IS NULL
+    WHERE (o.id IS NULL) != (n.id IS NULL)
+       OR NOT ({' AND '.join(f'o.{column} IS n.{column}' for column in HISTORY_TRACKED_COLUMNS)})
+    ORDER BY t.article, t.code, t.warehouse
+'''
+
+_NAME_INDEX = list(EXCEL_COLUMNS.values()).index('name')
+_TRACKED_INDEXES = [list(EXCEL_COLUMNS.values()).index(column) for column in HISTORY_TRACKED_COLUMNS]
+
+
+def history_rows(items, valid_from):
+    """Строки для INSERT_HISTORY_SQL из пар (ключ, значения из Excel)"""
+    normalized = normalize_articles(values[ARTICLE_INDEX] for _, values in items)
+    return [
+        key + (normalized[values[ARTICLE_INDEX]][1], values[_NAME_INDEX])
+        + tuple(values[i] for i in _TRACKED_INDEXES) + (valid_from,)
+        for key, values in items
+    ]
+
+
+def record_table(conn, valid_from):
+    """Сверяет историю с таблицей products после полной загрузки (внутри транзакции записи)"""
+    closed = conn.execute(CLOSE_CHANGED_SQL, (valid_from,)).rowcount
+    opened = conn.execute(OPEN_MISSING_SQL, (valid_from,)).rowcount
+    logger.info(f"История остатков: закрыто интервалов {closed}, открыто {opened}")
+
+
+def record_delta(conn, diff, valid_from):
+    """Записывает в историю различия из compare_excel_with_db (внутри транзакции записи)"""
+    changed = [
+        (key, values) for key, values, changes in diff['changed']
+        if any(column in changes for column in HISTORY_TRACKED_COLUMNS)
+    ]
+    added = [(product_key(values), values) for values in diff['added']]
+    closed = diff['removed'] + [key for key, _ in changed + added]
+    conn.executemany(CLOSE_HISTORY_SQL, [(valid_from,) + key for key in closed])
+    conn.executemany(INSERT_HISTORY_SQL, history_rows(changed + added, valid_from))
+
+
+def seed_history(conn, valid_from):
+    """Открывает интервалы для уже загруженных строк, если история ещё пуста (база старого формата)"""
+    if conn.execute('SELECT 1 FROM product_history LIMIT 1').fetchone():
+        return
+    if not conn.execute('SELECT 1 FROM products LIMIT 1').fetchone():
+        return
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        if not conn.execute('SELECT 1 FROM product_history LIMIT 1').fetchone():
+            opened = conn.execute(OPEN_MISSING_SQL, (valid_from,)).rowcount
+            logger.info(f"История остатков начата с текущих данных: {opened} строк")
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+
+def stock_at(db_manager, article_key, at):
+    """Остатки и цены по ключу артикула на момент at ('YYYY-MM-DD HH:MM:SS')"""
+    with db_manager.pool.reader() as conn:
+        return conn.execute(f'''
+            SELECT * FROM product_history
+            WHERE article_key = ? AND {VALID_AT_SQL}
+            ORDER BY article, code, warehouse
+        ''', (article_key, at, at)).fetchall()
+
+
+def article_history(db_manager, article_key, limit):
+    """Последние limit интервалов по ключу артикула, новые первыми"""
+    with db_manager.pool.reader() as conn:
+        return conn.execute('''
+            SELECT * FROM product_history
+            WHERE article_key = ?
+            ORDER BY valid_from DESC, warehouse
+            LIMIT ?
+        ''', (article_key, limit)).fetchall()
+
+
+def history_started(db_manager):
+    """Начало истории: время самого раннего интервала или None, если история пуста"""
+    with db_manager.pool.reader() as conn:
+        return conn.execute('SELECT MIN(valid_from) FROM product_history').fetchone()[0]
+
+
+def changes_since(db_manager, since):
+    """Строки, у которых с момента since изменились остатки или цена: old_* — было, new_* — стало.
+
+    old_id IS NULL — строка появилась после since, new_id IS NULL — строка удалена. Строки,
+    появившиеся и удалённые после since, не возвращаются. До начала истории (history_started)
+    все строки выглядят появившимися, поэтому since раньше него стоит сдвигать на него.
+    """
+    with db_manager.pool.reader() as conn:
+        return conn.execute(CHANGES_SINCE_SQL, {'since': since}).fetchall()
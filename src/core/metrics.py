@@ -0,0 +1,185 @@
+"""Метрики горячих путей: замеры этапов (span), счётчики и текстовый формат Prometheus"""
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+logger = logging.getLogger(__name__)
+
+METRICS_PREFIX = 'articles'
+# Границы корзин гистограмм длительности (секунды)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+# По скольким последним замерам каждого этапа считать перцентили для /stats
+RECENT_SAMPLES = 1000
+
+
+def percentile(sorted_values, fraction):
+    """Перцентиль по отсортированному списку (ближайший ранг)"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.recent.append(seconds)
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+
+
+class Metrics:
+    """Реестр метрик процесса. Создание ничего не запускает: HTTP-сервер поднимает serve()"""
+
+    def __init__(self, prefix=METRICS_PREFIX, buckets=DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = buckets
+        self._lock = Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._collectors = []
+
+    def observe(self, name, seconds, **labels):
+        """Записывает длительность этапа name (секунды)"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    @contextmanager
+    def span(self, name, log=False, **labels):
+        """Замер длительности блока; с log=True длительность пишется и в лог"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.observe(name, elapsed, **labels)
+            if log:
+                details = ''.join(f" {key}={value}" for key, value in labels.items())
+                logger.info(f"⏱ {name}{details}: {elapsed:.3f} с")
+
+    def timed_iter(self, name, iterable, **labels):
+        """Обходит iterable и записывает суммарное время, потраченное на получение элементов"""
+        iterator = iter(iterable)
+        spent = 0.0
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    spent += time.perf_counter() - started
+                    return
+                spent += time.perf_counter() - started
+                yield item
+        finally:
+            self.observe(name, spent, **labels)
+
+    def inc(self, name, value=1, **labels):
+        """Увеличивает счётчик name"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def add_collector(self, collect):
+        """Регистрирует функцию, возвращающую текущие значения (name, labels, value) для экспорта"""
+        self._collectors.append(collect)
+
+    def summary(self):
+        """Сводка по этапам для /stats: число замеров, среднее, p50/p95/максимум по последним замерам"""
+        with self._lock:
+            items = [(name, labels, h.count, h.total, sorted(h.recent)) for (name, labels), h in self._histograms.items()]
+        return [
+            {
+                'name': name, 'labels': dict(labels), 'count': count, 'total': total,
+                'avg': total / count if count else 0.0,
+                'p50': percentile(recent, 0.5), 'p95': percentile(recent, 0.95),
+                'max': recent[-1] if recent else 0.0,
+            }
+            for name, labels, count, total, recent in sorted(items)
+        ]
+
+    def render(self):
+        """Все метрики в текстовом формате Prometheus"""
+        lines = []
+        typed = set()
+
+        def declare(metric, kind):
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} {kind}")
+
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+            for (name, labels), histogram in histograms:
+                metric = f"{self.prefix}_{name}_seconds"
+                declare(metric, 'histogram')
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{metric}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{metric}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+                lines.append(f"{metric}_sum{format_labels(labels)} {histogram.total}")
+                lines.append(f"{metric}_count{format_labels(labels)} {histogram.count}")
+            for (name, labels), value in counters:
+                declare(f"{self.prefix}_{name}_total", 'counter')
+                lines.append(f"{self.prefix}_{name}_total{format_labels(labels)} {value}")
+        for collect in self._collectors:
+            try:
+                for name, labels, value in collect():
+                    declare(f"{self.prefix}_{name}", 'gauge')
+                    lines.append(f"{self.prefix}_{name}{format_labels(tuple(sorted(labels.items())))} {value}")
+            except Exception as e:
+                logger.error(f"Ошибка при сборе метрик: {e}")
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, host, port):
+        """Запускает в фоне HTTP-сервер, отдающий метрики по /metrics"""
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+        logger.info(f"Метрики доступны на http://{host}:{server.server_address[1]}/metrics")
+        return server
+
+
+# Общий реестр процесса: его пополняют core, бот и mail_watcher
+METRICS = Metrics()
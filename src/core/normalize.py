@@ -0,0 +1,40 @@
+"""Нормализация артикулов: при загрузке — один раз на каждое различное значение, при запросе — готовыми регулярками"""
+import re
+
+NON_DIGITS_RE = re.compile(r'[^\d]')
+NON_ALNUM_RE = re.compile(r'[\W_]+')
+# Артикул в тексте сообщения: буквы, цифры, - и /, не короче 4 символов, хотя бы одна цифра.
+# Опережающая проверка смотрит только на символы артикула, поэтому слова без цифр отбрасываются
+# самой регуляркой, без отдельного прохода по найденным словам
+ARTICLE_RE = re.compile(
+    r"(?=[A-Za-zА-Яа-яЁё0-9\-/]*\d)[A-Za-zА-Яа-яЁё0-9][A-Za-zА-Яа-яЁё0-9\-/]{2,}[A-Za-zА-Яа-яЁё0-9]"
+)
+# Кириллические буквы, которые в артикулах пишут вместо одинаковых на вид латинских (С123 и C123)
+LOOKALIKE_TABLE = str.maketrans('АВЕКМНОРСТХ', 'ABEKMHOPCTX')
+
+
+def article_clean(article):
+    """Старый нормализованный артикул: только цифры (805-015 → 805015, AB12 → 12)"""
+    return NON_DIGITS_RE.sub('', str(article))
+
+
+def article_key(article):
+    """Ключ артикула: буквы и цифры в верхнем регистре, кириллица-двойник как латиница (805-015 → 805015, ав-12 → AB12)"""
+    return NON_ALNUM_RE.sub('', str(article)).upper().translate(LOOKALIKE_TABLE)
+
+
+def normalize_articles(articles):
+    """Нормализованные формы для набора артикулов: {артикул: (article_clean, article_key)}.
+
+    Каждое различное значение обрабатывается один раз: в выгрузке один артикул повторяется
+    по складам, и в пачке различных значений заметно меньше, чем строк.
+    """
+    return {
+        article: (article_clean(article), article_key(article) if article else '')
+        for article in set(articles)
+    }
+
+
+def extract_articles(text):
+    """Выделяет из текста артикулы в порядке упоминания, без повторов"""
+    return list(dict.fromkeys(ARTICLE_RE.findall(text)))
@@ -0,0 +1,102 @@
+"""Конвейер загрузки выгрузки: этапы в отдельных потоках, связанные ограниченными очередями.
+
+Excel-файл разбирается один раз, и пачки строк одновременно идут в колоночный снимок и в
+сравнение с базой, поэтому вся загрузка занимает примерно столько же, сколько сам разбор.
+"""
+import logging
+import os
+import queue
+from threading import Thread
+
+from .columnar import file_sha256, write_columnar
+from .diff import compare_batches_with_db
+from .excel import iter_excel_batches
+from .metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+# Сколько пачек строк может ждать в очереди каждого этапа: чтение не уходит дальше вперёд
+PIPELINE_QUEUE_SIZE = 4
+
+_DONE = object()
+_ABORTED = object()
+
+
+class _BatchQueue(queue.Queue):
+    """Очередь пачек одного этапа; ended — этап уже получил отметку конца"""
+    ended = False
+
+    def __iter__(self):
+        while True:
+            batch = self.get()
+            if batch is _DONE or batch is _ABORTED:
+                self.ended = True
+                if batch is _ABORTED:
+                    raise RuntimeError("чтение выгрузки прервано")
+                return
+            yield batch
+
+
+def fan_out(batches, consumers, queue_size=PIPELINE_QUEUE_SIZE):
+    """Отдаёт каждую пачку из batches всем потребителям; возвращает их результаты в том же порядке.
+
+    consumers — {имя этапа: функция от итератора пачек}; каждая работает в своём потоке и получает
+    пачки через ограниченную очередь, а batches читается в текущем потоке. Если упал любой этап,
+    остальные дорабатывают или прерываются, после чего исключение пробрасывается.
+    """
+    queues = {name: _BatchQueue(maxsize=queue_size) for name in consumers}
+    results, errors = {}, {}
+
+    def run(name, consume):
+        items = queues[name]
+        try:
+            with METRICS.span('pipeline_stage', stage=name):
+                results[name] = consume(iter(items))
+        except Exception as e:
+            errors[name] = e
+        # Этап, закончивший раньше времени, не должен остановить чтение на полной очереди
+        if not items.ended:
+            for _ in items:
+                pass
+
+    threads = [
+        Thread(target=run, args=(name, consume), name=f"pipeline-{name}", daemon=True)
+        for name, consume in consumers.items()
+    ]
+    for thread in threads:
+        thread.start()
+    end = _DONE
+    try:
+        for batch in batches:
+            for items in queues.values():
+                items.put(batch)
+    except BaseException:
+        end = _ABORTED
+        raise
+    finally:
+        for items in queues.values():
+            items.put(end)
+        for thread in threads:
+            thread.join()
+    if errors:
+        name, error = next(iter(errors.items()))
+        raise RuntimeError(f"этап {name}: {error}") from error
+    return [results[name] for name in consumers]
+
+
+def parse_and_compare(db_manager, excel_file, columnar_file, report_file=None, max_ratio=None, source_sha256=None):
+    """Разбирает Excel-файл один раз, одновременно сохраняя колоночный снимок и сравнивая строки с базой.
+
+    Возвращает различия в том же виде, что и compare_excel_with_db; снимок пишется в columnar_file.
+    """
+    source_sha256 = source_sha256 or file_sha256(excel_file)
+    source_size = os.path.getsize(excel_file)
+    batches = METRICS.timed_iter('source_read', iter_excel_batches(excel_file), stage='pipeline', format='xlsx')
+    rows, diff = fan_out(batches, {
+        'snapshot': lambda stream: write_columnar(stream, columnar_file, source_sha256, source_size),
+        'diff': lambda stream: compare_batches_with_db(db_manager, stream, excel_file, report_file, max_ratio),
+    })
+    if diff is None:
+        raise RuntimeError(f"не удалось сравнить {excel_file} с базой")
+    logger.info(f"Колоночный снимок {columnar_file} сохранён, строк: {rows}")
+    return diff
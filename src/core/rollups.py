@@ -0,0 +1,118 @@
+"""Сводки остатков: итоги по артикулу и по складу, пересчитываемые при загрузке, и запросы к ним"""
+import logging
+
+from .excel import product_key
+from .normalize import article_key
+
+logger = logging.getLogger(__name__)
+
+# Ограничение WHERE {where} подставляется при частичном пересчёте, для полного — пустое условие
+ARTICLE_ROLLUP_SQL = '''
+    INSERT INTO article_rollup (article_key, article, name, total_quantity, warehouses, stock_value, currency)
+    SELECT article_key, MIN(article), MIN(name), SUM(IFNULL(quantity, 0)),
+           COUNT(DISTINCT CASE WHEN quantity > 0 THEN warehouse END), SUM(quantity * price),
+           CASE WHEN COUNT(DISTINCT currency) = 1 THEN MIN(currency) END
+    FROM products
+    WHERE article_key != '' {where}
+    GROUP BY article_key
+'''
+WAREHOUSE_ROLLUP_SQL = '''
+    INSERT INTO warehouse_rollup (warehouse, currency, positions, total_quantity, stock_value)
+    SELECT IFNULL(warehouse, ''), IFNULL(currency, ''), COUNT(CASE WHEN quantity > 0 THEN 1 END),
+           SUM(IFNULL(quantity, 0)), SUM(quantity * price)
+    FROM products
+    {where}
+    GROUP BY IFNULL(warehouse, ''), IFNULL(currency, '')
+'''
+
+
+def rebuild_rollups(conn):
+    """Полный пересчёт сводок по таблице products (внутри транзакции записи)"""
+    conn.execute('DELETE FROM article_rollup')
+    conn.execute('DELETE FROM warehouse_rollup')
+    conn.execute(ARTICLE_ROLLUP_SQL.format(where=''))
+    conn.execute(WAREHOUSE_ROLLUP_SQL.format(where=''))
+
+
+def update_rollups(conn, diff):
+    """Пересчитывает сводки только для артикулов и складов, затронутых различиями (внутри транзакции записи)"""
+    keys = diff['removed'] + [product_key(values) for values in diff['added']]
+    keys += [key for key, _, _ in diff['changed']]
+    article_keys = sorted({article_key(article) for article, _, _ in keys if article} - {''})
+    warehouses = sorted({warehouse for _, _, warehouse in keys})
+
+    conn.executemany('DELETE FROM article_rollup WHERE article_key = ?', [(key,) for key in article_keys])
+    for start in range(0, len(article_keys), 500):
+        chunk = article_keys[start:start + 500]
+        conn.execute(
+            ARTICLE_ROLLUP_SQL.format(where=f"AND article_key IN ({', '.join('?' * len(chunk))})"), chunk,
+        )
+    conn.executemany('DELETE FROM warehouse_rollup WHERE warehouse = ?', [(warehouse,) for warehouse in warehouses])
+    for warehouse in warehouses:
+        conn.execute(WAREHOUSE_ROLLUP_SQL.format(where="WHERE IFNULL(warehouse, '') = ?"), (warehouse,))
+
+
+def seed_rollups(conn):
+    """Строит сводки для уже загруженных строк, если их ещё нет (база старого формата)"""
+    if conn.execute('SELECT 1 FROM warehouse_rollup LIMIT 1').fetchone():
+        return
+    if not conn.execute('SELECT 1 FROM products LIMIT 1').fetchone():
+        return
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        if not conn.execute('SELECT 1 FROM warehouse_rollup LIMIT 1').fetchone():
+            rebuild_rollups(conn)
+            logger.info("Сводки по артикулам и складам построены по текущим данным")
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+
+def article_total(db_manager, key):
+    """Итог по артикулу (ключ article_key) на всех складах или None"""
+    with db_manager.pool.reader() as conn:
+        return conn.execute('SELECT * FROM article_rollup WHERE article_key = ?', (key,)).fetchone()
+
+
+def top_articles(db_manager, limit):
+    """Артикулы с наибольшей стоимостью остатка (quantity × price)"""
+    with db_manager.pool.reader() as conn:
+        return conn.execute('''
+            SELECT * FROM article_rollup
+            WHERE stock_value IS NOT NULL
+            ORDER BY stock_value DESC
+            LIMIT ?
+        ''', (limit,)).fetchall()
+
+
+def low_stock(db_manager, threshold, limit):
+    """Артикулы, которых на всех складах вместе не больше threshold, меньший остаток первым"""
+    with db_manager.pool.reader() as conn:
+        return conn.execute('''
+            SELECT * FROM article_rollup
+            WHERE total_quantity <= ?
+            ORDER BY total_quantity, article_key
+            LIMIT ?
+        ''', (threshold, limit)).fetchall()
+
+
+def warehouse_totals(db_manager, warehouse=None):
+    """Итоги по складам в разрезе валют; с warehouse — только по этому складу"""
+    with db_manager.pool.reader() as conn:
+        if warehouse is None:
+            return conn.execute('SELECT * FROM warehouse_rollup ORDER BY warehouse, currency').fetchall()
+        return conn.execute(
+            'SELECT * FROM warehouse_rollup WHERE warehouse = ? ORDER BY currency', (warehouse,),
+        ).fetchall()
+
+
+def warehouse_positions(db_manager, warehouse, limit):
+    """Строки склада с положительным остатком, больший остаток первым (индекс idx_warehouse_quantity)"""
+    with db_manager.pool.reader() as conn:
+        return conn.execute('''
+            SELECT * FROM products
+            WHERE warehouse = ? AND quantity > 0
+            ORDER BY quantity DESC
+            LIMIT ?
+        ''', (warehouse, limit)).fetchall()
@@ -0,0 +1,122 @@
+"""Схема базы остатков и соответствие колонок Excel-выгрузки полям таблицы products"""
+
+# Соответствие колонок Excel-файла полям таблицы products
+EXCEL_COLUMNS = {
+    'Период': 'period',
+    'Артикул': 'article',
+    'Номенклатура': 'name',
+    'Номенклатура.Код': 'code',
+    'Склад': 'warehouse',
+    'Остаток': 'quantity',
+    'Цена': 'price',
+    'Валюта': 'currency',
+    'Дата установки цены': 'price_date',
+}
+ARTICLE_INDEX = list(EXCEL_COLUMNS).index('Артикул')
+WAREHOUSE_INDEX = list(EXCEL_COLUMNS).index('Склад')
+PRODUCT_COLUMNS = tuple(EXCEL_COLUMNS.values()) + ('article_clean', 'article_key', 'last_updated')
+INSERT_PRODUCT_SQL = (
+    f"INSERT INTO {{table}} ({', '.join(PRODUCT_COLUMNS)}) "
+    f"VALUES ({', '.join('?' * len(PRODUCT_COLUMNS))})"
+)
+PRODUCTS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        period TEXT,
+        article TEXT,
+        article_clean TEXT,
+        article_key TEXT,
+        name TEXT,
+        code TEXT,
+        warehouse TEXT,
+        quantity REAL,
+        price REAL,
+        currency TEXT,
+        price_date TEXT,
+        last_updated TIMESTAMP
+    )
+'''
+# Ключ строки остатков: один и тот же артикул встречается у разных позиций номенклатуры
+# на одном складе, поэтому в ключ входит и код номенклатуры
+PRODUCT_KEY_SQL = "IFNULL(article, ''), IFNULL(code, ''), IFNULL(warehouse, '')"
+PRODUCT_KEY_WHERE_SQL = "IFNULL(article, '') = ? AND IFNULL(code, '') = ? AND IFNULL(warehouse, '') = ?"
+PRODUCT_KEY_INDEX_SQL = f'CREATE UNIQUE INDEX IF NOT EXISTS idx_product_key ON products ({PRODUCT_KEY_SQL})'
+PRODUCTS_INDEXES_SQL = (
+    'CREATE INDEX IF NOT EXISTS idx_article_clean ON products (article_clean)',
+    'CREATE INDEX IF NOT EXISTS idx_article_key ON products (article_key)',
+    # Остатки склада по убыванию и «всё, что есть на складе» читаются по этому индексу
+    'CREATE INDEX IF NOT EXISTS idx_warehouse_quantity ON products (warehouse, quantity)',
+    PRODUCT_KEY_INDEX_SQL,
+)
+META_TABLE_SQL = 'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)'
+# Пользователи, которым разрешён доступ к боту, в дополнение к списку из настроек бота
+ALLOWED_USERS_TABLE_SQL = 'CREATE TABLE IF NOT EXISTS allowed_users (user_id INTEGER PRIMARY KEY, comment TEXT)'
+UPDATE_PRODUCT_SQL = (
+    f"UPDATE products SET {', '.join(f'{column} = ?' for column in PRODUCT_COLUMNS)} "
+    f"WHERE {PRODUCT_KEY_WHERE_SQL}"
+)
+DELETE_PRODUCT_SQL = f"DELETE FROM products WHERE {PRODUCT_KEY_WHERE_SQL}"
+UPDATE_PERIOD_SQL = "UPDATE products SET period = ? WHERE period IS NOT ?"
+KEY_INDEXES = [list(EXCEL_COLUMNS.values()).index(column) for column in ('article', 'code', 'warehouse')]
+# Поля, по которым сравниваются строки с одинаковым ключом. Период у выгрузки обычно один на весь файл
+# и меняется сразу у всех строк, поэтому он сравнивается один раз на файл (см. core.diff), а не построчно
+COMPARED_COLUMNS = ('name', 'quantity', 'price', 'currency', 'price_date')
+COMPARED_INDEXES = [list(EXCEL_COLUMNS.values()).index(column) for column in COMPARED_COLUMNS]
+
+# История остатков и цен: по ключу строки хранятся интервалы [valid_from, valid_to) неизменных значений,
+# valid_to IS NULL у текущего значения. Новая запись появляется только при изменении HISTORY_TRACKED_COLUMNS,
+# поэтому история растёт с числом изменений, а не с размером каталога
+HISTORY_TRACKED_COLUMNS = ('quantity', 'price', 'currency', 'price_date')
+HISTORY_COLUMNS = ('article', 'code', 'warehouse', 'article_key', 'name') + HISTORY_TRACKED_COLUMNS + ('valid_from',)
+HISTORY_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS product_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        article TEXT NOT NULL,
+        code TEXT NOT NULL,
+        warehouse TEXT NOT NULL,
+        article_key TEXT,
+        name TEXT,
+        quantity REAL,
+        price REAL,
+        currency TEXT,
+        price_date TEXT,
+        valid_from TIMESTAMP NOT NULL,
+        valid_to TIMESTAMP
+    )
+'''
+HISTORY_INDEXES_SQL = (
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_history_current ON product_history (article, code, warehouse) '
+    'WHERE valid_to IS NULL',
+    'CREATE INDEX IF NOT EXISTS idx_history_key ON product_history (article, code, warehouse, valid_from)',
+    'CREATE INDEX IF NOT EXISTS idx_history_article_key ON product_history (article_key, valid_from)',
+    'CREATE INDEX IF NOT EXISTS idx_history_valid_from ON product_history (valid_from)',
+    'CREATE INDEX IF NOT EXISTS idx_history_valid_to ON product_history (valid_to)',
+)
+
+# Сводки, пересчитываемые при загрузке: итоги по артикулу (по всем складам) и по складу в разрезе валют.
+# stock_value — сумма quantity × price; currency у артикула NULL, если его цены в разных валютах
+ARTICLE_ROLLUP_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS article_rollup (
+        article_key TEXT PRIMARY KEY,
+        article TEXT,
+        name TEXT,
+        total_quantity REAL,
+        warehouses INTEGER,
+        stock_value REAL,
+        currency TEXT
+    )
+'''
+WAREHOUSE_ROLLUP_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS warehouse_rollup (
+        warehouse TEXT NOT NULL,
+        currency TEXT NOT NULL,
+        positions INTEGER,
+        total_quantity REAL,
+        stock_value REAL,
+        PRIMARY KEY (warehouse, currency)
+    )
+'''
+ROLLUP_INDEXES_SQL = (
+    'CREATE INDEX IF NOT EXISTS idx_article_rollup_value ON article_rollup (stock_value)',
+    'CREATE INDEX IF NOT EXISTS idx_article_rollup_quantity ON article_rollup (total_quantity, article_key)',
+)
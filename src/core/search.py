@@ -0,0 +1,181 @@
+"""Снимок таблицы products в памяти: точный, нечёткий и полнотекстовый поиск без обращения к SQLite"""
+import bisect
+import heapq
+import itertools
+import math
+import os
+import re
+from collections import Counter
+from datetime import datetime
+from difflib import SequenceMatcher
+from types import MappingProxyType
+
+from .normalize import article_key
+
+# Нечёткий поиск: сколько вариантов показывать и сколько кандидатов по триграммам уточнять через difflib
+FUZZY_RESULTS_LIMIT = int(os.getenv('FUZZY_RESULTS_LIMIT', '5'))
+FUZZY_CANDIDATES = 50
+# Поиск по наименованию: сколько позиций показывать в ответе
+NAME_SEARCH_LIMIT = int(os.getenv('NAME_SEARCH_LIMIT', '5'))
+WORD_RE = re.compile(r'[^\W_]+')
+# Служебные слова запроса, которые не несут смысла для поиска по наименованию
+STOP_WORDS = frozenset({'где', 'есть', 'и', 'или', 'в', 'на', 'по', 'для', 'с', 'со', 'из', 'нужен', 'нужна', 'нужно', 'найди'})
+RUSSIAN_ENDING_LETTERS = 'аяоеёыиуюйь'
+
+
+def article_trigrams(key):
+    """Триграммы ключа с метками начала и конца строки"""
+    padded = f"^{key}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def text_tokens(text):
+    """Слова текста для полнотекстового поиска: нижний регистр, ё → е"""
+    return WORD_RE.findall(str(text).lower().replace('ё', 'е')) if text else []
+
+
+def query_stem(token):
+    """Грубая основа слова запроса: без последней гласной, чтобы «кольца» находило «кольцо»"""
+    if len(token) > 4 and token[-1] in RUSSIAN_ENDING_LETTERS:
+        return token[:-1]
+    return token
+
+
+class ProductSnapshot:
+    """Неизменяемый снимок таблицы products в памяти для поиска без обращения к SQLite"""
+
+    def __init__(self, products, version=0, loaded_at=None):
+        by_article = {}
+        by_article_clean = {}
+        for product in products:
+            # Строки из базы (sqlite3.Row) и так неизменяемы, словари закрываем от изменений
+            if isinstance(product, dict):
+                product = MappingProxyType(product)
+            by_article.setdefault(product['article'], []).append(product)
+            by_article_clean.setdefault(product['article_clean'], []).append(product)
+
+        self._by_article = MappingProxyType({k: tuple(v) for k, v in by_article.items()})
+        self._by_article_clean = MappingProxyType({k: tuple(v) for k, v in by_article_clean.items()})
+
+        # Индексы нечёткого поиска: ключ артикула → артикулы, отсортированные ключи
+        # для поиска по префиксу и триграмма → номера ключей
+        by_key = {}
+        for article, rows in self._by_article.items():
+            # Ключ посчитан при загрузке и хранится в колонке article_key
+            key = rows[0]['article_key']
+            if key:
+                by_key.setdefault(key, []).append(article)
+        self._by_key = MappingProxyType({k: tuple(v) for k, v in by_key.items()})
+        self._keys = tuple(sorted(self._by_key))
+        trigrams = {}
+        for number, key in enumerate(self._keys):
+            for gram in article_trigrams(key):
+                trigrams.setdefault(gram, []).append(number)
+        self._trigrams = MappingProxyType({k: tuple(v) for k, v in trigrams.items()})
+
+        # Полнотекстовый индекс по наименованию и коду: позиция (артикул + код) → строки
+        # по складам, слово → номера позиций, отсортированный словарь для поиска по началу слова
+        by_item = {}
+        for rows in self._by_article.values():
+            for product in rows:
+                by_item.setdefault((product['article'], product['code']), []).append(product)
+        self._items = tuple(tuple(rows) for rows in by_item.values())
+        postings = {}
+        for number, rows in enumerate(self._items):
+            for word in set(text_tokens(rows[0]['name']) + text_tokens(rows[0]['code'])):
+                postings.setdefault(word, []).append(number)
+        self._postings = MappingProxyType({k: frozenset(v) for k, v in postings.items()})
+        self._words = tuple(sorted(self._postings))
+
+        self.size = len(products)
+        self.version = version
+        self.loaded_at = loaded_at
+        self.built_at = datetime.now()
+
+    def find_by_article(self, article):
+        """Поиск записей по артикулу (точное совпадение)"""
+        return self._by_article.get(article, ())
+
+    def find(self, article):
+        """Поиск по артикулу: сначала точное совпадение, затем без учёта регистра, пробелов и дефисов"""
+        products = self._by_article.get(article)
+        if products:
+            return products
+        return tuple(
+            product
+            for original in self._by_key.get(article_key(article), ())
+            for product in self._by_article[original]
+        )
+
+    def find_many(self, articles):
+        """Пакетный поиск: пары (артикул, записи) в порядке запроса"""
+        return [(article, self.find(article)) for article in articles]
+
+    def suggest(self, query, limit=FUZZY_RESULTS_LIMIT):
+        """Нечёткий и префиксный поиск: до limit ближайших артикулов с наименованиями"""
+        key = article_key(query)
+        if len(key) < 2:
+            return []
+
+        # Кандидаты: ключи с этим префиксом (бинарный поиск) и ключи с наибольшим числом общих триграмм
+        candidates = set()
+        start = bisect.bisect_left(self._keys, key)
+        for number in range(start, min(start + FUZZY_CANDIDATES, len(self._keys))):
+            if not self._keys[number].startswith(key):
+                break
+            candidates.add(number)
+        shared = Counter()
+        for gram in article_trigrams(key):
+            shared.update(self._trigrams.get(gram, ()))
+        candidates.update(heapq.nlargest(FUZZY_CANDIDATES, shared, key=shared.get))
+
+        # difflib только для небольшого набора кандидатов, совпадение по префиксу в приоритете
+        def score(number):
+            candidate = self._keys[number]
+            return SequenceMatcher(None, key, candidate).ratio() + (0.5 if candidate.startswith(key) else 0)
+
+        results = []
+        for number in sorted(candidates, key=lambda number: (-score(number), self._keys[number])):
+            for article in self._by_key[self._keys[number]]:
+                results.append((article, self._by_article[article][0]['name']))
+            if len(results) >= limit:
+                break
+        return results[:limit]
+
+    def search_names(self, query, limit=NAME_SEARCH_LIMIT):
+        """Полнотекстовый поиск по наименованию и коду: позиции с остатками по складам, лучшие первыми"""
+        terms = [query_stem(token) for token in text_tokens(query) if len(token) > 1 and token not in STOP_WORDS]
+        if not terms:
+            return []
+
+        matched = Counter()
+        scores = Counter()
+        for term in dict.fromkeys(terms):
+            # Слово запроса совпадает с любым словом индекса, которое с него начинается
+            items = set()
+            start = bisect.bisect_left(self._words, term)
+            for word in itertools.islice(self._words, start, None):
+                if not word.startswith(term):
+                    break
+                items |= self._postings[word]
+            if not items:
+                continue
+            idf = math.log(1 + len(self._items) / len(items))
+            for number in items:
+                matched[number] += 1
+                scores[number] += idf
+
+        if not matched:
+            return []
+        # Сначала позиции, где нашлись все слова запроса; при равенстве — больший суммарный остаток
+        coverage = max(matched.values())
+        best = [number for number, count in matched.items() if count == coverage]
+        best.sort(key=lambda number: (
+            -scores[number],
+            -sum(product['quantity'] or 0 for product in self._items[number]),
+        ))
+        return [self._items[number] for number in best[:limit]]
+
+    def find_by_article_clean(self, article_clean):
+        """Поиск записей по нормализованному артикулу"""
+        return self._by_article_clean.get(article_clean, ())
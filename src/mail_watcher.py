@@ -1,21 +1,30 @@
 import os
+import base64
+import hashlib
 import imaplib
+import imaplib2
+import itertools
+import quopri
+import shutil
+import tempfile
 import email
+import email.utils
 import logging
 import time
-from threading import Thread, Lock
+from threading import Thread, Event
 from email.header import decode_header
+from urllib.parse import unquote
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import pytz
-import sqlite3
-import pandas as pd
 import re
-import difflib
 
-# Загрузка переменных окружения
+# Загрузка переменных окружения: до импорта core, который берёт из них значения по умолчанию
 load_dotenv()
 
+from core import METRICS, DatabaseManager, apply_diff, columnar_path, parse_and_compare
+from core.diff import DELTA_MAX_RATIO
+
 # === НАСТРОЙКИ ИЗ .env ===
 EMAIL = os.getenv('EMAIL')
 EMAIL_PASSWORD = os.getenv('EMAIL_PASSWORD')
@@ -23,6 +32,27 @@ IMAP_SERVER = os.getenv('IMAP_SERVER')
 TARGET_SENDER = os.getenv('TARGET_SENDER')
 EXCEL_FILENAME = 'bot_data.xlsx'  # Изменено название файла
 DB_FILE = os.getenv('DB_FILE')
+# Сколько последних дней почты просматривать и каким размером порций скачивать вложение
+MAIL_SEARCH_DAYS = int(os.getenv('MAIL_SEARCH_DAYS', '7'))
+MAIL_FETCH_CHUNK = int(os.getenv('MAIL_FETCH_CHUNK', str(1024 * 1024)))
+# Режим ожидания писем: idle (IMAP IDLE), poll (периодический NOOP) или daily (раз в сутки в 20:00)
+MAIL_WATCH_MODE = os.getenv('MAIL_WATCH_MODE', 'idle')
+MAIL_POLL_INTERVAL = int(os.getenv('MAIL_POLL_INTERVAL', '300'))
+# RFC 2177 советует перезапускать IDLE не реже чем раз в 29 минут
+MAIL_IDLE_TIMEOUT = int(os.getenv('MAIL_IDLE_TIMEOUT', str(25 * 60)))
+MAIL_RECONNECT_MAX_DELAY = int(os.getenv('MAIL_RECONNECT_MAX_DELAY', '300'))
+# Каталог для временных файлов загрузки (по умолчанию системный); вложение скачивается туда,
+# а bot_data.xlsx и его колоночный снимок заменяются только после успешной загрузки в базу
+INGEST_DIR = os.getenv('INGEST_DIR') or None
+# Каждый этап загрузки (скачивание, разбор со сравнением, запись в базу) повторяется отдельно:
+# до INGEST_STAGE_RETRIES попыток с паузой INGEST_RETRY_DELAY × номер попытки секунд
+INGEST_STAGE_RETRIES = int(os.getenv('INGEST_STAGE_RETRIES', '3'))
+INGEST_RETRY_DELAY = float(os.getenv('INGEST_RETRY_DELAY', '10'))
+# Полный список различий последней загрузки (JSON Lines); пустое значение — не сохранять
+DIFF_REPORT_FILE = os.getenv('DIFF_REPORT_FILE', 'diff_report.jsonl') or None
+# Порт HTTP-эндпоинта /metrics в формате Prometheus (не задан — эндпоинт выключен)
+MAIL_METRICS_PORT = os.getenv('MAIL_METRICS_PORT')
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
 
 # Московский часовой пояс
 MOSCOW_TZ = pytz.timezone('Europe/Moscow')
@@ -38,111 +68,6 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-db_lock = Lock()
-
-class DatabaseManager:
-    def __init__(self, db_file):
-        self.db_file = db_file
-        self._initialize_db()
-
-    def _initialize_db(self):
-        """Инициализация базы данных с новой структурой"""
-        with db_lock:
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
-
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS products (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    period TEXT,
-                    article TEXT,
-                    article_clean TEXT,
-                    name TEXT,
-                    code TEXT,
-                    warehouse TEXT,
-                    quantity REAL,
-                    price REAL,
-                    currency TEXT,
-                    price_date TEXT,
-                    last_updated TIMESTAMP
-                )
-            ''')
-
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_article_clean ON products (article_clean)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_warehouse ON products (warehouse)')
-
-            conn.commit()
-            conn.close()
-
-    def update_from_excel(self, excel_file):
-        """Обновление базы данных из Excel файла с новой структурой"""
-        if not os.path.exists(excel_file):
-            logger.error(f"Файл {excel_file} не найден.")
-            return False
-
-        try:
-            logger.info(f"📂 Загружаю Excel-файл {excel_file}...")
-            df = pd.read_excel(excel_file)
-            df = df.where(pd.notnull(df), None)
-
-            # Нормализация артикулов
-            df['article_clean'] = df['Артикул'].apply(lambda x: re.sub(r'[^\d]', '', str(x)))
-
-            with db_lock:
-                conn = sqlite3.connect(self.db_file)
-                cursor = conn.cursor()
-
-                cursor.execute('DELETE FROM products')
-
-                for _, row in df.iterrows():
-                    cursor.execute('''
-                        INSERT INTO products (
-                            period, article, article_clean, name, code,
-                            warehouse, quantity, price, currency, price_date, last_updated
-                        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    ''', (
-                        row.get('Период'),
-                        row.get('Артикул'),
-                        row['article_clean'],
-                        row.get('Номенклатура'),
-                        row.get('Номенклатура.Код'),
-                        row.get('Склад'),
-                        row.get('Остаток'),
-                        row.get('Цена'),
-                        row.get('Валюта'),
-                        row.get('Дата установки цены'),
-                        datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    ))
-
-                conn.commit()
-                conn.close()
-
-            n_articles = df['Артикул'].nunique()
-            n_warehouses = df['Склад'].nunique()
-            logger.info(f"✅ База данных успешно обновлена. Записей: {len(df)} | Уникальных артикулов: {n_articles} | Уникальных складов: {n_warehouses}")
-            return True
-        except Exception as e:
-            logger.error(f"Ошибка при обновлении базы данных: {e}")
-            return False
-
-    def search_products(self, article_clean):
-        """Поиск продуктов по артикулу"""
-        with db_lock:
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
-
-            cursor.execute('''
-                SELECT * FROM products 
-                WHERE article_clean = ?
-                ORDER BY warehouse, period DESC
-            ''', (article_clean,))
-
-            columns = [column[0] for column in cursor.description]
-            results = [dict(zip(columns, row)) for row in cursor.fetchall()]
-
-            conn.close()
-            return results
-
 
 def decode_mail_header(header):
     """Декодирует заголовки писем"""
@@ -161,137 +86,413 @@ def is_target_email(msg):
     return TARGET_SENDER.lower() in from_email.lower()
 
 
-def download_latest_excel():
-    """Скачивает самый последний Excel-файл (.xlsx) из писем от целевого отправителя."""
+IMAP_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+IMAP_TOKEN_RE = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|\{(\d+)\}\r\n|([^\s()"]+))', re.S)
+
+
+def imap_date(day):
+    """Дата в формате IMAP (01-Jan-2025) независимо от локали"""
+    return f"{day.day:02d}-{IMAP_MONTHS[day.month - 1]}-{day.year}"
+
+
+def join_fetch_response(data):
+    """Склеивает ответ imaplib на FETCH (строки и пары «префикс + литерал») обратно в одну строку байт"""
+    return b''.join(
+        item[0] + b'\r\n' + item[1] if isinstance(item, tuple) else item
+        for item in data if item
+    )
+
+
+def parse_imap_response(data):
+    """Разбирает ответ IMAP (скобки, строки, литералы, NIL) во вложенные списки"""
+    stack = [[]]
+    pos = 0
+    while pos < len(data):
+        match = IMAP_TOKEN_RE.match(data, pos)
+        if not match:
+            break
+        pos = match.end()
+        opening, closing, quoted, literal, atom = match.groups()
+        if opening:
+            stack.append([])
+        elif closing:
+            if len(stack) > 1:
+                item = stack.pop()
+                stack[-1].append(item)
+        elif quoted is not None:
+            stack[-1].append(re.sub(rb'\\(.)', rb'\1', quoted).decode('utf-8', 'replace'))
+        elif literal is not None:
+            size = int(literal)
+            stack[-1].append(data[pos:pos + size].decode('utf-8', 'replace'))
+            pos += size
+        else:
+            stack[-1].append(None if atom.upper() == b'NIL' else atom.decode('utf-8', 'replace'))
+    return stack[0]
+
+
+def fetch_item(data, name):
+    """Значение элемента name (например, BODYSTRUCTURE) из ответа на UID FETCH"""
+    for response in parse_imap_response(join_fetch_response(data)):
+        if isinstance(response, list):
+            for key, value in zip(response[0::2], response[1::2]):
+                if isinstance(key, str) and key.upper() == name:
+                    return value
+    return None
+
+
+def mime_filename(params):
+    """Имя файла из MIME-параметров (filename/name), в том числе закодированное по RFC 2047 или RFC 2231"""
+    if not isinstance(params, list):
+        return None
+    pairs = {str(key).lower(): value for key, value in zip(params[0::2], params[1::2]) if key}
+    for name in ('filename', 'name'):
+        if pairs.get(name):
+            return decode_mail_header(pairs[name])
+        # RFC 2231: filename*=utf-8''..., длинные имена разбиты на filename*0*, filename*1* ...
+        continuations = sorted(
+            (key for key in pairs if key.startswith(name + '*')),
+            key=lambda key: int(re.sub(r'\D', '', key) or 0)
+        )
+        if continuations:
+            charset, _, value = email.utils.decode_rfc2231(''.join(pairs[key] or '' for key in continuations))
+            return unquote(value, encoding=charset or 'utf-8', errors='replace')
+    return None
+
+
+def find_excel_part(structure, section=''):
+    """Ищет в BODYSTRUCTURE часть с вложением .xlsx и возвращает её номер, кодировку, размер и имя"""
+    if not isinstance(structure, list) or not structure:
+        return None
+    if isinstance(structure[0], list):
+        # multipart: сначала идут вложенные части, затем подтип и параметры
+        parts = itertools.takewhile(lambda item: isinstance(item, list), structure)
+        for number, part in enumerate(parts, 1):
+            found = find_excel_part(part, f"{section}.{number}" if section else str(number))
+            if found:
+                return found
+        return None
+
+    # Одиночная часть: тип, подтип, параметры, id, описание, кодировка, размер, ...
+    # у text/* дополнительно число строк, поэтому disposition сдвигается на одну позицию
+    maintype = (structure[0] or '').lower()
+    disposition_index = 9 if maintype == 'text' else 8
+    disposition = structure[disposition_index] if len(structure) > disposition_index else None
+    filename = None
+    if isinstance(disposition, list) and len(disposition) > 1:
+        filename = mime_filename(disposition[1])
+    filename = filename or mime_filename(structure[2])
+    if not filename or not filename.lower().endswith('.xlsx'):
+        return None
+    return {
+        'section': section or '1',
+        'encoding': (structure[5] or '').lower(),
+        'size': int(structure[6] or 0),
+        'filename': filename,
+    }
+
+
+def fetch_part_to_file(mail, uid, part, path):
+    """Скачивает часть письма порциями BODY.PEEK[...]<offset.size>, декодирует на лету и пишет в файл"""
+    with METRICS.span('imap_fetch', log=True):
+        return _fetch_part_to_file(mail, uid, part, path)
+
+
+def _fetch_part_to_file(mail, uid, part, path):
+    digest = hashlib.sha256()
+    encoding = part['encoding']
+    offset = 0
+    pending = b''
+    tmp_path = f"{path}.part"
+    with open(tmp_path, 'wb') as f:
+        while True:
+            status, data = mail.uid('FETCH', uid, f"(BODY.PEEK[{part['section']}]<{offset}.{MAIL_FETCH_CHUNK}>)")
+            if status != 'OK':
+                raise imaplib.IMAP4.error(f"не удалось скачать часть {part['section']} письма {uid}")
+            chunk = next((item[1] for item in data if isinstance(item, tuple)), b'')
+            offset += len(chunk)
+
+            if encoding == 'base64':
+                # base64 декодируется кусками, кратными 4 символам, остаток ждёт следующей порции
+                pending += b''.join(chunk.split())
+                usable = len(pending) - len(pending) % 4
+                decoded = base64.b64decode(pending[:usable])
+                pending = pending[usable:]
+            elif encoding == 'quoted-printable':
+                pending += chunk
+                decoded = b''
+            else:
+                decoded = chunk
+            f.write(decoded)
+            digest.update(decoded)
+
+            if len(chunk) < MAIL_FETCH_CHUNK:
+                break
+
+        if pending:
+            decoded = (
+                quopri.decodestring(pending) if encoding == 'quoted-printable'
+                else base64.b64decode(pending + b'=' * (-len(pending) % 4))
+            )
+            f.write(decoded)
+            digest.update(decoded)
+    os.replace(tmp_path, path)
+    return digest.hexdigest()
+
+
+def download_latest_excel(skip_uid=None, path=EXCEL_FILENAME):
+    """Скачивает самый последний Excel-файл (.xlsx) из писем от целевого отправителя в path.
+
+    Возвращает None, если подходящего вложения нет, иначе словарь с UID письма и sha256 вложения.
+    Если самое свежее письмо с вложением уже обработано (его UID равен skip_uid),
+    вложение не скачивается и sha256 равен None. Ошибки соединения с почтой пробрасываются.
+    """
     mail = None
+    started = time.perf_counter()
     try:
         mail = imaplib.IMAP4_SSL(IMAP_SERVER)
         mail.login(EMAIL, EMAIL_PASSWORD)
         mail.select('INBOX')
-
-        # Ищем все письма от нужного отправителя (не только непрочитанные)
-        status, messages = mail.search(None, f'(FROM "{TARGET_SENDER}")')
+        METRICS.observe('imap_connect', time.perf_counter() - started)
+        # UID уникален только в пределах UIDVALIDITY почтового ящика
+        uidvalidity = (mail.response('UIDVALIDITY')[1] or [b''])[0]
+        uidvalidity = uidvalidity.decode() if isinstance(uidvalidity, bytes) else str(uidvalidity or '')
+
+        # Ищем только свежие письма от нужного отправителя: ящик растёт каждый день
+        since = imap_date(datetime.now(MOSCOW_TZ) - timedelta(days=MAIL_SEARCH_DAYS))
+        with METRICS.span('imap_search'):
+            status, messages = mail.uid('SEARCH', None, f'(FROM "{TARGET_SENDER}" SINCE {since})')
         if status != 'OK':
             logger.warning("Не удалось выполнить поиск писем")
-            return False
+            return None
 
-        message_ids = messages[0].split()
-        logger.info(f"Найдено писем от {TARGET_SENDER}: {len(message_ids)}")
-        if not message_ids:
+        uids = messages[0].split()
+        logger.info(f"Найдено писем от {TARGET_SENDER} с {since}: {len(uids)}")
+        if not uids:
             logger.info("Нет писем от целевого отправителя")
-            return False
+            return None
 
         # Берём последнее письмо (самое свежее)
-        for msg_id in reversed(message_ids):
-            status, msg_data = mail.fetch(msg_id, '(RFC822)')
-            if status != 'OK':
+        for uid in reversed(uids):
+            mail_uid = f"{uidvalidity}:{uid.decode()}"
+            if mail_uid == skip_uid:
+                logger.info(f"Письмо {mail_uid} уже обработано, вложение не скачивается")
+                return {'uid': mail_uid, 'sha256': None}
+
+            # Сначала только заголовки и структура письма, без тела и вложений
+            status, header_data = mail.uid('FETCH', uid, '(BODY.PEEK[HEADER.FIELDS (FROM SUBJECT)])')
+            if status != 'OK' or not header_data or header_data[0] is None:
                 continue
-
-            msg = email.message_from_bytes(msg_data[0][1])
+            header = next((item[1] for item in header_data if isinstance(item, tuple)), b'')
+            msg = email.message_from_bytes(header)
             if not is_target_email(msg):
                 continue
 
             logger.info(f"Обработка письма: {decode_mail_header(msg.get('Subject', ''))}")
 
-            found_xlsx = False
-            for part in msg.walk():
-                if part.get_content_maintype() == 'multipart':
-                    continue
-
-                filename = part.get_filename()
-                if not filename:
-                    continue
-
-                filename = decode_mail_header(filename)
-                logger.info(f"Найдено вложение: {filename}")
-                if not filename.lower().endswith('.xlsx'):
-                    continue
-
-                try:
-                    with open(EXCEL_FILENAME, 'wb') as f:
-                        f.write(part.get_payload(decode=True))
-                    logger.info(f"Файл {filename} успешно сохранен как {EXCEL_FILENAME}")
-                    found_xlsx = True
-                    mail.store(msg_id, '+FLAGS', '\\Seen')
-                    break
-                except Exception as e:
-                    logger.error(f"Ошибка при сохранении файла: {e}")
-                    continue
-            if found_xlsx:
-                return True
+            status, structure_data = mail.uid('FETCH', uid, '(BODYSTRUCTURE)')
+            if status != 'OK':
+                continue
+            part = find_excel_part(fetch_item(structure_data, 'BODYSTRUCTURE'))
+            if part is None:
+                logger.info("В письме нет вложения .xlsx")
+                continue
+
+            logger.info(f"Найдено вложение: {part['filename']} (часть {part['section']}, {part['size']} байт)")
+            try:
+                sha256 = fetch_part_to_file(mail, uid, part, path)
+                logger.info(f"Файл {part['filename']} успешно сохранен как {path}")
+                mail.uid('STORE', uid, '+FLAGS', '\\Seen')
+                return {'uid': mail_uid, 'sha256': sha256}
+            except Exception as e:
+                logger.error(f"Ошибка при сохранении файла: {e}")
+                continue
         logger.warning("Не найдено ни одного Excel-файла (.xlsx) во вложениях писем!")
-        return False
-    except Exception as e:
-        logger.error(f"Ошибка: {e}")
-        return False
+        return None
     finally:
         if mail:
             try:
                 mail.logout()
             except Exception:
                 pass
+        METRICS.observe('mail_download', time.perf_counter() - started)
+
+
+def run_ingest(db_manager):
+    """Скачивает свежую выгрузку и обновляет базу, пропуская уже обработанные письма и вложения"""
+    with METRICS.span('ingest', log=True):
+        result = _run_ingest(db_manager)
+    METRICS.inc('ingest_runs', result=result)
+    return result != 'failed'
+
+
+def run_stage(name, function, *args):
+    """Выполняет этап загрузки с замером времени; при ошибке повторяет только этот этап"""
+    for attempt in range(1, INGEST_STAGE_RETRIES + 1):
+        try:
+            with METRICS.span('ingest_stage', log=True, stage=name):
+                return function(*args)
+        except Exception as e:
+            METRICS.inc('ingest_stage_errors', stage=name)
+            if attempt == INGEST_STAGE_RETRIES:
+                raise
+            delay = INGEST_RETRY_DELAY * attempt
+            logger.warning(f"Этап {name} не удался (попытка {attempt} из {INGEST_STAGE_RETRIES}): {e}. "
+                           f"Повтор через {delay:.0f} с")
+            time.sleep(delay)
+
+
+def load_diff(db_manager, diff, columnar_file):
+    """Этап записи в базу: различия точечно или полная загрузка из колоночного снимка"""
+    if not apply_diff(db_manager, diff, columnar_file):
+        raise RuntimeError("база данных не обновлена")
+
+
+def publish_file(path, target):
+    """Заменяет target файлом path; между файловыми системами — через копию рядом с target"""
+    try:
+        os.replace(path, target)
+    except OSError:
+        shutil.copyfile(path, f"{target}.tmp")
+        os.replace(f"{target}.tmp", target)
+
 
+def _run_ingest(db_manager):
+    """Один проход загрузки; возвращает updated, unchanged или failed"""
+    last_uid = db_manager.get_meta('mail_last_uid')
+    last_sha256 = db_manager.get_meta('mail_last_sha256')
 
-def compare_excel_with_db(excel_file, db_file):
-    """Сравнивает данные из Excel-файла с текущей базой и пишет различия в лог."""
-    if not os.path.exists(excel_file):
-        logger.error(f"Файл {excel_file} не найден для сравнения.")
-        return
+    workdir = tempfile.mkdtemp(prefix='ingest-', dir=INGEST_DIR)
+    excel_file = os.path.join(workdir, EXCEL_FILENAME)
+    columnar_file = columnar_path(excel_file)
     try:
-        df_new = pd.read_excel(excel_file)
-        df_new = df_new.where(pd.notnull(df_new), None)
-        df_new['article_clean'] = df_new['Артикул'].apply(lambda x: re.sub(r'[^\d]', '', str(x)))
-        new_dict = {}
-        for _, row in df_new.iterrows():
-            key = (str(row.get('Артикул')), str(row.get('Склад')))
-            new_dict[key] = {
-                'quantity': row.get('Остаток'),
-                'price': row.get('Цена'),
-                'currency': row.get('Валюта'),
-                'price_date': row.get('Дата установки цены'),
-                'name': row.get('Номенклатура'),
-                'code': row.get('Номенклатура.Код'),
-            }
-
-        with db_lock:
-            conn = sqlite3.connect(db_file)
-            cursor = conn.cursor()
-            cursor.execute('SELECT article, warehouse, quantity, price, currency, price_date, name, code FROM products')
-            db_dict = {}
-            for row in cursor.fetchall():
-                key = (str(row[0]), str(row[1]))
-                db_dict[key] = {
-                    'quantity': row[2],
-                    'price': row[3],
-                    'currency': row[4],
-                    'price_date': row[5],
-                    'name': row[6],
-                    'code': row[7],
-                }
-            conn.close()
-
-        added = set(new_dict.keys()) - set(db_dict.keys())
-        removed = set(db_dict.keys()) - set(new_dict.keys())
-        changed = []
-        for key in set(new_dict.keys()) & set(db_dict.keys()):
-            changes = {}
-            for field in new_dict[key]:
-                if str(new_dict[key][field]) != str(db_dict[key][field]):
-                    changes[field] = {'old': db_dict[key][field], 'new': new_dict[key][field]}
-            if changes:
-                changed.append((key, changes))
-
-        logger.info(f"Сравнение с текущей базой:")
-        logger.info(f"Будет добавлено: {len(added)} записей: {list(added)[:10]}")
-        logger.info(f"Будет удалено: {len(removed)} записей: {list(removed)[:10]}")
-        logger.info(f"Будет изменено: {len(changed)} записей. Примеры изменений: {changed[:5]}")
-    except Exception as e:
-        logger.error(f"Ошибка при сравнении Excel и БД: {e}")
+        try:
+            download = run_stage('download', download_latest_excel, last_uid, excel_file)
+        except Exception as e:
+            logger.error(f"Ошибка при скачивании выгрузки: {e}")
+            download = None
+        if download is None:
+            logger.warning("❗ Не удалось скачать последний Excel-файл")
+            return 'failed'
+
+        # То же письмо или то же содержимое вложения: разбор, сравнение и загрузка не нужны
+        if download['sha256'] is None or download['sha256'] == last_sha256:
+            skipped = int(db_manager.get_meta('ingest_unchanged_count', 0)) + 1
+            db_manager.set_meta('ingest_unchanged_count', skipped)
+            db_manager.set_meta('mail_last_uid', download['uid'])
+            logger.info(f"Выгрузка не изменилась, обновление пропущено (пропусков всего: {skipped})")
+            return 'unchanged'
+
+        # Excel разбирается один раз: пачки строк одновременно идут в колоночный снимок и в сравнение,
+        # а полная загрузка, если она понадобится, читает уже готовый снимок
+        try:
+            diff = run_stage(
+                'parse', parse_and_compare, db_manager, excel_file, columnar_file,
+                DIFF_REPORT_FILE, DELTA_MAX_RATIO, download['sha256'],
+            )
+            run_stage('load', load_diff, db_manager, diff, columnar_file)
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке {download['uid']} в базу: {e}")
+            return 'failed'
+
+        # Файлы рядом с ботом заменяются после загрузки: /reload и запуск бота видят ту же выгрузку, что и база
+        publish_file(excel_file, EXCEL_FILENAME)
+        publish_file(columnar_file, columnar_path(EXCEL_FILENAME))
+
+        # Состояние сохраняем только после успешной загрузки, иначе следующая попытка будет пропущена
+        db_manager.set_meta('mail_last_uid', download['uid'])
+        db_manager.set_meta('mail_last_sha256', download['sha256'])
+        db_manager.set_meta('source_sha256', download['sha256'])
+        return 'updated'
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+class MailboxWatcher:
+    """Держит постоянное IMAP-соединение и запускает обновление сразу после прихода нового письма.
+
+    В режиме idle ждёт уведомлений сервера через IMAP IDLE, в режиме poll (или если сервер
+    не поддерживает IDLE) раз в poll_interval секунд отправляет NOOP. При обрыве соединения
+    переподключается с экспоненциально растущей паузой. imap_factory позволяет подставить
+    локальную замену IMAP-сервера.
+    """
+
+    def __init__(self, on_new_mail, mode=MAIL_WATCH_MODE, imap_factory=None,
+                 poll_interval=MAIL_POLL_INTERVAL, idle_timeout=MAIL_IDLE_TIMEOUT,
+                 max_delay=MAIL_RECONNECT_MAX_DELAY):
+        self.on_new_mail = on_new_mail
+        self.mode = mode
+        self.imap_factory = imap_factory or (lambda: imaplib2.IMAP4_SSL(IMAP_SERVER))
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+        self.max_delay = max_delay
+        self._stopped = Event()
+        self._mail = None
+
+    def stop(self):
+        """Останавливает наблюдение (прерывает текущий IDLE)"""
+        self._stopped.set()
+        mail = self._mail
+        if mail is not None:
+            try:
+                mail.noop()
+            except Exception:
+                pass
+
+    def run(self):
+        """Основной цикл: подключение, ожидание писем, переподключение при ошибках"""
+        delay = 1
+        while not self._stopped.is_set():
+            try:
+                self._mail = self.imap_factory()
+                self._mail.login(EMAIL, EMAIL_PASSWORD)
+                status, data = self._mail.select('INBOX')
+                if status != 'OK':
+                    raise imaplib.IMAP4.error(f"не удалось открыть INBOX: {data}")
+                use_idle = self.mode == 'idle' and 'IDLE' in getattr(self._mail, 'capabilities', ())
+                logger.info(f"Подключено к почте, режим ожидания: {'IDLE' if use_idle else 'опрос'}")
+                delay = 1
+
+                # Письма могли прийти, пока соединения не было
+                self._notify()
+                self._wait_for_mail(use_idle)
+            except Exception as e:
+                if self._stopped.is_set():
+                    break
+                logger.error(f"Ошибка соединения с почтой: {e}. Повторное подключение через {delay} с")
+                self._stopped.wait(delay)
+                delay = min(delay * 2, self.max_delay)
+            finally:
+                mail, self._mail = self._mail, None
+                if mail is not None:
+                    try:
+                        mail.logout()
+                    except Exception:
+                        pass
+
+    def _wait_for_mail(self, use_idle):
+        """Ждёт уведомлений EXISTS от сервера и запускает обновление по каждому из них"""
+        while not self._stopped.is_set():
+            if use_idle:
+                self._mail.idle(timeout=self.idle_timeout)
+            else:
+                self._stopped.wait(self.poll_interval)
+                self._mail.noop()
+            _, data = self._mail.response('EXISTS')
+            if any(data or ()):
+                self._notify()
+
+    def _notify(self):
+        if self._stopped.is_set():
+            return
+        try:
+            self.on_new_mail()
+        except Exception as e:
+            logger.error(f"Ошибка при обработке новых писем: {e}")
 
 
 def run_daily_update():
     """Запускает ежедневное обновление в 20:00 по Москве"""
-    db_manager = DatabaseManager(DB_FILE)
+    db_manager = DatabaseManager(DB_FILE, with_snapshot=False).open()
 
     while True:
         try:
@@ -307,12 +508,10 @@ def run_daily_update():
             time.sleep(sleep_seconds)
 
             logger.info("Начало ежедневного обновления...")
-            if download_latest_excel():
-                compare_excel_with_db(EXCEL_FILENAME, DB_FILE)
-                if db_manager.update_from_excel(EXCEL_FILENAME):
-                    logger.info("✅ База данных успешно обновлена")
-                else:
-                    logger.error("❌ Не удалось обновить базу данных")
+            if run_ingest(db_manager):
+                logger.info("✅ База данных успешно обновлена")
+            else:
+                logger.error("❌ Не удалось обновить базу данных")
 
         except Exception as e:
             logger.error(f"Ошибка в потоке обновления: {e}")
@@ -321,14 +520,16 @@ def run_daily_update():
 
 if __name__ == '__main__':
     logger.info("Запуск сервиса обновления базы данных...")
-    db_manager = DatabaseManager(DB_FILE)
-    logger.info("Пробую скачать и обновить базу из последнего письма...")
-    if download_latest_excel():
-        compare_excel_with_db(EXCEL_FILENAME, DB_FILE)
-        if db_manager.update_from_excel(EXCEL_FILENAME):
+    if MAIL_METRICS_PORT:
+        METRICS.serve(METRICS_LISTEN, int(MAIL_METRICS_PORT))
+    db_manager = DatabaseManager(DB_FILE, with_snapshot=False).open()
+    if MAIL_WATCH_MODE == 'daily':
+        logger.info("Пробую скачать и обновить базу из последнего письма...")
+        if run_ingest(db_manager):
             logger.info("✅ База данных успешно обновлена при запуске")
         else:
             logger.error("❌ Не удалось обновить базу данных при запуске")
+        run_daily_update()
     else:
-        logger.warning("❗ Не удалось скачать последний Excel-файл при запуске")
-    run_daily_update()
\ No newline at end of file
+        # Наблюдатель сам проверяет почту сразу после подключения
+        MailboxWatcher(lambda: run_ingest(db_manager)).run()
\ No newline at end of file
@@ -1,18 +1,30 @@
 import os
-import re
+import io
 import time
 import logging
-import sqlite3
-from threading import Thread, Lock
-from datetime import datetime
+import json
+import heapq
+import queue
+from collections import Counter, OrderedDict, deque
+from datetime import datetime, timedelta
+from threading import Condition, Lock, Thread
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
 from dotenv import load_dotenv
 import telebot
-import pandas as pd
-import pytz
+import openpyxl
 
-# Загрузка переменных окружения
+# Загрузка переменных окружения: до импорта core, который берёт из них значения по умолчанию
 load_dotenv()
 
+from core import (
+    METRICS, DatabaseManager, article_history, article_key, article_total, changes_since, extract_articles,
+    history_started, low_stock, stock_at, top_articles, warehouse_positions, warehouse_totals,
+)
+from core.db import DB_READ_POOL_SIZE, SNAPSHOT_CHECK_INTERVAL
+from core.metrics import percentile
+from core.search import FUZZY_RESULTS_LIMIT, NAME_SEARCH_LIMIT
+
 # === ЛОГГИРОВАНИЕ ===
 logging.basicConfig(
     level=logging.INFO,
@@ -26,128 +38,493 @@ TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 EXCEL_FILE = 'bot_data.xlsx'  # Изменено название файла
 DB_FILE = os.getenv('DB_FILE')
 
-# Глобальная блокировка для безопасного доступа к базе данных
-db_lock = Lock()
-
-
-class DatabaseManager:
-    def __init__(self, db_file):
-        self.db_file = db_file
-        self._initialize_db()
-
-    def _initialize_db(self):
-        """Инициализация базы данных с новой структурой"""
-        with db_lock:
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
-
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS products (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    period TEXT,
-                    article TEXT,
-                    article_clean TEXT,
-                    name TEXT,
-                    code TEXT,
-                    warehouse TEXT,
-                    quantity REAL,
-                    price REAL,
-                    currency TEXT,
-                    price_date TEXT,
-                    last_updated TIMESTAMP
-                )
-            ''')
+# Ответ на список артикулов: не больше MAX_ARTICLES_PER_REQUEST артикулов за раз,
+# а начиная с ARTICLES_FILE_THRESHOLD результат отправляется Excel-файлом
+MAX_ARTICLES_PER_REQUEST = int(os.getenv('MAX_ARTICLES_PER_REQUEST', '500'))
+ARTICLES_FILE_THRESHOLD = int(os.getenv('ARTICLES_FILE_THRESHOLD', '20'))
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Кэш готовых ответов по артикулам: сколько ответов хранить и для скольких самых частых
+# артикулов готовить ответы сразу после загрузки новой версии данных
+REPLY_CACHE_SIZE = int(os.getenv('REPLY_CACHE_SIZE', '2000'))
+REPLY_CACHE_WARM = int(os.getenv('REPLY_CACHE_WARM', '200'))
+# Сводки: сколько строк показывать в /top, /low и /warehouse и какой суммарный остаток считать малым
+ROLLUP_RESULTS_LIMIT = int(os.getenv('ROLLUP_RESULTS_LIMIT', '10'))
+LOW_STOCK_THRESHOLD = float(os.getenv('LOW_STOCK_THRESHOLD', '1'))
+# История: сколько последних изменений артикула показывать в /history и строк изменений в /changes
+HISTORY_LIMIT = int(os.getenv('HISTORY_LIMIT', '20'))
+CHANGES_LIMIT = int(os.getenv('CHANGES_LIMIT', '50'))
+# Обработка обновлений Telegram: число рабочих потоков и длина очереди каждого из них.
+# Сообщения одного чата всегда попадают в один поток и обрабатываются по порядку
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', '16'))
+BOT_QUEUE_SIZE = int(os.getenv('BOT_QUEUE_SIZE', '100'))
+# По скольким последним обновлениям считать задержку в /stats
+LATENCY_SAMPLES = 1000
+# Получение обновлений: 'polling' (long polling) или 'webhook' (Telegram сам присылает обновления
+# на WEBHOOK_URL, их принимает локальный HTTP-сервер на WEBHOOK_LISTEN:WEBHOOK_PORT)
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# Пауза между запросами getUpdates и сколько секунд Telegram держит запрос, ожидая обновлений
+POLL_INTERVAL = float(os.getenv('POLL_INTERVAL', '0'))
+POLL_TIMEOUT = int(os.getenv('POLL_TIMEOUT', '50'))
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+# Доступ: файл со списком разрешённых пользователей (по id в строке, # — комментарий) вместо
+# встроенного ALLOWED_USERS и как часто перечитывать его и таблицу allowed_users (секунды)
+ALLOWED_USERS_FILE = os.getenv('ALLOWED_USERS_FILE')
+ACCESS_RELOAD_INTERVAL = int(os.getenv('ACCESS_RELOAD_INTERVAL', '30'))
+# Ограничение частоты запросов одного пользователя: RATE_LIMIT_BURST подряд, дальше RATE_LIMIT_PER_MINUTE в минуту
+RATE_LIMIT_PER_MINUTE = float(os.getenv('RATE_LIMIT_PER_MINUTE', '30'))
+RATE_LIMIT_BURST = int(os.getenv('RATE_LIMIT_BURST', '10'))
+# Исходящие сообщения (ограничения Telegram Bot API): в один личный чат не чаще раза в SEND_CHAT_INTERVAL
+# секунд, в группу — раз в SEND_GROUP_INTERVAL, всем чатам вместе не больше SEND_GLOBAL_RATE в секунду.
+# Отправляют SEND_WORKERS фоновых потоков, сетевые ошибки повторяются до SEND_RETRIES раз
+SEND_CHAT_INTERVAL = float(os.getenv('SEND_CHAT_INTERVAL', '1'))
+SEND_GROUP_INTERVAL = float(os.getenv('SEND_GROUP_INTERVAL', '3'))
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', '30'))
+SEND_WORKERS = int(os.getenv('SEND_WORKERS', '4'))
+SEND_RETRIES = int(os.getenv('SEND_RETRIES', '5'))
+# Адрес Bot API вида http://host:port/bot{0}/{1}: локальный сервер telegram-bot-api или тестовая замена
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+# Порт HTTP-эндпоинта /metrics в формате Prometheus (не задан — эндпоинт выключен)
+METRICS_PORT = os.getenv('METRICS_PORT')
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
 
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_article_clean ON products (article_clean)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_warehouse ON products (warehouse)')
+# Пользователи, которым разрешён доступ к боту, если не задан ALLOWED_USERS_FILE
+ALLOWED_USERS = {
+    7513623853, 291591740, 308980455, 880161173, 7812414563, 459890220, 972172071, 747358781, 1654230, 7965375521, 7408230278, 262440194, 431233023, 913802510, 213653502, 293959414, 7426490187, 6577259391, 7825850418, 597558526
+}
 
-            conn.commit()
-            conn.close()
+# Все запросы TeleBot идут на этот адрес, в том числе из потоков отправки SendQueue
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL
 
-    def update_from_excel(self, excel_file):
-        """Обновление базы данных из Excel файла с новой структурой"""
-        if not os.path.exists(excel_file):
-            logger.error(f"Файл {excel_file} не найден.")
-            return False
+# Менеджер базы данных: соединения и снимок открываются при запуске бота (db_manager.open())
+db_manager = DatabaseManager(DB_FILE, read_pool_size=DB_READ_POOL_SIZE)
+
+
+def update_chat_id(update):
+    """Чат, к которому относится обновление; без чата — номер самого обновления"""
+    for name in ('message', 'edited_message', 'channel_post', 'edited_channel_post', 'callback_query'):
+        item = getattr(update, name, None)
+        if item is None:
+            continue
+        chat = getattr(getattr(item, 'message', item), 'chat', None)
+        if chat is not None:
+            return chat.id
+    return update.update_id
+
+
+def update_user_id(update):
+    """Пользователь, от которого пришло обновление; None для обновлений без отправителя"""
+    for name in ('message', 'edited_message', 'callback_query'):
+        item = getattr(update, name, None)
+        user = getattr(item, 'from_user', None)
+        if user is not None:
+            return user.id
+    return None
+
+
+class AccessControl:
+    """Кто может пользоваться ботом и как часто.
 
+    Список доступа — ALLOWED_USERS (или файл ALLOWED_USERS_FILE) плюс таблица allowed_users;
+    перечитывается не чаще раза в reload_interval секунд, поэтому пользователей можно добавлять
+    без перезапуска бота. У каждого пользователя своё ведро токенов: burst запросов подряд,
+    дальше per_minute в минуту. Обновления от посторонних и сверх лимита отбрасываются молча,
+    до очереди обработчиков.
+    """
+
+    def __init__(self, db_manager, default_users=ALLOWED_USERS, users_file=ALLOWED_USERS_FILE,
+                 reload_interval=ACCESS_RELOAD_INTERVAL, per_minute=RATE_LIMIT_PER_MINUTE, burst=RATE_LIMIT_BURST):
+        self.db_manager = db_manager
+        self.default_users = frozenset(default_users)
+        self.users_file = users_file
+        self.reload_interval = reload_interval
+        self.per_minute = per_minute
+        self.burst = burst
+        self.users = self.default_users
+        self._reloaded = None
+        self._reload_lock = Lock()
+        self._lock = Lock()
+        self._buckets = {}
+        self._reported = set()
+        self.denied = 0
+        self.limited = 0
+
+    def _read_users_file(self):
+        users = set()
+        with open(self.users_file, encoding='utf-8') as f:
+            for line in f:
+                line = line.partition('#')[0].strip()
+                if line:
+                    users.add(int(line))
+        return users
+
+    def reload(self):
+        """Перечитывает список доступа; при ошибке источника остаётся прежний список"""
+        self._reloaded = time.monotonic()
         try:
-            logger.info(f"📂 Загружаю Excel-файл {excel_file}...")
-            df = pd.read_excel(excel_file)
-            df = df.where(pd.notnull(df), None)
-
-            # Нормализация артикулов
-            df['article_clean'] = df['Артикул'].apply(lambda x: re.sub(r'[^\d]', '', str(x)))
-
-            with db_lock:
-                conn = sqlite3.connect(self.db_file)
-                cursor = conn.cursor()
-
-                cursor.execute('DELETE FROM products')
-
-                for _, row in df.iterrows():
-                    cursor.execute('''
-                        INSERT INTO products (
-                            period, article, article_clean, name, code,
-                            warehouse, quantity, price, currency, price_date, last_updated
-                        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    ''', (
-                        row.get('Период'),
-                        row.get('Артикул'),
-                        row['article_clean'],
-                        row.get('Номенклатура'),
-                        row.get('Номенклатура.Код'),
-                        row.get('Склад'),
-                        row.get('Остаток'),
-                        row.get('Цена'),
-                        row.get('Валюта'),
-                        row.get('Дата установки цены'),
-                        datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    ))
-
-                conn.commit()
-                conn.close()
-
-            logger.info(f"✅ База данных успешно обновлена. Записей: {len(df)}")
-            return True
+            users = self._read_users_file() if self.users_file else set(self.default_users)
+            users = frozenset(users | self.db_manager.allowed_users())
         except Exception as e:
-            logger.error(f"Ошибка при обновлении базы данных: {e}")
-            return False
+            logger.error(f"Ошибка при загрузке списка доступа: {e}")
+            return
+        if users != self.users:
+            logger.info(f"Список доступа обновлён: пользователей {len(users)}")
+        with self._lock:
+            self.users = users
+            # Вёдра удалённых из списка пользователей больше не нужны
+            self._buckets = {user_id: bucket for user_id, bucket in self._buckets.items() if user_id in users}
+            self._reported.clear()
+
+    def _reload_if_due(self):
+        if self._reloaded is not None and time.monotonic() - self._reloaded < self.reload_interval:
+            return
+        # Перечитывает один поток, остальные тем временем проверяют по прежнему списку
+        if self._reload_lock.acquire(blocking=self._reloaded is None):
+            try:
+                if self._reloaded is None or time.monotonic() - self._reloaded >= self.reload_interval:
+                    self.reload()
+            finally:
+                self._reload_lock.release()
+
+    def check(self, user_id):
+        """allowed, denied (нет в списке доступа) или limited (превышен лимит запросов)"""
+        self._reload_if_due()
+        now = time.monotonic()
+        with self._lock:
+            if user_id not in self.users:
+                result = 'denied'
+                self.denied += 1
+            else:
+                tokens, updated = self._buckets.get(user_id, (self.burst, now))
+                tokens = min(self.burst, tokens + (now - updated) * self.per_minute / 60)
+                if tokens >= 1:
+                    result = 'allowed'
+                    tokens -= 1
+                else:
+                    result = 'limited'
+                    self.limited += 1
+                self._buckets[user_id] = (tokens, now)
+            # О каждом отброшенном пользователе пишем в лог один раз до следующей перезагрузки списка
+            report = result != 'allowed' and user_id not in self._reported
+            if report:
+                self._reported.add(user_id)
+        METRICS.inc('access_checks', result=result)
+        if report:
+            if result == 'denied':
+                logger.warning(f"Обновления от пользователя {user_id} отброшены: его нет в списке доступа")
+            else:
+                logger.warning(f"Обновления от пользователя {user_id} отброшены: превышен лимит запросов")
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {'users': len(self.users), 'denied': self.denied, 'limited': self.limited}
+
+
+class ChatDispatcher:
+    """Пул потоков для обработки обновлений: разные чаты параллельно, один чат — строго по порядку"""
+
+    def __init__(self, process, workers=BOT_WORKERS, queue_size=BOT_QUEUE_SIZE):
+        self.process = process
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._lock = Lock()
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self._waits = deque(maxlen=LATENCY_SAMPLES)
+        self.busy = 0
+        self.processed = 0
+        self.errors = 0
+        self._started = False
+
+    def start(self):
+        """Запускает рабочие потоки (один раз; вызывается при первом обновлении)"""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        for number, updates in enumerate(self.queues):
+            Thread(target=self._work, args=(updates,), name=f"bot-worker-{number}", daemon=True).start()
+
+    def submit(self, update):
+        """Ставит обновление в очередь потока его чата; при переполнении очереди ждёт (обратное давление на polling)"""
+        if not self._started:
+            self.start()
+        chat_id = update_chat_id(update)
+        self.queues[hash(chat_id) % len(self.queues)].put((time.perf_counter(), update))
+
+    def _work(self, updates):
+        while True:
+            received, update = updates.get()
+            started = time.perf_counter()
+            with self._lock:
+                self.busy += 1
+            failed = False
+            try:
+                self.process([update])
+            except Exception as e:
+                failed = True
+                logger.error(f"Ошибка при обработке обновления {update.update_id}: {e}")
+            finally:
+                finished = time.perf_counter()
+                with self._lock:
+                    self.busy -= 1
+                    self.processed += 1
+                    self.errors += failed
+                    self._waits.append(started - received)
+                    self._latencies.append(finished - received)
+                METRICS.observe('update_queue_wait', started - received)
+                METRICS.observe('update', finished - received)
+
+    def stats(self):
+        """Глубина очередей и задержки (секунды от получения обновления до конца обработки)"""
+        with self._lock:
+            latencies = sorted(self._latencies)
+            waits = sorted(self._waits)
+            busy, processed, errors = self.busy, self.processed, self.errors
+        return {
+            'workers': len(self.queues),
+            'queued': sum(updates.qsize() for updates in self.queues),
+            'max_queue': max(updates.qsize() for updates in self.queues),
+            'busy': busy,
+            'processed': processed,
+            'errors': errors,
+            'latency_p50': percentile(latencies, 0.5),
+            'latency_p95': percentile(latencies, 0.95),
+            'latency_max': latencies[-1] if latencies else 0.0,
+            'wait_p95': percentile(waits, 0.95),
+        }
+
+
+class SendQueue:
+    """Очередь исходящих сообщений: обработчик только ставит сообщение в очередь, отправляют фоновые потоки.
+
+    Сообщения одного чата уходят по порядку и не чаще, чем позволяет Telegram (chat_interval, для групп
+    group_interval), всех чатов вместе — не больше global_rate в секунду. Накопившиеся за это время
+    тексты одному чату с одинаковыми параметрами склеиваются в одно сообщение до TELEGRAM_MESSAGE_LIMIT
+    символов, а «печатает...» перед уже готовым сообщением не отправляется. На ответ 429 чат
+    откладывается на retry_after из ответа Telegram; сетевые ошибки и ошибки сервера повторяются
+    до retries раз, остальные ошибки API (бот заблокирован, неверный запрос) отбрасывают сообщение.
+    """
+
+    def __init__(self, send, workers=SEND_WORKERS, chat_interval=SEND_CHAT_INTERVAL,
+                 group_interval=SEND_GROUP_INTERVAL, global_rate=SEND_GLOBAL_RATE, retries=SEND_RETRIES):
+        self.send = send
+        self.workers = workers
+        self.chat_interval = chat_interval
+        self.group_interval = group_interval
+        self.global_rate = global_rate
+        self.retries = retries
+        self._condition = Condition()
+        self._pending = {}
+        self._ready = []
+        self._next_send = {}
+        self._next_global = 0.0
+        self._order = 0
+        self._started = False
+        self.sent = 0
+        self.coalesced = 0
+        self.flood_waits = 0
+        self.retried = 0
+        self.dropped = 0
+
+    def start(self):
+        """Запускает потоки отправки (один раз; вызывается при первом сообщении)"""
+        with self._condition:
+            if self._started:
+                return
+            self._started = True
+        for number in range(self.workers):
+            Thread(target=self._work, name=f"bot-sender-{number}", daemon=True).start()
+
+    def put(self, method, chat_id, payload, kwargs):
+        """Ставит в очередь вызов method (sendMessage, sendDocument, sendChatAction) для чата chat_id"""
+        if not self._started:
+            self.start()
+        with self._condition:
+            pending = self._pending.get(chat_id)
+            if pending is None:
+                # У чата нет ни ожидающих, ни отправляемых сообщений: ставим его в расписание
+                pending = self._pending[chat_id] = deque()
+                self._schedule(chat_id, self._next_send.get(chat_id, 0.0))
+            pending.append([method, payload, kwargs, 0])
+            self._condition.notify()
+
+    def _schedule(self, chat_id, ready_at):
+        self._order += 1
+        heapq.heappush(self._ready, (ready_at, self._order, chat_id))
+
+    def _take(self, pending):
+        """Следующая отправка чата: подряд идущие тексты склеиваются, «печатает...» перед сообщением пропускается"""
+        item = pending.popleft()
+        while item[0] == 'sendChatAction' and pending:
+            item = pending.popleft()
+        if item[0] == 'sendMessage':
+            while (pending and pending[0][0] == 'sendMessage' and pending[0][2] == item[2]
+                   and len(item[1]) + 2 + len(pending[0][1]) <= TELEGRAM_MESSAGE_LIMIT):
+                item = [item[0], f"{item[1]}\n\n{pending.popleft()[1]}", item[2], item[3]]
+                self.coalesced += 1
+        return item
+
+    def _next(self):
+        """Ждёт чат, которому уже можно отправлять, и забирает его следующую отправку"""
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                if self._ready:
+                    ready_at = max(self._ready[0][0], self._next_global)
+                    if ready_at <= now:
+                        _, _, chat_id = heapq.heappop(self._ready)
+                        self._next_global = max(now, self._next_global) + 1 / self.global_rate
+                        return chat_id, self._take(self._pending[chat_id])
+                    self._condition.wait(ready_at - now)
+                else:
+                    self._condition.wait()
+
+    def _work(self):
+        while True:
+            chat_id, item = self._next()
+            method = item[0]
+            delay = self._deliver(chat_id, item)
+            with self._condition:
+                now = time.monotonic()
+                if delay is not None:
+                    # Не отправилось, но стоит повторить: сообщение возвращается в начало очереди чата
+                    self._pending[chat_id].appendleft(item)
+                    self._next_send[chat_id] = now + delay
+                elif method != 'sendChatAction':
+                    # «печатает...» не сообщение и на интервал между сообщениями чата не влияет
+                    group = isinstance(chat_id, int) and chat_id < 0
+                    self._next_send[chat_id] = now + (self.group_interval if group else self.chat_interval)
+                if self._pending[chat_id]:
+                    self._schedule(chat_id, self._next_send.get(chat_id, now))
+                    self._condition.notify()
+                else:
+                    del self._pending[chat_id]
+
+    def _deliver(self, chat_id, item):
+        """Отправляет item; возвращает паузу перед повтором или None, если повторять не нужно"""
+        method, payload, kwargs, attempts = item
+        if hasattr(payload, 'seek'):
+            payload.seek(0)
+        try:
+            self.send(method, chat_id, payload, kwargs)
+            with self._condition:
+                self.sent += 1
+            return None
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code == 429:
+                retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+                with self._condition:
+                    self.flood_waits += 1
+                METRICS.inc('telegram_flood_waits')
+                logger.warning(f"Telegram ограничил отправку в чат {chat_id}: повтор через {retry_after} с")
+                return retry_after
+            if e.error_code < 500:
+                logger.error(f"Сообщение в чат {chat_id} не отправлено: {e}")
+                with self._condition:
+                    self.dropped += 1
+                return None
+            error = e
+        except Exception as e:
+            error = e
+        item[3] = attempts = attempts + 1
+        if attempts > self.retries:
+            logger.error(f"Сообщение в чат {chat_id} не отправлено после {attempts} попыток: {error}")
+            with self._condition:
+                self.dropped += 1
+            return None
+        with self._condition:
+            self.retried += 1
+        logger.warning(f"Ошибка отправки в чат {chat_id} (попытка {attempts}): {error}")
+        return min(2 ** attempts, 60)
+
+    def stats(self):
+        with self._condition:
+            return {
+                'queued': sum(len(pending) for pending in self._pending.values()),
+                'chats': len(self._pending),
+                'sent': self.sent,
+                'coalesced': self.coalesced,
+                'flood_waits': self.flood_waits,
+                'retried': self.retried,
+                'dropped': self.dropped,
+            }
+
 
-    def search_products(self, article_clean):
-        """Поиск продуктов по артикулу"""
-        with db_lock:
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
+class DispatchingTeleBot(telebot.TeleBot):
+    """TeleBot, который отдаёт полученные обновления в ChatDispatcher вместо обработки в потоке опроса"""
+    dispatcher = None
+    access = None
 
-            cursor.execute('''
-                SELECT * FROM products 
-                WHERE article_clean = ?
-                ORDER BY warehouse, period DESC
-            ''', (article_clean,))
+    def process_new_updates(self, updates):
+        # Смещение опроса сдвигаем сразу: иначе, пока рабочий поток не дошёл до обновления,
+        # следующий getUpdates вернёт его повторно и ответ уйдёт дважды. Смещение учитывает и
+        # отброшенные ниже обновления, иначе Telegram присылал бы их снова и снова
+        if updates:
+            self.last_update_id = max(self.last_update_id, max(update.update_id for update in updates))
+        # Посторонние и слишком частые обновления отбрасываются окончательно: они не занимают
+        # ни очередь, ни базу, ни Telegram API
+        if self.access is not None:
+            updates = [update for update in updates if self.access.check(update_user_id(update)) == 'allowed']
+        if self.dispatcher is None:
+            return super().process_new_updates(updates)
+        for update in updates:
+            self.dispatcher.submit(update)
 
-            columns = [column[0] for column in cursor.description]
-            results = [dict(zip(columns, row)) for row in cursor.fetchall()]
+    def process_updates_now(self, updates):
+        """Обработка в текущем потоке: вызывается рабочими потоками диспетчера"""
+        super().process_new_updates(updates)
 
-            conn.close()
-            return results
+    # Отправка из обработчиков: при заданной очереди outbox сообщение только ставится в очередь,
+    # и поток обработчика сразу освобождается; сами запросы замеряются отдельно от поиска
+    outbox = None
+    SEND_METHODS = {
+        'sendMessage': telebot.TeleBot.send_message,
+        'sendDocument': telebot.TeleBot.send_document,
+        'sendChatAction': telebot.TeleBot.send_chat_action,
+    }
 
+    def send_now(self, method, chat_id, payload, kwargs):
+        """Отправка в текущем потоке: вызывается потоками SendQueue"""
+        with METRICS.span('telegram_send', method=method):
+            return self.SEND_METHODS[method](self, chat_id, payload, **kwargs)
 
-# Инициализация менеджера базы данных
-db_manager = DatabaseManager(DB_FILE)
+    def _send(self, method, chat_id, payload, kwargs):
+        if self.outbox is None:
+            return self.send_now(method, chat_id, payload, kwargs)
+        self.outbox.put(method, chat_id, payload, kwargs)
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self._send('sendMessage', chat_id, text, kwargs)
+
+    def send_document(self, chat_id, document, **kwargs):
+        return self._send('sendDocument', chat_id, document, kwargs)
+
+    def send_chat_action(self, chat_id, action, **kwargs):
+        return self._send('sendChatAction', chat_id, action, kwargs)
 
 
 class BotWrapper:
     def __init__(self, token):
         self.token = token
-        self.bot = telebot.TeleBot(token)
-        self._initialize_bot()
+        # Обработчики выполняются в потоках диспетчера, а не во встроенном пуле TeleBot
+        self.bot = DispatchingTeleBot(token, threaded=False)
+        self.bot.dispatcher = ChatDispatcher(self.bot.process_updates_now)
+        self.bot.access = AccessControl(db_manager)
+        self.bot.outbox = SendQueue(self.bot.send_now)
 
     def _initialize_bot(self):
         """Инициализация бота с обработкой ошибок"""
+        if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+            # Без адреса set_webhook снял бы вебхук, и обновления перестали бы приходить совсем
+            logger.error("Режим webhook требует WEBHOOK_URL")
+            return False
         try:
-            # Удаляем вебхук перед использованием polling
-            self.bot.delete_webhook()
-            time.sleep(1)
+            if BOT_MODE != 'webhook':
+                # Удаляем вебхук перед использованием polling
+                self.bot.delete_webhook()
             self.bot.get_me()
             logger.info("Бот успешно авторизован")
             return True
@@ -155,16 +532,66 @@ class BotWrapper:
             logger.error(f"Ошибка инициализации бота: {str(e)}")
             return False
 
-    def polling(self):
+    def polling(self, interval=POLL_INTERVAL):
         """Запуск бота с обработкой ошибок"""
         while True:
             try:
                 logger.info("Запуск бота...")
-                self.bot.polling(none_stop=True, interval=3, timeout=60)
+                # Long polling: ответ на getUpdates приходит сразу с новым обновлением,
+                # поэтому пауза между запросами только добавляет задержку
+                self.bot.polling(none_stop=True, interval=interval, timeout=POLL_TIMEOUT + 10,
+                                 long_polling_timeout=POLL_TIMEOUT)
             except Exception as e:
                 logger.error(f"Ошибка в работе бота: {e}")
                 time.sleep(10)
 
+    def webhook_server(self, listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, path=None, secret=WEBHOOK_SECRET):
+        """HTTP-сервер, принимающий обновления от Telegram и передающий их диспетчеру"""
+        bot = self.bot
+        path = path or urlparse(WEBHOOK_URL or '').path or '/'
+
+        class WebhookHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != path or (secret and self.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret):
+                    self.send_response(403)
+                    self.end_headers()
+                    return
+                try:
+                    body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                    update = telebot.types.Update.de_json(json.loads(body))
+                    if update is None:
+                        raise ValueError("пустое обновление")
+                except (ValueError, KeyError, TypeError) as e:
+                    # JSON без обязательных полей (например, update_id) — тоже некорректное обновление:
+                    # отвечаем 400, а не роняем поток запроса без ответа
+                    logger.warning(f"Некорректное обновление от Telegram: {e!r}")
+                    self.send_response(400)
+                    self.end_headers()
+                    return
+                # Отвечаем Telegram сразу: обработка идёт в потоках диспетчера
+                bot.process_new_updates([update])
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logger.debug(f"Webhook: {format % args}")
+
+        return ThreadingHTTPServer((listen, port), WebhookHandler)
+
+    def webhook(self):
+        """Запуск бота в режиме вебхука"""
+        server = self.webhook_server()
+        self.bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+        logger.info(f"Вебхук {WEBHOOK_URL} установлен, принимаю обновления на {WEBHOOK_LISTEN}:{WEBHOOK_PORT}")
+        server.serve_forever()
+
+    def run(self):
+        if BOT_MODE == 'webhook':
+            self.webhook()
+        else:
+            self.polling()
+
 
 # Создаем экземпляр бота
 bot_wrapper = BotWrapper(TELEGRAM_TOKEN)
@@ -185,34 +612,401 @@ def format_product_info(product):
     )
 
 
-ALLOWED_USERS = {
-    7513623853, 291591740, 308980455, 880161173, 7812414563, 459890220, 972172071, 747358781, 1654230, 7965375521, 7408230278, 262440194, 431233023, 913802510, 213653502, 293959414, 7426490187, 6577259391, 7825850418, 597558526
-}
-
-
 @bot.message_handler(commands=['start', 'help'])
 def handle_start_help(message):
-    if message.from_user.id not in ALLOWED_USERS:
-        bot.send_message(message.chat.id, "доступ запрещен")
-        return
     help_text = (
         "🔍 *Бот для поиска товаров по артикулу*\n\n"
         "Отправьте мне артикул товара — и я найду его в базе.\n"
         "Примеры:\n"
         "`805015`\n"
-        "`где 805015 и 805017`\n"
+        "`где 805015 и 805017`\n\n"
+        "Если артикул записан неточно, поищите похожие:\n"
+        "`/find 805-01`\n\n"
+        "Поиск по наименованию:\n"
+        "`/name кольцо уплотнительное`\n\n"
+        "История остатков и цен артикула, в том числе на дату:\n"
+        "`/history 805015`\n"
+        "`/history 805015 01.06.2025`\n\n"
+        "Что изменилось со вчерашнего дня или с даты:\n"
+        "`/changes`\n"
+        "`/changes 01.06.2025`\n\n"
+        "Итоги по остаткам:\n"
+        "`/total 805015` — остаток артикула на всех складах\n"
+        "`/top 10` — артикулы с наибольшей стоимостью остатка\n"
+        "`/low 1` — артикулы с малым остатком\n"
+        "`/warehouse` — склады, `/warehouse магадан` — остатки склада\n"
     )
     bot.send_message(message.chat.id, help_text, parse_mode='Markdown')
 
 
+@bot.message_handler(commands=['find'])
+def handle_find(message):
+    try:
+        query = message.text.partition(' ')[2].strip()
+        if not query:
+            bot.send_message(message.chat.id, "Укажите артикул или его часть, например: /find 805-01")
+            return
+
+        with METRICS.span('lookup', kind='fuzzy'):
+            suggestions = db_manager.snapshot.suggest(query, limit=FUZZY_RESULTS_LIMIT)
+        if not suggestions:
+            bot.send_message(message.chat.id, f"❌ Похожих на {query} артикулов не найдено.")
+            return
+        bot.send_message(message.chat.id, f"🔎 Похожие артикулы:\n{format_suggestions(suggestions)}")
+    except Exception as e:
+        logger.error(f"Ошибка при нечётком поиске: {e}")
+        bot.send_message(message.chat.id, "⚠️ Ошибка при обработке запроса.")
+
+
+@bot.message_handler(commands=['name'])
+def handle_name(message):
+    try:
+        query = message.text.partition(' ')[2].strip()
+        if not query:
+            bot.send_message(message.chat.id, "Укажите наименование, например: /name кольцо уплотнительное")
+            return
+        if not reply_name_search(message.chat.id, query):
+            bot.send_message(message.chat.id, f"❌ По наименованию «{query}» ничего не найдено.")
+    except Exception as e:
+        logger.error(f"Ошибка при поиске по наименованию: {e}")
+        bot.send_message(message.chat.id, "⚠️ Ошибка при обработке запроса.")
+
+
+def parse_day(text):
+    """Дата из команды: ДД.ММ.ГГГГ или ГГГГ-ММ-ДД; None, если это не дата"""
+    for date_format in ('%d.%m.%Y', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(text, date_format)
+        except ValueError:
+            pass
+    return None
+
+
+def format_price(price, currency):
+    return f"{price if price is not None else '—'} {currency or ''}".strip()
+
+
+def format_stock_value(quantity, price, currency):
+    return f"{quantity if quantity is not None else '—'} | 💰 {format_price(price, currency)}"
+
+
+@bot.message_handler(commands=['history'])
+def handle_history(message):
+    try:
+        query = message.text.partition(' ')[2].strip()
+        article, _, last = query.rpartition(' ')
+        day = parse_day(last)
+        if day is None:
+            article = query
+        if not article:
+            bot.send_message(message.chat.id, "Укажите артикул и, если нужно, дату, например: /history 805015 01.06.2025")
+            return
+
+        with METRICS.span('lookup', kind='history'):
+            if day is not None:
+                rows = stock_at(db_manager, article_key(article), f"{day:%Y-%m-%d} 23:59:59")
+            else:
+                rows = article_history(db_manager, article_key(article), HISTORY_LIMIT)
+        if not rows:
+            when = f" на {day:%d.%m.%Y}" if day is not None else ''
+            bot.send_message(message.chat.id, f"❌ Истории артикула {article}{when} не найдено.")
+            return
+
+        if day is not None:
+            blocks = [f"📦 Артикул {article} на {day:%d.%m.%Y}:"] + [
+                f"🏭 {row['warehouse'] or '—'}: {format_stock_value(row['quantity'], row['price'], row['currency'])}"
+                for row in rows
+            ]
+        else:
+            blocks = [f"📦 Последние изменения артикула {article}:"] + [
+                f"🕒 {row['valid_from']} — {row['valid_to'] or 'сейчас'}\n"
+                f"🏭 {row['warehouse'] or '—'}: {format_stock_value(row['quantity'], row['price'], row['currency'])}"
+                for row in rows
+            ]
+        for text in pack_messages(['\n'.join(blocks)]):
+            bot.send_message(message.chat.id, text)
+    except Exception as e:
+        logger.error(f"Ошибка при запросе истории: {e}")
+        bot.send_message(message.chat.id, "⚠️ Ошибка при обработке запроса.")
+
+
+def format_change(row):
+    """Строка /changes: появилась, исчезла или изменилась позиция на складе"""
+    place = f"{row['article'] or '—'} ({row['code'] or '—'}, {row['warehouse'] or '—'})"
+    if row['old_id'] is None:
+        return f"➕ {place}: {format_stock_value(row['new_quantity'], row['new_price'], row['new_currency'])}"
+    if row['new_id'] is None:
+        return f"➖ {place}: было {format_stock_value(row['old_quantity'], row['old_price'], row['old_currency'])}"
+    changes = []
+    if row['old_quantity'] != row['new_quantity']:
+        changes.append(f"остаток {row['old_quantity'] if row['old_quantity'] is not None else '—'} → "
+                       f"{row['new_quantity'] if row['new_quantity'] is not None else '—'}")
+    if row['old_price'] != row['new_price'] or row['old_currency'] != row['new_currency']:
+        changes.append(
+            f"цена {format_price(row['old_price'], row['old_currency'])} → {format_price(row['new_price'], row['new_currency'])}"
+        )
+    if row['old_price_date'] != row['new_price_date']:
+        changes.append(f"дата цены {row['old_price_date'] or '—'} → {row['new_price_date'] or '—'}")
+    return f"✏️ {place}: {', '.join(changes)}"
+
+
+@bot.message_handler(commands=['changes'])
+def handle_changes(message):
+    try:
+        query = message.text.partition(' ')[2].strip()
+        day = parse_day(query) if query else None
+        if query and day is None:
+            bot.send_message(message.chat.id, "Укажите дату в виде ДД.ММ.ГГГГ, например: /changes 01.06.2025")
+            return
+        since = day or datetime.now() - timedelta(days=1)
+
+        with METRICS.span('lookup', kind='changes'):
+            # Раньше начала истории сравнивать не с чем: считаем изменения от её начала
+            started = history_started(db_manager)
+            if started is None:
+                bot.send_message(message.chat.id, "История остатков пока пуста.")
+                return
+            started = datetime.strptime(started, '%Y-%m-%d %H:%M:%S')
+            since = max(since, started)
+            rows = changes_since(db_manager, f"{since:%Y-%m-%d %H:%M:%S}")
+        if not rows:
+            bot.send_message(message.chat.id, f"Изменений с {since:%d.%m.%Y %H:%M} нет.")
+            return
+
+        added = sum(1 for row in rows if row['old_id'] is None)
+        removed = sum(1 for row in rows if row['new_id'] is None)
+        lines = [
+            f"📋 Изменения с {since:%d.%m.%Y %H:%M}: появилось {added}, исчезло {removed}, "
+            f"изменилось {len(rows) - added - removed}"
+        ] + [format_change(row) for row in rows[:CHANGES_LIMIT]]
+        if len(rows) > CHANGES_LIMIT:
+            lines.append(f"… и ещё {len(rows) - CHANGES_LIMIT}")
+        for text in pack_messages(['\n'.join(lines)]):
+            bot.send_message(message.chat.id, text)
+    except Exception as e:
+        logger.error(f"Ошибка при запросе изменений: {e}")
+        bot.send_message(message.chat.id, "⚠️ Ошибка при обработке запроса.")
+
+
+def format_quantity(quantity):
+    return f"{quantity:g}" if quantity is not None else '—'
+
+
+def format_value(value, currency):
+    """Стоимость остатка; currency None у артикула с ценами в разных валютах"""
+    if value is None:
+        return '—'
+    return f"{value:,.2f}".replace(',', ' ') + f" {currency or '(разные валюты)'}"
+
+
+def command_number(message, default):
+    """Число после команды или default; None, если указано не число"""
+    text = message.text.partition(' ')[2].strip().replace(',', '.')
+    if not text:
+        return default
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+@bot.message_handler(commands=['total'])
+def handle_total(message):
+    try:
+        article = message.text.partition(' ')[2].strip()
+        if not article:
+            bot.send_message(message.chat.id, "Укажите артикул, например: /total 805015")
+            return
+        with METRICS.span('lookup', kind='total'):
+            total = article_total(db_manager, article_key(article))
+        if total is None:
+            bot.send_message(message.chat.id, f"❌ Артикул {article} не найден в базе.")
+            return
+        bot.send_message(
+            message.chat.id,
+            f"📦 {total['article']} — {total['name'] or '—'}\n"
+            f"📊 Всего: {format_quantity(total['total_quantity'])} на складах: {total['warehouses']}\n"
+            f"💰 Стоимость остатка: {format_value(total['stock_value'], total['currency'])}"
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при запросе итога по артикулу: {e}")
+        bot.send_message(message.chat.id, "⚠️ Ошибка при обработке запроса.")
+
+
+@bot.message_handler(commands=['top'])
+def handle_top(message):
+    try:
+        limit = command_number(message, ROLLUP_RESULTS_LIMIT)
+        if limit is None or limit < 1:
+            bot.send_message(message.chat.id, "Укажите число позиций, например: /top 10")
+            return
+        with METRICS.span('lookup', kind='top'):
+            rows = top_articles(db_manager, min(int(limit), 100))
+        if not rows:
+            bot.send_message(message.chat.id, "❌ Нет артикулов с известной ценой.")
+            return
+        lines = ["🏆 Наибольшая стоимость остатка:"] + [
+            f"{number}. {row['article']} — {row['name'] or '—'}: {format_value(row['stock_value'], row['currency'])} "
+            f"({format_quantity(row['total_quantity'])} шт.)"
+            for number, row in enumerate(rows, 1)
+        ]
+        for text in pack_messages(['\n'.join(lines)]):
+            bot.send_message(message.chat.id, text)
+    except Exception as e:
+        logger.error(f"Ошибка при запросе топа по стоимости: {e}")
+        bot.send_message(message.chat.id, "⚠️ Ошибка при обработке запроса.")
+
+
+@bot.message_handler(commands=['low'])
+def handle_low(message):
+    try:
+        threshold = command_number(message, LOW_STOCK_THRESHOLD)
+        if threshold is None:
+            bot.send_message(message.chat.id, "Укажите порог остатка, например: /low 1")
+            return
+        with METRICS.span('lookup', kind='low'):
+            rows = low_stock(db_manager, threshold, ROLLUP_RESULTS_LIMIT)
+        if not rows:
+            bot.send_message(message.chat.id, f"Артикулов с остатком не больше {threshold:g} нет.")
+            return
+        lines = [f"🔻 Остаток не больше {threshold:g} (первые {len(rows)}):"] + [
+            f"{row['article']} — {row['name'] or '—'}: {format_quantity(row['total_quantity'])}" for row in rows
+        ]
+        for text in pack_messages(['\n'.join(lines)]):
+            bot.send_message(message.chat.id, text)
+    except Exception as e:
+        logger.error(f"Ошибка при запросе малых остатков: {e}")
+        bot.send_message(message.chat.id, "⚠️ Ошибка при обработке запроса.")
+
+
+def format_warehouse_totals(warehouse, rows):
+    """Строка склада: позиции и остаток по всем валютам, стоимость по каждой валюте"""
+    positions = sum(row['positions'] for row in rows)
+    quantity = sum(row['total_quantity'] or 0 for row in rows)
+    values = ', '.join(
+        format_value(row['stock_value'], row['currency']) for row in rows if row['currency'] and row['stock_value']
+    )
+    return f"🏭 {warehouse or '—'}: позиций {positions}, остаток {format_quantity(quantity)}" + (
+        f", стоимость {values}" if values else ''
+    )
+
+
+@bot.message_handler(commands=['warehouse'])
+def handle_warehouse(message):
+    try:
+        query = message.text.partition(' ')[2].strip()
+        with METRICS.span('lookup', kind='warehouse'):
+            by_warehouse = {}
+            for row in warehouse_totals(db_manager):
+                by_warehouse.setdefault(row['warehouse'], []).append(row)
+            if not query:
+                lines = ["🏭 Склады:"] + [format_warehouse_totals(name, rows) for name, rows in by_warehouse.items()]
+                for text in pack_messages(['\n'.join(lines)]):
+                    bot.send_message(message.chat.id, text)
+                return
+
+            # Склад можно указать частью названия: «магадан» → «СКЛАД МАГАДАН»
+            matches = [name for name in by_warehouse if name.upper() == query.upper()]
+            matches = matches or [name for name in by_warehouse if query.upper() in name.upper()]
+            if len(matches) != 1:
+                found = '\n'.join(f"🔹 {name}" for name in matches)
+                bot.send_message(
+                    message.chat.id,
+                    f"Уточните склад:\n{found}" if matches else f"❌ Склад «{query}» не найден. Список складов: /warehouse"
+                )
+                return
+            warehouse = matches[0]
+            positions = warehouse_positions(db_manager, warehouse, ROLLUP_RESULTS_LIMIT)
+
+        lines = [format_warehouse_totals(warehouse, by_warehouse[warehouse]), '', "📊 Наибольшие остатки:"] + [
+            f"{row['article'] or '—'} — {row['name'] or '—'}: {format_quantity(row['quantity'])}" for row in positions
+        ]
+        for text in pack_messages(['\n'.join(lines)]):
+            bot.send_message(message.chat.id, text)
+    except Exception as e:
+        logger.error(f"Ошибка при запросе остатков склада: {e}")
+        bot.send_message(message.chat.id, "⚠️ Ошибка при обработке запроса.")
+
+
+def format_spans(spans):
+    """Строки сводки METRICS.summary() для /stats"""
+    lines = []
+    for span in spans:
+        labels = ','.join(str(value) for value in span['labels'].values())
+        name = f"{span['name']}[{labels}]" if labels else span['name']
+        lines.append(
+            f"{name}: {span['count']}, {span['p50'] * 1000:.1f} / {span['p95'] * 1000:.1f} / {span['max'] * 1000:.1f} мс"
+        )
+    return '\n'.join(lines) or '—'
+
+
+def collect_bot_metrics():
+    """Текущие значения очередей, пула соединений, снимка, кэша ответов, доступа и отправки для /metrics"""
+    stats = bot.dispatcher.stats()
+    pool = db_manager.pool.stats()
+    snapshot = db_manager.snapshot
+    cache = reply_cache.stats()
+    access = bot.access.stats()
+    outbox = bot.outbox.stats()
+    return [
+        ('dispatcher_queued', {}, stats['queued']),
+        ('dispatcher_busy', {}, stats['busy']),
+        ('dispatcher_workers', {}, stats['workers']),
+        ('db_readers', {'state': 'open'}, pool['readers']),
+        ('db_readers', {'state': 'idle'}, pool['readers_idle']),
+        ('db_reader_waits', {}, pool['reader_waited']),
+        ('snapshot_version', {}, snapshot.version),
+        ('snapshot_rows', {}, snapshot.size),
+        ('reply_cache_size', {}, cache['size']),
+        ('reply_cache_requests', {'result': 'hit'}, cache['hits']),
+        ('reply_cache_requests', {'result': 'miss'}, cache['misses']),
+        ('allowed_users', {}, access['users']),
+        ('outbox_queued', {}, outbox['queued']),
+        ('outbox_sends', {'result': 'sent'}, outbox['sent']),
+        ('outbox_sends', {'result': 'coalesced'}, outbox['coalesced']),
+        ('outbox_sends', {'result': 'retried'}, outbox['retried']),
+        ('outbox_sends', {'result': 'dropped'}, outbox['dropped']),
+    ]
+
+
+@bot.message_handler(commands=['stats'])
+def handle_stats(message):
+    try:
+        stats = bot.dispatcher.stats()
+        pool = db_manager.pool.stats()
+        snapshot = db_manager.snapshot
+        cache = reply_cache.stats()
+        access = bot.access.stats()
+        outbox = bot.outbox.stats()
+        bot.send_message(
+            message.chat.id,
+            f"📈 Обработчики: {stats['busy']}/{stats['workers']} заняты, в очереди {stats['queued']} "
+            f"(макс. на поток {stats['max_queue']})\n"
+            f"✅ Обработано: {stats['processed']}, ошибок: {stats['errors']}\n"
+            f"⏱ Задержка p50 {stats['latency_p50'] * 1000:.0f} мс, p95 {stats['latency_p95'] * 1000:.0f} мс, "
+            f"макс. {stats['latency_max'] * 1000:.0f} мс; ожидание в очереди p95 {stats['wait_p95'] * 1000:.0f} мс\n"
+            f"🔌 SQLite: чтение {pool['readers'] - pool['readers_idle']}/{pool['readers']} занято "
+            f"(макс. {pool['readers_max']}), выдано {pool['reader_acquired']}, ожиданий {pool['reader_waited']}; "
+            f"запись выдана {pool['writer_acquired']} раз, ожидание {pool['writer_wait']:.2f} с\n"
+            f"🗂 Данные: версия {snapshot.version}, строк {snapshot.size}, загружены {snapshot.loaded_at or '—'}\n"
+            f"💾 Кэш ответов: {cache['size']}/{cache['max_size']}, попаданий {cache['hits']}, промахов {cache['misses']}\n"
+            f"🔐 Доступ: пользователей {access['users']}, отброшено посторонних {access['denied']}, "
+            f"сверх лимита {access['limited']}\n"
+            f"📤 Отправка: в очереди {outbox['queued']} (чатов {outbox['chats']}), отправлено {outbox['sent']}, "
+            f"склеено {outbox['coalesced']}, ожиданий 429 {outbox['flood_waits']}, повторов {outbox['retried']}, "
+            f"потеряно {outbox['dropped']}\n\n"
+            f"⏱ Этапы (число, p50 / p95 / макс.):\n{format_spans(METRICS.summary())}"
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при запросе статистики: {e}")
+        bot.send_message(message.chat.id, "⚠️ Ошибка при обработке запроса.")
+
+
 @bot.message_handler(commands=['reload'])
 def handle_reload(message):
-    if message.from_user.id not in ALLOWED_USERS:
-        bot.send_message(message.chat.id, "доступ запрещен")
-        return
     try:
         bot.send_message(message.chat.id, "🔄 Перезагружаю базу данных...")
-        success = db_manager.update_from_excel(EXCEL_FILE)
+        success = db_manager.load_excel(EXCEL_FILE, force=True)
         if success:
             bot.send_message(message.chat.id, "✅ База данных успешно обновлена")
         else:
@@ -222,72 +1016,243 @@ def handle_reload(message):
         bot.send_message(message.chat.id, "⚠️ Ошибка при перезагрузке базы.")
 
 
+def format_suggestions(suggestions):
+    """Список похожих артикулов с наименованиями"""
+    return '\n'.join(f"🔹 {article} — {name or '—'}" for article, name in suggestions)
+
+
+def format_article_reply(article, products, loaded_at=None, suggestions=()):
+    """Текст ответа по одному артикулу: цена, наименование, остатки по складам и даты"""
+    if not products:
+        msg = f"❌ Артикул {article} не найден в базе."
+        if suggestions:
+            msg += f"\nВозможно, вы имели в виду:\n{format_suggestions(suggestions)}"
+        return msg
+
+    # Собираем уникальные даты установки цены
+    price_dates = set(p['price_date'] for p in products if p['price_date'])
+    price_dates_str = ', '.join(sorted(price_dates)) if price_dates else '—'
+    # Дата последнего обновления базы: время загрузки текущей версии данных,
+    # для старых баз — максимальная из last_updated
+    last_updated_list = [p['last_updated'] for p in products if p['last_updated']]
+    last_updated_str = loaded_at or (max(last_updated_list) if last_updated_list else '—')
+
+    # Информация об артикуле (берём из первой записи)
+    main = products[0]
+    msg = (
+        f"🔎 Артикул: {main['article'] or article}\n"
+        f"💰 Цена: {main['price'] or '—'} {main['currency'] or ''}\n"
+        f"🏷 Наименование: {main['name'] or '—'}\n"
+        f"🔢 Код: {main['code'] or '—'}\n"
+        f"\n"
+    )
+    # По каждому складу — только склад и остаток
+    for product in products:
+        msg += (
+            f"🏭 Склад: {product['warehouse'] or '—'}\n"
+            f"📊 Остаток: {product['quantity'] or '—'}\n"
+            f"\n"
+        )
+    msg += f"📅 Дата установки цены: {price_dates_str}\n🕒 Дата обновления базы: {last_updated_str}"
+    return msg
+
+
+def render_article_reply(snapshot, article):
+    """Ответ по артикулу из снимка; для ненайденного — с похожими артикулами"""
+    products = snapshot.find(article)
+    return format_article_reply(
+        article, products, snapshot.loaded_at,
+        suggestions=() if products else snapshot.suggest(article, limit=3)
+    )
+
+
+class ReplyCache:
+    """LRU-кэш готовых ответов по артикулу для текущей версии данных.
+
+    Смена версии снимка сбрасывает кэш; после каждой загрузки warm() заранее готовит ответы
+    для самых частых артикулов, чтобы первые запросы к новой версии тоже попадали в кэш.
+    """
+
+    def __init__(self, size=REPLY_CACHE_SIZE, warm_limit=REPLY_CACHE_WARM):
+        self.size = size
+        self.warm_limit = warm_limit
+        self.version = None
+        self._replies = OrderedDict()
+        self._popular = Counter()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _switch(self, version):
+        """Переходит на версию version; ответы старой версии больше не нужны"""
+        if self.version != version:
+            self.version = version
+            self._replies.clear()
+
+    def _store(self, version, article, text):
+        if self.version != version:
+            return
+        self._replies[article] = text
+        self._replies.move_to_end(article)
+        while len(self._replies) > self.size:
+            self._replies.popitem(last=False)
+
+    def reply(self, snapshot, article):
+        """Ответ по артикулу: из кэша или отформатированный заново и сохранённый"""
+        with self._lock:
+            self._popular[article] += 1
+            # Счётчик популярности не растёт бесконечно: оставляем самые частые артикулы
+            if len(self._popular) > 10 * self.size:
+                self._popular = Counter(dict(self._popular.most_common(self.size)))
+            # Обработчик, начавший работу со старым снимком, кэш не трогает
+            if self.version is None or snapshot.version > self.version:
+                self._switch(snapshot.version)
+            if snapshot.version == self.version:
+                text = self._replies.get(article)
+                if text is not None:
+                    self._replies.move_to_end(article)
+                    self.hits += 1
+                    return text
+            self.misses += 1
+        text = render_article_reply(snapshot, article)
+        with self._lock:
+            self._store(snapshot.version, article, text)
+        return text
+
+    def warm(self, snapshot):
+        """Сбрасывает кэш на версию снимка и готовит ответы для самых частых артикулов"""
+        with self._lock:
+            if self.version is not None and snapshot.version < self.version:
+                return
+            self._switch(snapshot.version)
+            popular = [article for article, _ in self._popular.most_common(self.warm_limit)]
+        replies = [(article, render_article_reply(snapshot, article)) for article in popular]
+        with self._lock:
+            for article, text in replies:
+                self._store(snapshot.version, article, text)
+        if replies:
+            logger.info(f"Кэш ответов подготовлен для {len(replies)} частых артикулов, версия {snapshot.version}")
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._replies), 'max_size': self.size, 'hits': self.hits, 'misses': self.misses}
+
+
+reply_cache = ReplyCache()
+db_manager.add_snapshot_listener(reply_cache.warm)
+
+
+def format_name_result(products):
+    """Краткий блок по позиции, найденной по наименованию: артикул, код, цена и остатки по складам"""
+    main = products[0]
+    msg = (
+        f"🏷 {main['name'] or '—'}\n"
+        f"📦 Артикул: {main['article'] or '—'} | 🔢 Код: {main['code'] or '—'}\n"
+        f"💰 Цена: {main['price'] or '—'} {main['currency'] or ''}\n"
+    )
+    for product in products:
+        msg += f"🏭 {product['warehouse'] or '—'}: {product['quantity'] or '—'}\n"
+    return msg.strip()
+
+
+def reply_name_search(chat_id, query):
+    """Отвечает результатами поиска по наименованию; возвращает False, если ничего не найдено"""
+    with METRICS.span('lookup', kind='name'):
+        results = db_manager.snapshot.search_names(query, limit=NAME_SEARCH_LIMIT)
+    if not results:
+        return False
+    blocks = [f"🔎 Найдено по наименованию «{query}»:"] + [format_name_result(products) for products in results]
+    for text in pack_messages(blocks):
+        bot.send_message(chat_id, text)
+    return True
+
+
+def pack_messages(blocks, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Собирает блоки текста в как можно меньшее число сообщений не длиннее limit"""
+    pieces = []
+    for block in blocks:
+        # Блок длиннее лимита режем по границам строк
+        while len(block) > limit:
+            cut = block.rfind('\n', 0, limit)
+            if cut <= 0:
+                cut = limit
+            pieces.append(block[:cut])
+            block = block[cut:].lstrip('\n')
+        pieces.append(block)
+
+    messages = []
+    for piece in pieces:
+        if messages and len(messages[-1]) + 2 + len(piece) <= limit:
+            messages[-1] += '\n\n' + piece
+        else:
+            messages.append(piece)
+    return messages
+
+
+def build_results_workbook(results):
+    """Excel-файл с результатами поиска по списку артикулов"""
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet('Остатки')
+    sheet.append(['Артикул', 'Наименование', 'Код', 'Склад', 'Остаток', 'Цена', 'Валюта', 'Дата установки цены'])
+    for article, products in results:
+        if not products:
+            sheet.append([article, 'не найден в базе'])
+        for product in products:
+            sheet.append([
+                article, product['name'], product['code'], product['warehouse'],
+                product['quantity'], product['price'], product['currency'], product['price_date'],
+            ])
+
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    buffer.seek(0)
+    buffer.name = 'ostatki.xlsx'
+    return buffer
+
+
 @bot.message_handler(func=lambda message: True)
 @bot.message_handler(func=lambda message: True)
 def handle_message(message):
-    if message.from_user.id not in ALLOWED_USERS:
-        bot.send_message(message.chat.id, "доступ запрещен")
-        return
     try:
         user_text = message.text
         logger.info(f"Запрос от {message.from_user.id}: {user_text}")
 
-        # Новый универсальный паттерн для артикулов: буквы, цифры, -, /, длина >= 4
-        article_pattern = r"[A-Za-zА-Яа-яЁё0-9][A-Za-zА-Яа-яЁё0-9\-/]{2,}[A-Za-zА-Яа-яЁё0-9]"
-        articles = re.findall(article_pattern, user_text)
-        articles = list(set(articles))  # Убираем дубли
-
-        # Фильтруем слишком короткие и неартикульные слова
-        articles = [a for a in articles if len(a) >= 4 and any(c.isdigit() for c in a)]
-
+        articles = extract_articles(user_text)
         if not articles:
-            bot.send_message(message.chat.id, "⛔️ Не найден артикул в сообщении.")
+            # Артикула нет — возможно, пользователь знает только наименование
+            if not reply_name_search(message.chat.id, user_text):
+                bot.send_message(message.chat.id, "⛔️ Не найден артикул в сообщении.")
             return
 
-        for article in articles:
-            logger.info(f"Найден артикул: {article}")
+        requested = len(articles)
+        articles = articles[:MAX_ARTICLES_PER_REQUEST]
+        logger.info(f"Найдены артикулы ({requested}): {articles[:20]}")
+
+        # Один снимок на всё сообщение, чтобы перезагрузка базы не разорвала ответ;
+        # все артикулы ищутся одним пакетом в памяти, без обращения к SQLite
+        snapshot = db_manager.snapshot
+        if len(articles) > ARTICLES_FILE_THRESHOLD:
+            with METRICS.span('lookup', kind='articles'):
+                results = snapshot.find_many(articles)
+            bot.send_chat_action(message.chat.id, 'upload_document')
+            found = sum(1 for _, products in results if products)
+            bot.send_document(
+                message.chat.id, build_results_workbook(results),
+                caption=f"📎 Найдено {found} из {len(articles)} артикулов\n🕒 Дата обновления базы: {snapshot.loaded_at or '—'}"
+            )
+        else:
             bot.send_chat_action(message.chat.id, 'typing')
-            # Поиск по article (точное совпадение)
-            with db_lock:
-                conn = sqlite3.connect(DB_FILE)
-                cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT * FROM products WHERE article = ? ORDER BY warehouse, period DESC
-                ''', (article,))
-                columns = [column[0] for column in cursor.description]
-                products = [dict(zip(columns, row)) for row in cursor.fetchall()]
-                conn.close()
-
-            if not products:
-                bot.send_message(message.chat.id, f"❌ Артикул {article} не найден в базе.")
-                continue
-
-            # Собираем уникальные даты установки цены
-            price_dates = set(p['price_date'] for p in products if p['price_date'])
-            price_dates_str = ', '.join(sorted(price_dates)) if price_dates else '—'
-            # Дата последнего обновления базы (берём максимальную из last_updated)
-            last_updated_list = [p['last_updated'] for p in products if p.get('last_updated')]
-            last_updated_str = max(last_updated_list) if last_updated_list else '—'
-
-            # Информация об артикуле (берём из первой записи)
-            main = products[0]
-            msg = (
-                f"🔎 Артикул: {article}\n"
-                f"💰 Цена: {main['price'] or '—'} {main['currency'] or ''}\n"
-                f"🏷 Наименование: {main['name'] or '—'}\n"
-                f"🔢 Код: {main['code'] or '—'}\n"
-                f"\n"
+            # Частые артикулы отвечаются из кэша без поиска и форматирования
+            with METRICS.span('lookup', kind='articles'):
+                blocks = [reply_cache.reply(snapshot, article) for article in articles]
+            for text in pack_messages(blocks):
+                bot.send_message(message.chat.id, text)
+
+        if requested > len(articles):
+            bot.send_message(
+                message.chat.id,
+                f"⚠️ Обработаны первые {len(articles)} артикулов из {requested}. Отправьте остальные отдельным сообщением."
             )
-            # По каждому складу — только склад и остаток
-            for product in products:
-                msg += (
-                    f"🏭 Склад: {product['warehouse'] or '—'}\n"
-                    f"📊 Остаток: {product['quantity'] or '—'}\n"
-                    f"\n"
-                )
-            bot.send_message(message.chat.id, msg.strip())
-            # Отдельным сообщением — дата установки цены и дата обновления базы
-            bot.send_message(message.chat.id, f"📅 Дата установки цены: {price_dates_str}\n🕒 Дата обновления базы: {last_updated_str}")
 
     except Exception as e:
         logger.error(f"Ошибка при обработке сообщения: {e}")
@@ -295,13 +1260,18 @@ def handle_message(message):
 
 
 if __name__ == "__main__":
+    if METRICS_PORT:
+        METRICS.add_collector(collect_bot_metrics)
+        METRICS.serve(METRICS_LISTEN, int(METRICS_PORT))
     if bot_wrapper._initialize_bot():
         # Первоначальная загрузка базы данных
+        db_manager.open()
+        # Если в базе уже то же содержимое выгрузки, Excel не разбирается и не загружается заново
+        db_manager.load_excel(EXCEL_FILE)
 
-        logger.info("База данных не найдена, создаем новую...")
-        db_manager.update_from_excel(EXCEL_FILE)
+        Thread(target=db_manager.watch_for_updates, args=(SNAPSHOT_CHECK_INTERVAL,), daemon=True).start()
 
         logger.info("✅ Бот запущен и ждёт запросы...")
-        bot_wrapper.polling()
+        bot_wrapper.run()
     else:
-        logger.error("❌ Бот не инициализирован. Проверьте токен.")
\ No newline at end of file
+        logger.error("❌ Бот не инициализирован. Проверьте токен и настройки режима.")
\ No newline at end of file
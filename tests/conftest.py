@@ -0,0 +1,50 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+from fake_telegram import FakeTelegram
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+
+@pytest.fixture(scope='session')
+def fake_telegram():
+    fake = FakeTelegram()
+    yield fake
+    fake.close()
+
+
+def import_in(workdir, name, **env):
+    """Импортирует модуль из src с настройками env; файлы логов, которые он открывает при импорте, — в workdir"""
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    os.environ.update(env)
+    try:
+        return importlib.import_module(name)
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture(scope='session')
+def bot_main(fake_telegram, tmp_path_factory):
+    """Модуль main, настроенный на fake_telegram; лог и база — во временном каталоге"""
+    workdir = tmp_path_factory.mktemp('bot')
+    return import_in(
+        workdir, 'main',
+        TELEGRAM_TOKEN='1:test', DB_FILE=str(workdir / 'products.db'), TELEGRAM_API_URL=fake_telegram.api_url,
+    )
+
+
+@pytest.fixture(scope='session')
+def mail_watcher(tmp_path_factory):
+    workdir = tmp_path_factory.mktemp('mail')
+    return import_in(workdir, 'mail_watcher', TARGET_SENDER='reports@example.com', DB_FILE=str(workdir / 'products.db'))
+
+
+@pytest.fixture
+def telegram(fake_telegram):
+    fake_telegram.reset()
+    return fake_telegram
@@ -0,0 +1,153 @@
+"""Замена IMAP-сервера для тестов: почтовый ящик в памяти и клиент с интерфейсом imaplib/imaplib2"""
+import base64
+import imaplib
+import re
+import time
+from email.header import Header
+from threading import Condition
+
+XLSX_TYPE = '"application" "vnd.openxmlformats-officedocument.spreadsheetml.sheet"'
+
+
+class FakeMailbox:
+    """Общий для всех соединений ящик: письма, UIDVALIDITY и журнал подключений"""
+
+    def __init__(self, capabilities=('IMAP4REV1', 'IDLE'), uidvalidity=777):
+        self.capabilities = tuple(capabilities)
+        self.uidvalidity = uidvalidity
+        self.messages = {}
+        self.connects = []
+        self.idle_calls = 0
+        self.fetched = []
+        self.fail_connects = 0
+        self.changed = Condition()
+        self._clients = []
+
+    def connect(self):
+        """Фабрика соединений для MailboxWatcher (imap_factory) и imaplib.IMAP4_SSL"""
+        with self.changed:
+            self.connects.append(time.monotonic())
+            self.changed.notify_all()
+            if self.fail_connects:
+                self.fail_connects -= 1
+                raise ConnectionRefusedError("сервер недоступен")
+            client = FakeIMAP(self)
+            self._clients.append(client)
+            return client
+
+    def deliver(self, sender, subject, attachment=None, filename='data.xlsx'):
+        """Кладёт письмо в ящик и будит соединения в IDLE; возвращает UID"""
+        with self.changed:
+            uid = max(self.messages, default=0) + 1
+            self.messages[uid] = (sender, subject, attachment, filename)
+            for client in self._clients:
+                client.exists = len(self.messages)
+            self.changed.notify_all()
+            return uid
+
+    def drop(self):
+        """Обрывает все открытые соединения"""
+        with self.changed:
+            for client in self._clients:
+                client.dropped = True
+            self._clients = []
+            self.changed.notify_all()
+
+    def wait_connects(self, count, timeout=10):
+        deadline = time.monotonic() + timeout
+        with self.changed:
+            while len(self.connects) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise AssertionError(f"подключений {len(self.connects)} вместо {count}")
+                self.changed.wait(remaining)
+            return list(self.connects)
+
+
+class FakeIMAP:
+    """Соединение с FakeMailbox; отвечает так же, как imaplib2.IMAP4_SSL на команды наблюдателя и загрузки"""
+
+    def __init__(self, mailbox):
+        self.mailbox = mailbox
+        self.capabilities = mailbox.capabilities
+        self.exists = None
+        self.dropped = False
+        self._woken = False
+
+    def _check(self):
+        if self.dropped:
+            raise imaplib.IMAP4.abort("соединение разорвано")
+
+    def login(self, user, password):
+        self._check()
+        return 'OK', [b'LOGIN completed']
+
+    def select(self, mailbox='INBOX'):
+        self._check()
+        return 'OK', [str(len(self.mailbox.messages)).encode()]
+
+    def idle(self, timeout=None):
+        """Ждёт EXISTS, NOOP из другого потока (так MailboxWatcher.stop прерывает IDLE) или обрыва"""
+        changed = self.mailbox.changed
+        deadline = time.monotonic() + (timeout or 60)
+        with changed:
+            self.mailbox.idle_calls += 1
+            while self.exists is None and not self._woken and not self.dropped:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                changed.wait(remaining)
+            self._woken = False
+        self._check()
+        return 'OK', [b'IDLE terminated']
+
+    def noop(self):
+        with self.mailbox.changed:
+            self._woken = True
+            self.mailbox.changed.notify_all()
+        self._check()
+        return 'OK', [b'NOOP completed']
+
+    def response(self, code):
+        if code == 'UIDVALIDITY':
+            return code, [str(self.mailbox.uidvalidity).encode()]
+        if code == 'EXISTS' and self.exists is not None:
+            exists, self.exists = self.exists, None
+            return code, [str(exists).encode()]
+        return code, [None]
+
+    def logout(self):
+        return 'BYE', [b'LOGOUT completed']
+
+    def uid(self, command, *args):
+        self._check()
+        command = command.upper()
+        if command == 'SEARCH':
+            return 'OK', [b' '.join(str(uid).encode() for uid in sorted(self.mailbox.messages))]
+        if command == 'STORE':
+            return 'OK', [None]
+        if command == 'FETCH':
+            uid, query = int(args[0]), args[1]
+            return 'OK', self._fetch(uid, query)
+        return 'NO', [b'unknown command']
+
+    def _fetch(self, uid, query):
+        sender, subject, attachment, filename = self.mailbox.messages[uid]
+        encoded = base64.encodebytes(attachment or b'')
+        prefix = f"{uid} (UID {uid}"
+        if 'HEADER.FIELDS' in query:
+            header = f"From: {sender}\r\nSubject: {Header(subject, 'utf-8').encode()}\r\n\r\n".encode()
+            return [(f"{prefix} BODY[HEADER.FIELDS (FROM SUBJECT)] {{{len(header)}}}".encode(), header), b')']
+        if query == '(BODYSTRUCTURE)':
+            parts = '("text" "plain" ("charset" "utf-8") NIL NIL "7bit" 5 1 NIL NIL NIL NIL)'
+            if attachment is not None:
+                parts += (f'({XLSX_TYPE} ("name" "{filename}") NIL NIL "base64" {len(encoded)} NIL '
+                          f'("attachment" ("filename" "{filename}")) NIL NIL)')
+            return [f'{prefix} BODYSTRUCTURE ({parts} "mixed" ("boundary" "b") NIL NIL NIL))'.encode()]
+        match = re.fullmatch(r'\(BODY\.PEEK\[(\d+)\]<(\d+)\.(\d+)>\)', query)
+        if match:
+            self.mailbox.fetched.append(uid)
+            offset, size = int(match.group(2)), int(match.group(3))
+            chunk = encoded[offset:offset + size]
+            return [(f"{prefix} BODY[{match.group(1)}]<{offset}> {{{len(chunk)}}}".encode(), chunk), b')']
+        return [None]
@@ -0,0 +1,89 @@
+"""Локальная замена Telegram Bot API для тестов: записывает вызовы и по заказу отвечает ошибками"""
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Condition, Thread
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeTelegram:
+    """HTTP-сервер с методами Bot API, которые вызывает бот; calls — (время, метод, параметры)"""
+
+    def __init__(self):
+        self.calls = []
+        self._errors = {}
+        self._changed = Condition()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                url = urlparse(self.path)
+                method = url.path.rsplit('/', 1)[-1]
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode()
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                if body:
+                    params.update({k: v[0] for k, v in parse_qs(body).items()})
+                status, response = fake.call(method, params)
+                out = json.dumps(response).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.api_url = f"http://127.0.0.1:{self.server.server_address[1]}/bot{{0}}/{{1}}"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        with self._changed:
+            self.calls = []
+            self._errors = {}
+
+    def fail_next(self, method, error_code, retry_after=None):
+        """Следующий вызов method завершится ошибкой API error_code (для 429 — с retry_after)"""
+        response = {'ok': False, 'error_code': error_code, 'description': f"Error {error_code}"}
+        if retry_after is not None:
+            response['parameters'] = {'retry_after': retry_after}
+        with self._changed:
+            self._errors.setdefault(method, []).append((error_code, response))
+
+    def call(self, method, params):
+        with self._changed:
+            self.calls.append((time.monotonic(), method, params))
+            self._changed.notify_all()
+            errors = self._errors.get(method)
+            if errors:
+                return errors.pop(0)
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'test', 'username': 'test_bot'}}
+        if method == 'sendMessage':
+            chat = {'id': int(params['chat_id']), 'type': 'private'}
+            message = {'message_id': len(self.calls), 'date': 0, 'chat': chat, 'text': params.get('text', '')}
+            return 200, {'ok': True, 'result': message}
+        return 200, {'ok': True, 'result': True}
+
+    def sent(self, method='sendMessage'):
+        """Вызовы method в порядке поступления: (время, параметры)"""
+        with self._changed:
+            return [(at, params) for at, name, params in self.calls if name == method]
+
+    def wait_for(self, count, method='sendMessage', timeout=10):
+        """Ждёт, пока method вызовут count раз; возвращает эти вызовы"""
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while len(self.sent(method)) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise AssertionError(f"{method} вызван {len(self.sent(method))} раз вместо {count}")
+                self._changed.wait(remaining)
+        return self.sent(method)
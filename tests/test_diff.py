@@ -0,0 +1,72 @@
+import openpyxl
+import pytest
+
+from core import EXCEL_COLUMNS, DatabaseManager, compare_excel_with_db, sync_db_with_excel
+
+
+def write_export(path, rows):
+    """Excel-выгрузка с колонками EXCEL_COLUMNS; rows — словари по именам колонок products"""
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append(list(EXCEL_COLUMNS))
+    for row in rows:
+        sheet.append([row.get(column) for column in EXCEL_COLUMNS.values()])
+    workbook.save(path)
+    return str(path)
+
+
+def export_rows(period, count=4, overrides=None):
+    overrides = overrides or {}
+    return [
+        {
+            'period': period, 'article': f"A{i}", 'name': f"Деталь {i}", 'code': f"C{i}", 'warehouse': 'СКЛАД',
+            'quantity': i + 1, 'price': 10.0 * (i + 1), 'currency': 'RUB', 'price_date': '01.06.2025',
+            **overrides.get(i, {}),
+        }
+        for i in range(count)
+    ]
+
+
+@pytest.fixture
+def db(tmp_path):
+    manager = DatabaseManager(str(tmp_path / 'products.db'), with_snapshot=False).open()
+    assert manager.update_from_excel(write_export(tmp_path / 'first.xlsx', export_rows('01.06.2025')))
+    return manager
+
+
+def periods(db):
+    with db.pool.reader() as conn:
+        return {row[0] for row in conn.execute('SELECT period FROM products')}
+
+
+def test_period_change_is_applied_as_delta(db, tmp_path, monkeypatch):
+    export = write_export(tmp_path / 'second.xlsx', export_rows('02.06.2025'))
+
+    diff = compare_excel_with_db(db, export, max_ratio=0.5)
+    assert diff['counts'] == {'added': 0, 'removed': 0, 'changed': 0}
+    assert (diff['period'], diff['period_changed']) == ('02.06.2025', True)
+
+    monkeypatch.setattr(db, 'update_from_excel', lambda *args: pytest.fail("полная загрузка вместо дельты"))
+    assert sync_db_with_excel(db, export)
+    assert periods(db) == {'02.06.2025'}
+
+
+def test_period_change_with_row_changes(db, tmp_path):
+    export = write_export(tmp_path / 'second.xlsx', export_rows('02.06.2025', overrides={1: {'quantity': 50}}))
+
+    diff = compare_excel_with_db(db, export, max_ratio=0.5)
+    assert diff['counts'] == {'added': 0, 'removed': 0, 'changed': 1}
+    assert list(diff['changed'][0][2]) == ['quantity']
+    assert db.apply_delta(diff)
+    assert periods(db) == {'02.06.2025'}
+
+
+def test_mixed_periods_are_compared_per_row(db, tmp_path):
+    export = write_export(tmp_path / 'second.xlsx', export_rows('01.06.2025', overrides={2: {'period': '02.06.2025'}}))
+
+    diff = compare_excel_with_db(db, export, max_ratio=0.5)
+    assert diff['period_changed'] is False
+    assert diff['counts'] == {'added': 0, 'removed': 0, 'changed': 1}
+    assert diff['changed'][0][2] == {'period': {'old': '01.06.2025', 'new': '02.06.2025'}}
+    assert db.apply_delta(diff)
+    assert periods(db) == {'01.06.2025', '02.06.2025'}
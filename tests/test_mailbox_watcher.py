@@ -0,0 +1,114 @@
+import hashlib
+import time
+from threading import Event, Thread
+
+import pytest
+
+from fake_imap import FakeMailbox
+
+SENDER = 'reports@example.com'
+
+
+class Calls:
+    """on_new_mail для наблюдателя: считает вызовы и позволяет их дождаться"""
+
+    def __init__(self):
+        self.count = 0
+        self.event = Event()
+
+    def __call__(self):
+        self.count += 1
+        self.event.set()
+
+    def wait(self, count, timeout=10):
+        deadline = time.monotonic() + timeout
+        while self.count < count:
+            assert time.monotonic() < deadline, f"вызовов {self.count} вместо {count}"
+            self.event.wait(0.05)
+            self.event.clear()
+
+
+@pytest.fixture
+def watch(mail_watcher):
+    """Запускает MailboxWatcher в отдельном потоке и останавливает его после теста"""
+    started = []
+
+    def start(mailbox, **kwargs):
+        calls = Calls()
+        watcher = mail_watcher.MailboxWatcher(calls, imap_factory=mailbox.connect, **kwargs)
+        thread = Thread(target=watcher.run, daemon=True)
+        thread.start()
+        started.append((watcher, thread))
+        return calls
+
+    yield start
+    for watcher, thread in started:
+        watcher.stop()
+        thread.join(5)
+        assert not thread.is_alive()
+
+
+def test_idle_notification_starts_ingest(watch):
+    mailbox = FakeMailbox()
+    calls = watch(mailbox, mode='idle', idle_timeout=30)
+    # Сразу после подключения — проверка писем, пришедших без соединения
+    calls.wait(1)
+
+    mailbox.deliver(SENDER, 'Остатки')
+    calls.wait(2)
+    assert mailbox.idle_calls >= 1
+    assert len(mailbox.connects) == 1
+
+
+def test_reconnects_with_growing_delay(watch):
+    mailbox = FakeMailbox()
+    mailbox.fail_connects = 2
+    calls = watch(mailbox, mode='idle', idle_timeout=30)
+
+    first, second, third = mailbox.wait_connects(3)
+    assert 0.9 <= second - first < 1.9
+    assert 1.9 <= third - second < 3.5
+    calls.wait(1)
+
+    # После успешного подключения пауза снова начинается с секунды
+    mailbox.drop()
+    fourth = mailbox.wait_connects(4)[3]
+    assert 0.9 <= fourth - third
+    calls.wait(2)
+    mailbox.deliver(SENDER, 'Остатки')
+    calls.wait(3)
+
+
+def test_falls_back_to_polling_without_idle(watch):
+    mailbox = FakeMailbox(capabilities=('IMAP4REV1',))
+    calls = watch(mailbox, mode='idle', poll_interval=0.2)
+    calls.wait(1)
+
+    mailbox.deliver(SENDER, 'Остатки')
+    calls.wait(2)
+    assert mailbox.idle_calls == 0
+
+
+def test_download_skips_processed_mail_and_fetches_fresh_uid(mail_watcher, monkeypatch, tmp_path):
+    mailbox = FakeMailbox()
+    monkeypatch.setattr(mail_watcher.imaplib, 'IMAP4_SSL', lambda server: mailbox.connect())
+    # Вложение больше порции скачивания, чтобы проверить склейку base64 между порциями
+    monkeypatch.setattr(mail_watcher, 'MAIL_FETCH_CHUNK', 64)
+    path = tmp_path / 'bot_data.xlsx'
+
+    first = bytes(range(256)) * 3
+    uid = mailbox.deliver(SENDER, 'Остатки', first)
+    mailbox.deliver('someone@example.com', 'Не то письмо', b'other')
+    download = mail_watcher.download_latest_excel(None, str(path))
+    assert download == {'uid': f"777:{uid}", 'sha256': hashlib.sha256(first).hexdigest()}
+    assert path.read_bytes() == first
+
+    fetched = len(mailbox.fetched)
+    assert mail_watcher.download_latest_excel(download['uid'], str(path)) == {'uid': download['uid'], 'sha256': None}
+    assert len(mailbox.fetched) == fetched
+
+    second = b'new export'
+    uid = mailbox.deliver(SENDER, 'Остатки', second)
+    download = mail_watcher.download_latest_excel(download['uid'], str(path))
+    assert download == {'uid': f"777:{uid}", 'sha256': hashlib.sha256(second).hexdigest()}
+    assert path.read_bytes() == second
@@ -0,0 +1,86 @@
+import time
+
+import pytest
+
+CHAT_INTERVAL = 0.3
+
+
+@pytest.fixture
+def outbox(bot_main, telegram):
+    """SendQueue, отправляющая через настоящий TeleBot в telegram"""
+    bot = bot_main.DispatchingTeleBot('1:test', threaded=False)
+    return bot_main.SendQueue(bot.send_now, workers=2, chat_interval=CHAT_INTERVAL, global_rate=1000, retries=2)
+
+
+def texts(calls):
+    return [params['text'] for _, params in calls]
+
+
+def wait_stats(outbox, timeout=5, **expected):
+    """Ждёт, пока счётчики очереди станут равны expected: вызов в API записан раньше, чем обработан ответ"""
+    deadline = time.monotonic() + timeout
+    while True:
+        stats = outbox.stats()
+        if all(stats[name] == value for name, value in expected.items()) or time.monotonic() > deadline:
+            return stats
+        time.sleep(0.01)
+
+
+def test_messages_queued_during_chat_interval_are_coalesced(outbox, telegram):
+    outbox.put('sendMessage', 1, 'a', {})
+    telegram.wait_for(1)
+    outbox.put('sendMessage', 1, 'b', {})
+    outbox.put('sendMessage', 1, 'c', {})
+
+    assert texts(telegram.wait_for(2)) == ['a', 'b\n\nc']
+    time.sleep(CHAT_INTERVAL * 2)
+    assert len(telegram.sent()) == 2
+    assert wait_stats(outbox, coalesced=1, sent=2)['coalesced'] == 1
+
+
+def test_messages_with_different_options_are_not_coalesced(outbox, telegram):
+    outbox.put('sendMessage', 1, 'a', {})
+    telegram.wait_for(1)
+    outbox.put('sendMessage', 1, 'b', {'parse_mode': 'HTML'})
+    outbox.put('sendMessage', 1, 'c', {})
+
+    assert texts(telegram.wait_for(3)) == ['a', 'b', 'c']
+
+
+def test_per_chat_interval_does_not_delay_other_chats(outbox, telegram):
+    outbox.put('sendMessage', 1, 'a', {})
+    outbox.put('sendMessage', 1, 'b', {'parse_mode': 'HTML'})
+    outbox.put('sendMessage', 2, 'x', {})
+
+    calls = telegram.wait_for(3)
+    by_chat = {}
+    for at, params in calls:
+        by_chat.setdefault(params['chat_id'], []).append((at, params['text']))
+    (first_at, _), (second_at, _) = by_chat['1']
+    assert second_at - first_at >= CHAT_INTERVAL * 0.9
+    # Второй чат не ждёт интервала первого
+    assert by_chat['2'][0][0] < second_at
+
+
+def test_flood_wait_retries_after_retry_after(outbox, telegram):
+    telegram.fail_next('sendMessage', 429, retry_after=1)
+    outbox.put('sendMessage', 1, 'a', {})
+
+    (first_at, _), (second_at, params) = telegram.wait_for(2)
+    assert params['text'] == 'a'
+    assert second_at - first_at >= 0.9
+    stats = wait_stats(outbox, sent=1)
+    assert stats['flood_waits'] == 1
+    assert stats['sent'] == 1
+    assert stats['dropped'] == 0
+
+
+def test_client_error_drops_message_and_keeps_chat_order(outbox, telegram):
+    telegram.fail_next('sendMessage', 403)
+    outbox.put('sendMessage', 1, 'a', {})
+    outbox.put('sendMessage', 1, 'b', {'parse_mode': 'HTML'})
+
+    assert texts(telegram.wait_for(2)) == ['a', 'b']
+    time.sleep(CHAT_INTERVAL * 2)
+    assert len(telegram.sent()) == 2
+    assert wait_stats(outbox, dropped=1, sent=1)['dropped'] == 1